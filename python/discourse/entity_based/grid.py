@@ -14,7 +14,7 @@ import numpy as np
 import sys
 import logging
 import itertools
-from discourse.util import pairwise, bar
+from discourse.util import bar, chunks
 from discourse.doctext import iterdoctext
 from discourse import command
 import functools
@@ -25,20 +25,62 @@ i2r = {v: k for k, v in r2i.iteritems()}
 
 
 def read_grids(istream, str2int):
-    return [np.array([[str2int[role] for role in line] for line in lines], int) for lines, attrs in iterdoctext(istream)]
-
-
-def train(corpus, vocab_size, salience):
+    return list(iter_grids(istream, str2int))
+
+
+def iter_grids(istream, str2int):
+    """iterates over grids (one at a time, see `read_grids`)"""
+    return (np.array([[str2int[role] for role in line] for line in lines], int) for lines, attrs in iterdoctext(istream))
+
+
+def train(corpus, vocab_size, salience, chunk_size=1000):
+    """
+    Counts roles (unigrams) and role transitions (bigrams) of the entities in a corpus of grids.
+
+    Grids are processed in chunks: the roles of all salient entities in a chunk are flattened
+    and counted with `np.bincount`, where a transition (ri, rj) between consecutive sentences
+    is encoded as vocab_size * ri + rj.
+    The corpus can be a generator (see `iter_grids`), only one chunk is held in memory at a time.
+
+    Arguments
+    ---------
+    corpus: iterable of grids (int arrays: sentences x entities)
+    vocab_size: number of roles
+    salience: minimum number of (non-null) roles an entity must have in order to be counted
+    chunk_size: number of grids counted at once
+
+    Returns
+    -------
+    U: unigram counts
+    B: bigram counts
+
+    >>> grids = [np.array([[3, 0], [2, 0], [0, 1]]), np.array([[1], [1]])]
+    >>> U, B = train(grids, 4, 0)
+    >>> U
+    array([3, 3, 1, 1])
+    >>> B[3,2], B[2,0], B[1,1], B[0,0], B.sum()
+    (1, 1, 1, 1, 5)
+    >>> train(grids, 4, 2)[0]
+    array([1, 2, 1, 1])
+    """
     U = np.zeros(vocab_size, int)
-    B = np.zeros((vocab_size, vocab_size), int)
-    for grid in bar(corpus, msg='Counting role transitions'):
-        for entity_roles in grid.transpose():
-            if get_number_of_occurrences(entity_roles) >= salience:
-                for r in entity_roles:
-                    U[r] += 1
-                for ri, rj in pairwise(entity_roles):
-                    B[ri,rj] += 1
-    return U, B
+    B = np.zeros(vocab_size * vocab_size, int)
+    n = 0
+    for grids in chunks(bar(corpus, msg='Counting role transitions'), chunk_size):
+        n += len(grids)
+        roles, transitions = [], []
+        for grid in grids:
+            if not grid.size:
+                continue
+            # entities whose number of roles (not null) is above the threshold
+            grid = grid[:, (grid != r2i['-']).sum(0) >= salience]
+            roles.append(grid.ravel())
+            transitions.append((vocab_size * grid[:-1] + grid[1:]).ravel())
+        if roles:
+            U += np.bincount(np.concatenate(roles), minlength=vocab_size)
+            B += np.bincount(np.concatenate(transitions), minlength=vocab_size * vocab_size)
+    logging.info('Training set contains %d docs', n)
+    return U, B.reshape(vocab_size, vocab_size)
 
 
 def get_number_of_occurrences(entity_roles):
@@ -60,20 +102,24 @@ def main(args):
             level=(logging.DEBUG if args.verbose else logging.INFO), 
             format='%(levelname)s %(message)s')
 
-    training = read_grids(args.input, r2i)
-    logging.info('Training set contains %d docs', len(training))
+    # grids are streamed in (see `train`)
+    training = iter_grids(args.input, r2i)
     unigrams, bigrams = train(training, len(r2i), args.salience) 
     logging.info('%d unigrams and %d bigrams', unigrams.size, bigrams.size)
-    
+    write_model(args.output, unigrams, bigrams)
+
+
+def write_model(prefix, unigrams, bigrams):
+    """stores unigrams (prefix.unigrams) and bigrams (prefix.bigrams)"""
     # save unigrams and bigrams
     # this is nice ;) but perhaps for now we are interested in a more human readable format
     # np.savetxt('{0}.unigrams'.format(args.output), unigrams)
     # np.savetxt('{0}.bigrams'.format(args.output), bigrams)
-    with open('{0}.unigrams'.format(args.output), 'w') as fu:
+    with open('{0}.unigrams'.format(prefix), 'w') as fu:
         print >> fu, '#role\t#count'
         for rid, count in enumerate(unigrams):
             print >> fu, '{0}\t{1}'.format(i2r[rid], count)
-    with open('{0}.bigrams'.format(args.output), 'w') as fb:
+    with open('{0}.bigrams'.format(prefix), 'w') as fb:
         print >> fb, '#role\t#role\t#count'
         for r1, r2 in itertools.product(xrange(len(r2i)), xrange(len(r2i))):
             print >> fb, '{0}\t{1}\t{2}'.format(i2r[r1], i2r[r2], bigrams[r1,r2])
@@ -6,13 +6,14 @@ Created on 25 Nov 2014
 @author: Karin Sim
 """
 import sys
+import os
 import argparse
 import logging
 import itertools
 import traceback
 import numpy as np
-from discourse.util import pairwise, smart_open
-from grid import read_grids, r2i, i2r
+from discourse.util import pairwise, smart_open, atomic_open, imap_documents
+from grid import read_grids, iter_grids, r2i, i2r
 from discourse import command
 from multiprocessing import Pool
 from functools import partial
@@ -44,31 +45,103 @@ def read_bigrams(istream, str2int):
     return B
 
 
-def grid_loglikelihood(grid, U, B, salience=0):
+def transition_logprobs(U, B):
+    """
+    Precomputes the table of log transition probabilities: log p(rj|ri) = log c(ri,rj)/c(ri).
+
+    >>> transition_logprobs(np.array([2, 4]), np.array([[1, 1], [0, 4]]))
+    array([[-0.69314718, -0.69314718],
+           [       -inf,  0.        ]])
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.log(B / U[:, np.newaxis].astype(float))
+
+
+def grid_loglikelihood(grid, U, B, salience=0, logprobs=None):
+    """
+    Scores a single grid (see `loglikelihood` to score a batch of grids at once).
+
+    Arguments
+    ---------
+    grid: int array (sentences x entities) of roles
+    U: unigram counts
+    B: bigram counts
+    salience: salience variable for entities
+    logprobs: log transition probabilities (see `transition_logprobs`), computed from U and B if not given
+
+    Returns
+    -------
+    log probability of the grid normalised by its size
+
+    >>> U, B = np.array([2, 4]), np.array([[1, 1], [0, 4]])
+    >>> grid_loglikelihood(np.array([[0, 1], [1, 1], [1, 1]]), U, B)
+    -0.11552453009332421
+    """
+    if logprobs is None:
+        logprobs = transition_logprobs(U, B)
     # sum_i sum_j log p(rj|ri)
-    # where p(rj|ri) = c(ri,rj)/c(ri)
-    logprob = np.sum([
-        np.sum(
-            [np.log( np.divide(float(B[ri,rj]), U[ri])) for ri, rj in pairwise(entity_roles)])
-        for entity_roles in grid.transpose()])
+    # where p(rj|ri) = c(ri,rj)/c(ri) and (ri, rj) are the roles of an entity in consecutive sentences
+    logprob = logprobs[grid[:-1], grid[1:]].sum()
     # probabilities for individual columns are normalized by column
     # length (n) and the probability of the entire text is normalized
     # by the number of columns (m):
-    return logprob / grid.size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return logprob / grid.size
 
 
 def loglikelihood(corpus, U, B, salience):
-    return np.array([grid_loglikelihood(grid, U, B, salience) for grid in corpus])
+    """
+    Scores a batch of grids at once: transitions of all grids are flattened
+    and the log probabilities are summed per grid with a single `np.bincount`.
+
+    >>> U, B = np.array([2, 4]), np.array([[1, 1], [0, 4]])
+    >>> loglikelihood([np.array([[0, 1], [1, 1], [1, 1]]), np.array([[0], [0]])], U, B, 0)
+    array([-0.11552453, -0.34657359])
+    """
+    logprobs = transition_logprobs(U, B)
+    if not len(corpus):
+        return np.zeros(0)
+    # roles of each entity in a sentence (ri) and in the next one (rj)
+    ri = np.concatenate([grid[:-1].ravel() for grid in corpus])
+    rj = np.concatenate([grid[1:].ravel() for grid in corpus])
+    grid_ids = np.repeat(np.arange(len(corpus)), [grid[:-1].size for grid in corpus])
+    logprob = np.bincount(grid_ids, weights=logprobs[ri, rj], minlength=len(corpus))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return logprob / np.array([grid.size for grid in corpus])
     
 
-def wrapped_loglikelihood(corpus, U, B, salience):
+# the model is shared with worker processes (inherited when the pool forks, thus never pickled)
+_SHARED_ = {}
+
+
+def _init_worker(U, B, salience):
+    _SHARED_.update(U=U, B=B, salience=salience)
+
+
+def _shared_model(unigrams, bigrams, mtime):
+    """loads a model once per worker of a shared pool (whose workers were not initialised with it, see `decode_many`)"""
+    key = (unigrams, bigrams, mtime)
+    if key not in _SHARED_:
+        _SHARED_[key] = read_unigrams(smart_open(unigrams), r2i), read_bigrams(smart_open(bigrams), r2i)
+    return _SHARED_[key]
+
+
+def wrapped_loglikelihood(corpus):
     try:
-        return loglikelihood(corpus, U, B, salience)
+        return loglikelihood(corpus, _SHARED_['U'], _SHARED_['B'], _SHARED_['salience']), [grid.shape for grid in corpus]
     except:
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
 
 
-def decode_many(unigrams, bigrams, salience, ipaths, opaths, jobs, estream=sys.stderr):
+def wrapped_loglikelihood_with(model, salience, corpus):
+    try:
+        U, B = _shared_model(*model)
+        return loglikelihood(corpus, U, B, salience), [grid.shape for grid in corpus]
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def decode_many(unigrams, bigrams, salience, ipaths, opaths, jobs, estream=sys.stderr, chunk_size=100, pool=None):
 
     # reads in the model
     logging.info('Reading unigrams from: %s', unigrams)
@@ -79,27 +152,36 @@ def decode_many(unigrams, bigrams, salience, ipaths, opaths, jobs, estream=sys.s
     B = read_bigrams(smart_open(bigrams), r2i)
     logging.info('Read in %d bigrams', B.size)
     
-    
-    tests = [None] * len(ipaths)
-    for i, ipath in enumerate(ipaths):
-        documents = read_grids(smart_open(ipath), r2i)
-        logging.info('%s: %d test documents read', ipath, len(documents))
-        tests[i] = documents 
-
-    # computes the log likelihood of each document in each test file
-    pool = Pool(jobs)
-    all_L = pool.map(partial(wrapped_loglikelihood, U=U, B=B, salience=salience), tests)
-
-    print >> estream, '#file\t#sum\t#mean'
-    for ipath, opath, test, L in itertools.izip(ipaths, opaths, tests, all_L):
-        with smart_open(opath, 'w') as ostream:
+    # test grids are streamed in and scored in chunks by the workers (as they become available)
+    # each file is written out as soon as all of its chunks are scored
+    if pool is None:
+        pool, shared = Pool(jobs, _init_worker, (U, B, salience)), False
+        func = wrapped_loglikelihood
+    else:
+        # workers of a shared pool load the model themselves (once)
+        shared = True
+        func = partial(wrapped_loglikelihood_with, (unigrams, bigrams, max(os.path.getmtime(unigrams), os.path.getmtime(bigrams))), salience)
+    summary = [None] * len(ipaths)
+    for k, results in imap_documents(pool, func, ipaths, 
+            partial(iter_grids, str2int=r2i), chunk_size, max_pending=4 * jobs):
+        n = 0
+        with atomic_open(opaths[k]) as ostream:
             # dumps scores
             print >> ostream, '#doc\t#logprob\t#sentences\t#entities'
-            for i, ll in enumerate(L):
-                num_sentences = test[i].shape[0]
-                num_entities = test[i].shape[1]
-                print >> ostream, '{0}\t{1}\t{2}\t{3}'.format(i, ll, num_sentences, num_entities)
-            print >> estream, '{0}\t{1}\t{2}'.format(opath, L.sum(), np.mean(L))
+            for L, shapes in results:
+                for ll, (num_sentences, num_entities) in itertools.izip(L, shapes):
+                    print >> ostream, '{0}\t{1}\t{2}\t{3}'.format(n, ll, num_sentences, num_entities)
+                    n += 1
+        L = np.concatenate([L for L, _ in results])
+        logging.info('%s: %d test documents scored', ipaths[k], n)
+        summary[k] = '{0}\t{1}\t{2}'.format(opaths[k], L.sum(), L.mean() if n else np.nan)
+    if not shared:
+        pool.close()
+        pool.join()
+
+    print >> estream, '#file\t#sum\t#mean'
+    for line in summary:
+        print >> estream, line
 
 
 def main(args):
@@ -114,8 +196,7 @@ def main(args):
     test = read_grids(args.input, r2i)
     logging.info('Scoring %d documents', len(test)) 
     print >> args.output, '#docid\t#loglikelihood'
-    for i, grid in enumerate(test):
-        ll = grid_loglikelihood(grid, U, B, args.salience)
+    for i, ll in enumerate(loglikelihood(test, U, B, args.salience)):
         print >> args.output, '{0}\t{1}'.format(i, ll)
             
 
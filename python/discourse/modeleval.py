@@ -8,35 +8,33 @@ def ranks_higher(R, sysid, strictly=True):
 
     Arguments
     ---------
-    R[m,d,s]: is the ranking of system s in document d by model m
+    R[m,d,s]: is the ranking of system s in document d by model m 
+        (or R[b,m,d,s] for a batch of resampled tensors, in which case the result is goodness[b,m])
     sysid: is the index of the system we are taking as reference
     strictly: strictly higher or not 
 
     Returns
     -------
     goodness[m] = average across documents of the rate at which model m scores sysid higher than other systems
+
+    >>> ranks_higher(np.array([[[1, 2, 2], [2, 1, 2]]]), 0)
+    array([0.5])
+    >>> ranks_higher(np.array([[[1, 2, 2], [2, 1, 2]]]), 0, strictly=False)
+    array([0.75])
     """
-    M, D, S = R.shape
+    D, S = R.shape[-2:]
     # for each model
     #   for each document
     #       computes the rate at which the references scores higher than other systems (the denominator S-1 excludes the ref)
     #   and returns the average across documents for that given model
-
-    with_ties = np.zeros(M, float)
-    no_ties = np.zeros(M, float)
-    for m in xrange(M):
-        for d in xrange(D):
-            for s in xrange(S):
-                if s == sysid:  # we must exclude the reference
-                    continue
-                if R[m,d,sysid] < R[m,d,s]:
-                    no_ties[m] += 1
-                if R[m,d,sysid] <= R[m,d,s]:
-                    with_ties[m] += 1
+    ref = R[..., sysid:sysid+1]
     # we must exclude the reference
-    with_ties /= (S-1) * D 
-    no_ties /= (S-1) * D  
-    return no_ties if strictly else with_ties
+    others = np.delete(R, sysid, -1)
+    if strictly:
+        higher = (ref < others).sum((-2, -1))
+    else:
+        higher = (ref <= others).sum((-2, -1))
+    return higher / float((S-1) * D)
 
 
 
@@ -47,31 +45,28 @@ def expected_win(R, sysid):
     Arguments
     ---------
     R[m,d,s]: is the ranking of system s in document d by model m
+        (or R[b,m,d,s] for a batch of resampled tensors, in which case the result is expectedwin[b,m])
     sysid: is the index of the system we are taking as reference
 
     Returns
     -------
     expectedwin[m]
+
+    >>> expected_win(np.array([[[1, 2, 2], [2, 1, 2], [1, 1, 2]]]), 0)
+    array([0.5])
     """
-    M, D, S = R.shape
-    ref_wins = np.zeros((M, S))
-    ref_loses = np.zeros((M, S))
-    for m in xrange(M):
-        for d in xrange(D):
-            for s in xrange(S):
-                if s == sysid:
-                    continue
-                if R[m,d,sysid] < R[m,d,s]:
-                    ref_wins[m,s] += 1
-                elif R[m,d,sysid] > R[m,d,s]:
-                    ref_loses[m,s] += 1
-
-    score = np.zeros(M)
-    for m in xrange(M):
-        for s in xrange(S):
-            if s == sysid: 
-                continue
-            score[m] += ref_wins[m,s]/(ref_wins[m,s] + ref_loses[m,s])
+    S = R.shape[-1]
+    ref = R[..., sysid:sysid+1]
+    # we must exclude the reference
+    others = np.delete(R, sysid, -1)
+    # ref_wins[...,s] and ref_loses[...,s] count documents (ties are ignored)
+    ref_wins = (ref < others).sum(-2).astype(float)
+    ref_loses = (ref > others).sum(-2).astype(float)
+    ratios = ref_wins / (ref_wins + ref_loses)
+    # accumulated one system at a time (in order) as to reproduce the exact same floating point sums
+    score = np.zeros(R.shape[:-2])
+    for s in xrange(S - 1):
+        score += ratios[..., s]
 
     return score/S
 
@@ -81,26 +76,27 @@ def top1(R, sysid, exclusive=False):
     Arguments
     ---------
     R[m,d,s]: is the ranking of system s in document d by model m
+        (or R[b,m,d,s] for a batch of resampled tensors, in which case the result is goodness[b,m])
     exclusive: whether or not we allow the first ranking to be shared with other systems
 
     Returns
     -------
     goodness[m] = average across documents of the rate at which model m is ranked first
+
+    >>> top1(np.array([[[1, 2, 2], [1, 1, 2]]]), 0)
+    array([1.])
+    >>> top1(np.array([[[1, 2, 2], [1, 1, 2]]]), 0, exclusive=True)
+    array([0.5])
     """
-    M, D, S = R.shape
+    D = R.shape[-2]
     # for each model
     #   for each document
-    #       computes the rate at which the references scores higher than other systems (the denominator S-1 excludes the ref)
+    #       checks whether the reference is ranked first (possibly alone)
     #   and returns the average across documents for that given model
-    with_ties = np.zeros(M, float)
-    no_ties = np.zeros(M, float)
-    for m in xrange(M):
-        for d in xrange(D):
-            if R[m,d,sysid] == 1:
-                with_ties[m] += 1
-                if sum(r == 1 for r in R[m,d,:]) == 1:
-                    no_ties[m] += 1
-    return no_ties/D if exclusive else with_ties/D
+    first = R[..., sysid] == 1
+    if exclusive:
+        first &= (R == 1).sum(-1) == 1
+    return first.sum(-1) / float(D)
 
 
 def rho(R, sysid, gold_rankings):
@@ -9,18 +9,22 @@ import argparse
 import traceback
 import itertools
 import shlex
-import subprocess as sp
+import hashlib
 import numpy as np
 from discourse import command
 from glob import glob
 from functools import partial
-from multiprocessing import Pool
+from multiprocessing import Pool, Process
 from discourse.doctext import iterdoctext, writedoctext
-from discourse.syntax_based.dseq import dseqs
+from discourse.syntax_based.dseq import dseqs_at, cached_dseqs, DSeqCache
 from discourse.syntax_based.ibm1_decoder import decode_many as ibm1_decode_many
 from discourse.syntax_based.alouis_decoder import decode_many as alouis_decode_many
 from discourse.entity_based.grid_decoder import decode_many as grid_decode_many
-from discourse.util import smart_open, tabulate, partial_ordering
+from discourse.syntax_based.ibm1 import argparser as ibm1_argparser, train_model as ibm1_train_model
+from discourse.syntax_based.alouis import argparser as alouis_argparser, train_model as alouis_train_model
+from discourse.syntax_based.packed import read_corpus
+from discourse.entity_based.grid import argparser as grid_argparser, train as grid_train, write_model as grid_write_model, iter_grids, r2i
+from discourse.util import smart_open, atomic_open, atomic_path, tabulate, Task, run_tasks, partial_ordering, iter_documents, build_vocab, save_vocab, load_vocab_counts
 
 
 def make_namespace(args):
@@ -34,6 +38,9 @@ def make_namespace(args):
     if args.unk:
         ibm1_experiment += '.u'
         alouis_experiment += '.u'
+    if args.min_count:
+        ibm1_experiment += '.mc{0}'.format(args.min_count)
+        alouis_experiment += '.mc{0}'.format(args.min_count)
     if args.insertion:
         alouis_experiment += '.i'
 
@@ -51,6 +58,7 @@ def make_namespace(args):
         # output stuff
         'workspace': args.workspace,
         'dseqs': '{0}/dseqs{1}'.format(args.workspace, args.depth),
+        'vocab': '{0}/dseqs{1}.{2}.vocab'.format(args.workspace, args.depth, args.training),
         'ibm1': '{0}/ibm1/{1}'.format(args.workspace, ibm1_experiment),
         'ibm1_model': '{0}/ibm1/{1}/model'.format(args.workspace, ibm1_experiment),
         'ibm1_probs': '{0}/ibm1/{1}/probs'.format(args.workspace, ibm1_experiment),
@@ -86,130 +94,395 @@ def make_namespace(args):
 
     return names
 
-def file_check(corpus, input_dir, output_dir):
-    todo = frozenset(os.path.basename(path) for path in glob('{0}/{1}*'.format(input_dir, corpus)))
-    logging.info('%d files matching %s', len(todo), '{0}/{1}*'.format(input_dir, corpus))
-    done = frozenset(os.path.basename(path) for path in glob('{0}/{1}*'.format(output_dir, corpus)))
-    logging.info('%d files matching %s', len(done), '{0}/{1}*'.format(output_dir, corpus))
-    missing = todo - done
-    return todo, done, missing
+# digests of files (keyed by path, size and modification time) so that every file is hashed at most once per run
+_DIGESTS_ = {}
+# source files are fingerprinted relative to the package
+_PACKAGE_ = os.path.dirname(os.path.abspath(__file__))
 
-def wrap_dseqs((i, ipath, opath), depth, **kwargs):
+
+def file_digest(path):
+    """sha1 of the contents of a file"""
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime)
+    if key not in _DIGESTS_:
+        h = hashlib.sha1()
+        with open(path, 'rb') as fi:
+            for block in iter(lambda: fi.read(1 << 20), ''):
+                h.update(block)
+        _DIGESTS_[key] = h.hexdigest()
+    return _DIGESTS_[key]
+
+
+def fingerprint(inputs=[], params={}, code=[], deps=[]):
+    """
+    Fingerprints an artifact of the pipeline (e.g. a model or a file of probabilities).
+
+    Arguments
+    ---------
+    inputs: paths to input files (their contents are hashed)
+    params: hyperparameters which affect the artifact
+    code: source files (relative to the package) which produce the artifact
+    deps: fingerprints of upstream artifacts (e.g. the model used to produce probabilities)
+
+    Returns
+    -------
+    a hex digest which changes whenever any of the above changes
+    """
+    h = hashlib.sha1()
+    for path in sorted(inputs):
+        h.update('input {0} {1}\n'.format(os.path.basename(path), file_digest(path)))
+    for k, v in sorted(params.iteritems()):
+        h.update('param {0}={1!r}\n'.format(k, v))
+    for name in code:
+        h.update('code {0} {1}\n'.format(name, file_digest(os.path.join(_PACKAGE_, name))))
+    for fp in deps:
+        h.update('dep {0}\n'.format(fp))
+    return h.hexdigest()
+
+
+def stamp_path(namespace, artifact):
+    """stamps live in a hidden tree which mirrors the workspace (so that they never match the globs of the pipeline)"""
+    return os.path.join(namespace.workspace, '.stamps', os.path.relpath(artifact, namespace.workspace))
+
+
+def is_fresh(namespace, artifact, fp, outputs=None):
+    """an artifact is fresh if all of its outputs exist and it was stamped with the same fingerprint"""
+    if not all(os.path.exists(path) for path in (outputs or [artifact])):
+        return False
+    path = stamp_path(namespace, artifact)
+    if not os.path.exists(path):
+        return False
+    with open(path) as fi:
+        return fi.read().strip() == fp
+
+
+def stamp(namespace, artifact, fp):
+    """marks an artifact as built (stamps are written once all of its outputs are complete)"""
+    path = stamp_path(namespace, artifact)
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:  # made by another process in the meantime
+            pass
+    with atomic_open(path) as fo:
+        print >> fo, fp
+
+
+def stale_files(corpus, input_dir, output_dir, namespace, force=False, **kwargs):
+    """
+    Lists the files of a corpus whose outputs are stale (see `is_fresh`).
+
+    Returns
+    -------
+    list of triples (name, input path, output path, fingerprint) where the fingerprint of each output 
+    is made of its input file and kwargs (see `fingerprint`)
+    """
+    names = sorted(os.path.basename(path) for path in glob('{0}/{1}*'.format(input_dir, corpus)))
+    logging.info('%d files matching %s', len(names), '{0}/{1}*'.format(input_dir, corpus))
+    todo = []
+    for name in names:
+        ipath, opath = '{0}/{1}'.format(input_dir, name), '{0}/{1}'.format(output_dir, name)
+        fp = fingerprint(inputs=[ipath], **kwargs)
+        if force or not is_fresh(namespace, opath, fp):
+            todo.append((name, ipath, opath, fp))
+    logging.info('%d stale files in %s', len(todo), output_dir)
+    return todo
+
+
+def wrap_dseqs((i, ipath, opaths), depths, cache=None, **kwargs):
     """
     Wrap a call to dseqs. To be used with Pool.map.
+    D-sequences of all depths are extracted with a single traversal of each tree (opaths[k] gets depth depths[k]),
+    optionally going through a persistent cache.
+    Outputs are written atomically (see `atomic_open`).
     """
     try:
         logging.info('(%d) %s ', i, ipath)
+        cache = DSeqCache(cache) if cache else None
         fi = smart_open(ipath, 'r')
-        fo = smart_open(opath, 'w')
-        for trees, attrs in iterdoctext(fi):
-            sequences = [' '.join(dseqs(tree, depth=depth, **kwargs)) for tree in trees]
-            writedoctext(fo, sequences, **attrs)
+        writers = [atomic_open(opath) for opath in opaths]
+        fos = [writer.__enter__() for writer in writers]
+        try:
+            for trees, attrs in iterdoctext(fi):
+                if cache is not None:
+                    sequences = [cached_dseqs(tree, depths, cache, **kwargs) for tree in trees]
+                else:
+                    sequences = [dseqs_at(tree, depths, **kwargs) for tree in trees]
+                for k, fo in enumerate(fos):
+                    writedoctext(fo, [' '.join(patterns[k]) for patterns in sequences], **attrs)
+        except:
+            # temporary files are discarded
+            exc_info = sys.exc_info()
+            for writer in writers:
+                writer.__exit__(*exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        for writer in writers:
+            writer.__exit__(None, None, None)
+        if cache is not None:
+            cache.close()
+        return i
     except:
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
 
-def extract_dseqs(corpus, args, namespace, **kwargs):
+def extract_dseqs(corpus, args, namespace, pool=None, **kwargs):
     """
     Extracts dsequences for a certain corpus
+    (as well as d-sequences of depths in args.extra_depths, see `wrap_dseqs`)
+    using a pool of workers (a new one unless `pool` is given)
     """
 
     logging.info('Extracting d-sequences for: %s', corpus)
     input_dir = namespace.trees
-    output_dir = namespace.dseqs
-
-    todo, done, missing = file_check(corpus, input_dir, output_dir)
-    if not missing:
-        logging.info('all d-sequences of depth %d are there, nothing to be done', args.depth)
+    depths = [args.depth] + [depth for depth in args.extra_depths if depth != args.depth]
+    output_dirs = [namespace.dseqs] + ['{0}/dseqs{1}'.format(args.workspace, depth) for depth in depths[1:]]
+
+    # a tree file is processed if any of its outputs (one per depth) is stale
+    stale = {}
+    for depth, output_dir in itertools.izip(depths, output_dirs):
+        if not args.dry_run and not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        for name, ipath, opath, fp in stale_files(corpus, input_dir, output_dir, namespace,
+                params=dict(depth=depth, **kwargs), code=['syntax_based/dseq.py']):
+            stale[name] = ipath
+    if not stale:
+        logging.info('all d-sequences of depth %s are up to date, nothing to be done', ', '.join(str(depth) for depth in depths))
         return 
     
-    jobs = [(j, '{0}/{1}'.format(input_dir, name), '{0}/{1}'.format(output_dir, name)) for j, name in enumerate(missing)]
-    pool = Pool(args.jobs)
+    jobs = [(j, stale[name], ['{0}/{1}'.format(output_dir, name) for output_dir in output_dirs]) 
+            for j, name in enumerate(sorted(stale))]
     logging.info('Distributing %d jobs to %d workers', len(jobs), args.jobs)
    
     if args.dry_run:
         return 
 
-    pool.map(partial(wrap_dseqs, depth=args.depth, **kwargs), jobs)
+    shared = pool is not None
+    if not shared:
+        pool = Pool(args.jobs)
+    # outputs are stamped as soon as their tree file is done
+    for j in pool.imap_unordered(partial(wrap_dseqs, depths=depths, cache=args.dseq_cache, **kwargs), jobs):
+        _, ipath, opaths = jobs[j]
+        for depth, opath in itertools.izip(depths, opaths):
+            stamp(namespace, opath, fingerprint(inputs=[ipath], params=dict(depth=depth, **kwargs), code=['syntax_based/dseq.py']))
+    if not shared:
+        pool.close()
+        pool.join()
 
 
-def train_alouis(args, namespace):
-    logging.info("Training A. Louis's model with: %s", args.training)
-    output_prefix = '{0}/counts'.format(namespace.alouis_model)
+def training_files(input_dir, args):
+    input_prefix = '{0}/{1}'.format(input_dir, args.training)
+    paths = sorted(glob(input_prefix + '*'))
+    logging.info('%d training files matching %s*', len(paths), input_prefix)
+    return paths
+
+
+def make_vocab(args, namespace):
+    """
+    Counts d-sequences in the training corpus once, the vocabulary (with counts) is shared by the syntax-based models.
+
+    Returns
+    -------
+    fingerprint of the vocabulary
+    """
+    paths = training_files(namespace.dseqs, args)
+    # models are trained with document boundary tokens (-b)
+    fp = fingerprint(inputs=paths, params=dict(boundary=True), code=['util.py'])
+    if not args.retrain and is_fresh(namespace, namespace.vocab, fp):
+        logging.info('Vocabulary is up to date: %s', namespace.vocab)
+        return fp
+
+    if args.dry_run:
+        return fp
+
+    logging.info('Counting d-sequences')
+    istream = itertools.chain(*map(smart_open, paths))
+    tokens, counts = build_vocab(iter_documents(istream, True))
+    logging.info('%d patterns (including <null> and <unk>): %s', len(tokens), namespace.vocab)
+    with atomic_path(namespace.vocab) as tmp:
+        save_vocab(tmp, tokens, counts)
+    stamp(namespace, namespace.vocab, fp)
+    return fp
+
+
+def plan_alouis(args, namespace, vocab_fp=''):
+    """
+    Returns
+    -------
+    fingerprint of the model and the options of discourse.syntax_based.alouis to train it with (None if it is up to date)
+    """
     unigram_path = namespace.dseq_unigrams
     bigram_path = namespace.dseq_bigrams
+    output_prefix = '{0}/counts'.format(namespace.alouis_model)
     
-    if not args.retrain and os.path.exists(unigram_path) and os.path.exists(bigram_path):
-        logging.info("A. Louis's model already exists: %s and %s", unigram_path, bigram_path)
-        return 
+    paths = training_files(namespace.dseqs, args)
+    fp = fingerprint(inputs=paths, 
+            params=dict(unk=args.unk, min_count=args.min_count, insertion=args.insertion, config=args.alouis_config), 
+            code=['syntax_based/alouis.py', 'syntax_based/packed.py', 'syntax_based/sparse.py', 'util.py'],
+            deps=[vocab_fp])
+    if not args.retrain and is_fresh(namespace, output_prefix, fp, [unigram_path, bigram_path]):
+        logging.info("A. Louis's model is up to date: %s and %s", unigram_path, bigram_path)
+        return fp, None
     
-    input_prefix = '{0}/{1}'.format(namespace.dseqs, args.training)
-    training_files = glob(input_prefix + '*')
-    logging.info('%d training files matching %s*', len(training_files), input_prefix)
-    istream = itertools.chain(*map(smart_open, training_files))
     opt_flags = []
     if args.unk:
         opt_flags.append('--unk')
+    if args.min_count:
+        opt_flags.append('--min-count {0}'.format(args.min_count))
     if args.insertion:
         opt_flags.append('--insertion')
-    cmd_line = 'python -m discourse.syntax_based.alouis -b --smoothing {0} {1} {2} {3}'.format(args.smoothing, args.alouis_config, ' '.join(opt_flags), output_prefix)
-    logging.info(cmd_line)
-    cmd_args = shlex.split(cmd_line)
+    cmd_line = '-b --vocab {0} --smoothing {1} {2} {3} {4}'.format(namespace.vocab, args.smoothing, args.alouis_config, ' '.join(opt_flags), output_prefix)
+    logging.info("A. Louis's model: %s", cmd_line)
+    return fp, alouis_argparser().parse_args(shlex.split(cmd_line))
 
-    if args.dry_run:
-        return
 
-    proc = sp.Popen(cmd_args, stdin=sp.PIPE)
-    proc.communicate(''.join(istream))
+def plan_ibm1(args, namespace, vocab_fp=''):
+    """
+    Returns
+    -------
+    fingerprint of the model and the options of discourse.syntax_based.ibm1 to train it with (None if it is up to date)
+    """
+    ll_path = '{0}/likelihood'.format(namespace.ibm1_model)
+    output_path = namespace.t1  #'{0}/t1'.format(namespace.ibm1_model)
 
+    paths = training_files(namespace.dseqs, args)
+    fp = fingerprint(inputs=paths, 
+            params=dict(m1=args.m1, unk=args.unk, min_count=args.min_count, config=args.m1_config), 
+            code=['syntax_based/ibm1.py', 'syntax_based/packed.py', 'syntax_based/sparse.py', 'util.py'],
+            deps=[vocab_fp])
+    # the model is stored both as text (t1) and in binary format (t1.vocab and t1.*.npy) which is faster to load
+    outputs = [output_path] + ['{0}.{1}'.format(output_path, suffix) for suffix in ['vocab', 'keys.npy', 'values.npy', 'shape.npy']]
+    if not args.retrain and is_fresh(namespace, output_path, fp, outputs):
+        logging.info('IBM model 1 is up to date: %s', output_path)
+        return fp, None
+    
+    unkflag = '--unk' if args.unk else ''
+    if args.min_count:
+        unkflag += ' --min-count {0}'.format(args.min_count)
+    # the model is written by the pipeline (see `_train_ibm1`), thus input and output are left to their defaults
+    cmd_line = '-m {0} -g 0 -b -p -j {1} {2} --ll {3} --vocab {5} --binary {6} {4}'.format(args.m1, args.jobs, args.m1_config, ll_path, unkflag, namespace.vocab, output_path)
+    logging.info('IBM model 1: %s', cmd_line)
+    return fp, ibm1_argparser().parse_args(shlex.split(cmd_line))
 
-def decode_alouis(corpus, args, namespace):
 
-    logging.info("Decoding with A. Louis's model: %s", corpus)
-    input_dir = namespace.dseqs
-    output_dir = namespace.alouis_probs
+def plan_grid(args, namespace):
+    """
+    Returns
+    -------
+    fingerprint of the model and the options of discourse.entity_based.grid to train it with (None if it is up to date)
+    """
+    unigram_path = namespace.role_unigrams
+    bigram_path = namespace.role_bigrams
+    output_prefix = '{0}/counts'.format(namespace.grid_model)
 
-    alljobs, done, missing = file_check(corpus, input_dir, output_dir)
+    paths = training_files(namespace.grids, args)
+    fp = fingerprint(inputs=paths, params=dict(salience=args.salience), code=['entity_based/grid.py', 'util.py'])
+    if not args.retrain and is_fresh(namespace, output_prefix, fp, [unigram_path, bigram_path]):
+        logging.info("Entity grid model is up to date: %s and %s", unigram_path, bigram_path)
+        return fp, None
+    
+    cmd_line = '- {0} --salience {1}'.format(output_prefix, args.salience)
+    logging.info('Entity grid model: %s', cmd_line)
+    return fp, grid_argparser().parse_args(shlex.split(cmd_line))
 
-    if args.retest:
-        missing = alljobs
 
-    if not missing:
-        logging.info('all alouis probabilities are there, nothing to be done')
-        return 
+def _train_ibm1(options, corpus, tokens):
+    # the text model shares its path with the prefix of the binary one
+    with atomic_open(options.binary) as ostream:
+        ibm1_train_model(options, corpus, tokens, ostream)
 
-    if args.dry_run:
-        return 
+
+def _train_alouis(options, corpus, tokens):
+    alouis_train_model(options, corpus, tokens)
+
+
+def _train_grid(options, paths):
+    unigrams, bigrams = grid_train(iter_grids(itertools.chain(*map(smart_open, paths)), r2i), len(r2i), options.salience)
+    grid_write_model(options.output, unigrams, bigrams)
+
+
+def train_models(args, namespace, vocab_fp=''):
+    """
+    Trains the requested models in-process (see `plan_ibm1`, `plan_alouis` and `plan_grid`).
+
+    The training d-sequences are read and encoded once and shared by IBM model 1 and A. Louis's model.
+    Models are independent, thus stale ones are trained concurrently: each in a process forked after encoding,
+    which inherits the encoded corpus (thus it is never pickled).
     
-    ipaths = ['{0}/{1}'.format(input_dir, name) for name in missing]
-    opaths = ['{0}/{1}'.format(output_dir, name) for name in missing]
-    alouis_decode_many(namespace.dseq_unigrams, namespace.dseq_bigrams, args.smoothing, ipaths, opaths, jobs=args.jobs)
+    Returns
+    -------
+    dict mapping a model (ibm1, alouis, grid) to its fingerprint
+    """
+    plans = {}
+    if args.ibm1:
+        plans['ibm1'] = plan_ibm1(args, namespace, vocab_fp)
+    if args.alouis:
+        plans['alouis'] = plan_alouis(args, namespace, vocab_fp)
+    if args.grid:
+        plans['grid'] = plan_grid(args, namespace)
+    fps = dict((model, fp) for model, (fp, options) in plans.iteritems())
+    todo = sorted((model, options) for model, (fp, options) in plans.iteritems() if options is not None)
+    if not todo or args.dry_run:
+        return fps
+
+    # syntax-based models share encoded corpora (options affecting the encoding normally agree)
+    corpora = {}
+    jobs = []
+    for model, options in todo:
+        if model == 'grid':
+            jobs.append((model, _train_grid, (options, training_files(namespace.grids, args))))
+            continue
+        key = (options.boundary, options.unk, options.min_count, options.vocab)
+        if key not in corpora:
+            logging.info('Encoding training d-sequences (boundary=%s unk=%s min-count=%d)', *key[:3])
+            corpora[key] = read_corpus(itertools.chain(*map(smart_open, training_files(namespace.dseqs, args))),
+                    options.boundary, options.unk, options.min_count, 
+                    load_vocab_counts(options.vocab) if options.vocab else None)
+        corpus, tokens = corpora[key]
+        jobs.append((model, _train_ibm1 if model == 'ibm1' else _train_alouis, (options, corpus, tokens)))
+
+    logging.info('Training %d models concurrently: %s', len(jobs), ', '.join(model for model, _, _ in jobs))
+    procs = [(model, Process(target=func, args=func_args)) for model, func, func_args in jobs]
+    for model, proc in procs:
+        proc.start()
+    failed = []
+    for model, proc in procs:
+        proc.join()
+        if proc.exitcode != 0:
+            failed.append(model)
+            continue
+        # a model is stamped only once it has been completely written
+        plan_fp, options = plans[model]
+        stamp(namespace, options.binary if model == 'ibm1' else options.output, plan_fp)
+        logging.info('Trained %s', model)
+    if failed:
+        raise Exception('Training failed: {0}'.format(', '.join(failed)))
+    return fps
+
+
+def decode_alouis(corpus, args, namespace, model_fp='', pool=None):
 
+    logging.info("Decoding with A. Louis's model: %s", corpus)
+    input_dir = namespace.dseqs
+    output_dir = namespace.alouis_probs
 
-def train_ibm1(args, namespace):
-    logging.info('Training IBM model 1 with: %s', args.training)
-    ll_path = '{0}/likelihood'.format(namespace.ibm1_model)
-    output_path = namespace.t1  #'{0}/t1'.format(namespace.ibm1_model)
-    if not args.retrain and os.path.exists(output_path):
-        logging.info('IBM model 1 already exists: %s', output_path)
+    stale = stale_files(corpus, input_dir, output_dir, namespace, force=args.retest,
+            params=dict(smoothing=args.smoothing), 
+            code=['syntax_based/alouis_decoder.py', 'syntax_based/sparse.py', 'util.py'],
+            deps=[model_fp])
+
+    if not stale:
+        logging.info('all alouis probabilities are up to date, nothing to be done')
         return 
-    
-    input_prefix = '{0}/{1}'.format(namespace.dseqs, args.training)
-    training_files = glob(input_prefix + '*')
-    logging.info('%d training files matching %s*', len(training_files), input_prefix)
-    istream = itertools.chain(*map(smart_open, training_files))
-    unkflag = '--unk' if args.unk else ''
-    cmd_line = 'python -m discourse.syntax_based.ibm1 -m {0} -g 0 -b -p {1} --ll {2} {3} - {4}'.format(args.m1, args.m1_config, ll_path, unkflag, output_path)
-    logging.info(cmd_line)
-    cmd_args = shlex.split(cmd_line)
 
     if args.dry_run:
-        return
-
-    proc = sp.Popen(cmd_args, stdin=sp.PIPE)
-    proc.communicate(''.join(istream))
+        return 
+    
+    names, ipaths, opaths, fps = zip(*stale)
+    alouis_decode_many(namespace.dseq_unigrams, namespace.dseq_bigrams, args.smoothing, ipaths, opaths, jobs=args.jobs, pool=pool)
+    for opath, fp in itertools.izip(opaths, fps):
+        stamp(namespace, opath, fp)
 
 
-def decode_ibm1(corpus, args, namespace):
+def decode_ibm1(corpus, args, namespace, model_fp='', pool=None):
     """
     Computes IBM 1 probabilities for a certain corpus.
     """
@@ -218,70 +491,47 @@ def decode_ibm1(corpus, args, namespace):
     input_dir = namespace.dseqs
     output_dir = namespace.ibm1_probs
 
-    alljobs, done, missing = file_check(corpus, input_dir, output_dir)
-    if args.retest:
-        missing = alljobs
+    stale = stale_files(corpus, input_dir, output_dir, namespace, force=args.retest,
+            code=['syntax_based/ibm1_decoder.py', 'syntax_based/sparse.py', 'util.py'],
+            deps=[model_fp])
 
-    if not missing:
-        logging.info('all IBM1 probabilities are there, nothing to be done')
+    if not stale:
+        logging.info('all IBM1 probabilities are up to date, nothing to be done')
         return 
 
     if args.dry_run:
         return 
     
-    ipaths = ['{0}/{1}'.format(input_dir, name) for name in missing]
-    opaths = ['{0}/{1}'.format(output_dir, name) for name in missing]
-    ibm1_decode_many(namespace.t1, ipaths, opaths, jobs=args.jobs)
-
-
-def train_grid(args, namespace):
-    logging.info('Training an entity grid model with: %s', args.training)
-    ll_path = '{0}/likelihood'.format(namespace.ibm1_model)
-    unigram_path = namespace.role_unigrams
-    bigram_path = namespace.role_bigrams
-    if not args.retrain and os.path.exists(unigram_path) and os.path.exists(bigram_path):
-        logging.info("Entity grid model already exists: %s and %s", unigram_path, bigram_path)
-        return 
-    
-    input_prefix = '{0}/{1}'.format(namespace.grids, args.training)
-    output_prefix = '{0}/counts'.format(namespace.grid_model)
-    training_files = glob(input_prefix + '*')
-    logging.info('%d training files matching %s*', len(training_files), input_prefix)
-    istream = itertools.chain(*map(smart_open, training_files))
-    cmd_line = 'python -m discourse.entity_based.grid - {0} --salience {1}'.format(output_prefix, args.salience)
-    logging.info(cmd_line)
-    cmd_args = shlex.split(cmd_line)
-
-    if args.dry_run:
-        return
-
-    proc = sp.Popen(cmd_args, stdin=sp.PIPE)
-    proc.communicate(''.join(istream))
+    names, ipaths, opaths, fps = zip(*stale)
+    ibm1_decode_many(namespace.t1, ipaths, opaths, jobs=args.jobs, binary=True, pool=pool)
+    for opath, fp in itertools.izip(opaths, fps):
+        stamp(namespace, opath, fp)
 
 
-def decode_grid(corpus, args, namespace):
+def decode_grid(corpus, args, namespace, model_fp='', pool=None):
     """
     Computes entity grids probabilities for a certain corpus.
     """
-    pass
     logging.info("Decoding with the Entity Grid model: %s", corpus)
     input_dir = namespace.grids
     output_dir = namespace.grid_probs
 
-    alljobs, done, missing = file_check(corpus, input_dir, output_dir)
-    if args.retest:
-        missing = alljobs
+    stale = stale_files(corpus, input_dir, output_dir, namespace, force=args.retest,
+            params=dict(salience=args.salience),
+            code=['entity_based/grid_decoder.py', 'entity_based/grid.py', 'util.py'],
+            deps=[model_fp])
 
-    if not missing:
-        logging.info('all entity grid probabilities are there, nothing to be done')
+    if not stale:
+        logging.info('all entity grid probabilities are up to date, nothing to be done')
         return 
 
     if args.dry_run:
         return 
     
-    ipaths = ['{0}/{1}'.format(input_dir, name) for name in missing]
-    opaths = ['{0}/{1}'.format(output_dir, name) for name in missing]
-    grid_decode_many(namespace.role_unigrams, namespace.role_bigrams, args.salience, ipaths, opaths, jobs=args.jobs)
+    names, ipaths, opaths, fps = zip(*stale)
+    grid_decode_many(namespace.role_unigrams, namespace.role_bigrams, args.salience, ipaths, opaths, jobs=args.jobs, pool=pool)
+    for opath, fp in itertools.izip(opaths, fps):
+        stamp(namespace, opath, fp)
 
 
 def evaluate(corpus, model, probs_dir, eval_dir, args, namespace):
@@ -295,6 +545,13 @@ def evaluate(corpus, model, probs_dir, eval_dir, args, namespace):
     if not names:
         logging.info('nothing to do')
         return 
+    rankings_path = '{0}/rankings'.format(output_dir)
+    fp = fingerprint(inputs=['{0}/{1}'.format(input_dir, name) for name in names],
+            params=dict(column=args.column, refsys=args.refsys),
+            code=['pipeline.py', 'util.py'])
+    if not args.retest and is_fresh(namespace, rankings_path, fp):
+        logging.info('rankings are up to date: %s', rankings_path)
+        return
     logging.info('Evaluating %d systems for %s', len(names), corpus)
 
     results = []
@@ -321,7 +578,7 @@ def evaluate(corpus, model, probs_dir, eval_dir, args, namespace):
             refsys = args.refsys
         else:
             logging.info('Unknown system %s cannot be used as reference', args.refsys)
-    with open('{0}/rankings'.format(output_dir), 'w') as fo:
+    with atomic_open(rankings_path) as fo:
         print >> fo, '#best-to-worst'
         # computes and stores rankings
         # and counts how many times each system ranked first
@@ -330,6 +587,35 @@ def evaluate(corpus, model, probs_dir, eval_dir, args, namespace):
             print >> fo, ' > '.join(' '.join(names[sysid] for sysid in group) for r, group in ranking)
             #ranking = sorted(enumerate(results[:,i]), key=lambda (_, score): score, reverse=True)
             #print >> fo, ' '.join(names[sysid] for sysid, score in ranking)
+    stamp(namespace, rankings_path, fp)
+
+
+def schedule(args, namespace, model_fps, pool):
+    """
+    Builds the graph of tasks which follow training: d-sequences of dev/test corpora, decoding and evaluation.
+    A decoder runs as soon as its test corpus is ready and it is evaluated as soon as it is done, 
+    all tasks share the same pool of workers (see `run_tasks`).
+    """
+    tasks = []
+    corpora = list(args.dev) + [corpus for corpus in args.test if corpus not in args.dev]
+    for corpus in corpora:
+        tasks.append(Task('dseqs:{0}'.format(corpus), 
+            partial(extract_dseqs, corpus, args, namespace, pool=pool, backoff=['*']), []))
+    models = [('ibm1', decode_ibm1, namespace.ibm1, namespace.ibm1_probs, namespace.ibm1_eval),
+            ('alouis', decode_alouis, namespace.alouis, namespace.alouis_probs, namespace.alouis_eval),
+            ('grid', decode_grid, namespace.grid, namespace.grid_probs, namespace.grid_eval)]
+    for corpus in args.test:
+        for model, decode, name, probs_dir, eval_dir in models:
+            if not getattr(args, model):
+                continue
+            decode_task = 'decode:{0}:{1}'.format(model, corpus)
+            tasks.append(Task(decode_task, 
+                partial(decode, corpus, args, namespace, model_fps[model], pool=pool), 
+                ['dseqs:{0}'.format(corpus)] if model != 'grid' else []))
+            tasks.append(Task('evaluate:{0}:{1}'.format(model, corpus), 
+                partial(evaluate, corpus, name, probs_dir, eval_dir, args, namespace), 
+                [decode_task]))
+    return tasks
 
 
 def main(args):
@@ -339,31 +625,24 @@ def main(args):
 
     # pipeline
     extract_dseqs(args.training, args, namespace, backoff='[*]')
-   
-    if args.dev:
-        extract_dseqs(args.dev, args, namespace, backoff=['*'])
-    if args.test:
-        extract_dseqs(args.test, args, namespace, backoff=['*'])
 
-    if args.ibm1:
-        train_ibm1(args, namespace)
-        
-        if args.test:
-            decode_ibm1(args.test, args, namespace)
-            evaluate(args.test, namespace.ibm1, namespace.ibm1_probs, namespace.ibm1_eval, args, namespace)
+    # every stage rebuilds only stale artifacts (see `fingerprint`), 
+    # fingerprints of models are passed downstream so that new models invalidate their probabilities
+    vocab_fp = make_vocab(args, namespace) if args.ibm1 or args.alouis else ''
+    # models are trained in-process and concurrently
+    model_fps = train_models(args, namespace, vocab_fp)
 
-    if args.alouis:
-        train_alouis(args, namespace)
-        if args.test:
-            decode_alouis(args.test, args, namespace)
-            evaluate(args.test, namespace.alouis, namespace.alouis_probs, namespace.alouis_eval, args, namespace)
-    
-    if args.grid:
-        train_grid(args, namespace)
-        if args.test:
-            pass
-            decode_grid(args.test, args, namespace)
-            evaluate(args.test, namespace.grid, namespace.grid_probs, namespace.grid_eval, args, namespace)
+    # the remaining stages run as a graph of tasks sharing a single pool of workers
+    pool = Pool(args.jobs)
+    try:
+        timings = run_tasks(schedule(args, namespace, model_fps, pool), args.concurrency)
+    finally:
+        pool.close()
+        pool.join()
+    report = tabulate([(name, '{0:.2f}'.format(start), '{0:.2f}'.format(duration)) for name, start, duration in timings], 
+            headers=['task', 'start', 'duration'], tablefmt='plain')
+    logging.info('Task timings (in seconds):\n%s', report)
+    print >> sys.stderr, report
 
 
 @command('pipeline', 'scripts')
@@ -384,14 +663,17 @@ def argparser(parser=None, func=main):
             type=str, default='potet.ref',
             help='training corpus')
     parser.add_argument('--dev', 
-            type=str, # default='newstest2013.de-en',
-            help='dev corpus')
+            type=str, nargs='+', default=[], # default='newstest2013.de-en',
+            help='dev corpora')
     parser.add_argument('--test', 
-            type=str, # default='newstest2014.de-en',
-            help='test corpus')
+            type=str, nargs='+', default=[], # default='newstest2014.de-en',
+            help='test corpora')
     parser.add_argument('--jobs', 
             type=int, default=10,
             help='jobs in parallel')
+    parser.add_argument('--concurrency', 
+            type=int, default=4,
+            help='maximum number of tasks (e.g. decoding a corpus with a model) running at once, all of them share the same --jobs workers')
     parser.add_argument('--dry-run', '-n',
             action='store_true',
             help='only stage operations')
@@ -406,10 +688,10 @@ def argparser(parser=None, func=main):
             help='increase the verbosity level')
     parser.add_argument('--retrain',
             action='store_true',
-            help='overwrites existing models')
+            help='overwrites existing models (even if they are up to date)')
     parser.add_argument('--retest',
             action='store_true',
-            help='overwrites existing results')
+            help='overwrites existing results (even if they are up to date)')
 
 
     # d-sequences
@@ -417,6 +699,12 @@ def argparser(parser=None, func=main):
     dseq_group.add_argument('--depth', 
             type=int, default=2,
             help='depth of d-sequences')
+    dseq_group.add_argument('--extra-depths', 
+            type=int, nargs='+', default=[],
+            help='also extracts d-sequences of these depths (in the same traversal of the trees), e.g. to prepare a sweep over depths')
+    dseq_group.add_argument('--dseq-cache', 
+            type=str,
+            help='path to a persistent cache of d-sequences (sqlite database shared across runs)')
 
     # IBM1
     ibm_group = parser.add_argument_group('IBM model 1')
@@ -449,6 +737,9 @@ def argparser(parser=None, func=main):
     ibm1_alouis_group.add_argument('--unk', '-u',
             action='store_true',
             help='replaces singletons by an unk token')
+    ibm1_alouis_group.add_argument('--min-count',
+            type=int, default=0,
+            help='replaces d-sequences occurring fewer times than this (in the training corpus) by an unk token')
     
     # Graph similarity
     graph_group = parser.add_argument_group("Graph similarity")
@@ -22,7 +22,10 @@ import multiprocessing
 import traceback
 import time
 import itertools
+import threading
+import Queue
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from functools import partial
 from ldc import get_ldc_name
 from discourse.doctext import iterdoctext, writedoctext
@@ -31,9 +34,9 @@ from discourse.util import tabulate
 from discourse import command
 
 
-def parse(content, args):
+def parser_command(args, threads=None):
     """
-    Parse a number of segments. 
+    Command line to the Stanford parser which parses sentences (one per line) from stdin.
     
     Arguments
     ---------
@@ -41,29 +44,117 @@ def parse(content, args):
     parser: path to jar
     models: path to jar
     grammar: path to gz
-    threads: how many threads are available to the parser
+    threads: how many threads are available to the parser (overrides args.threads if given)
     maxlength: segment maximum length (longer segments are skipped and the output is an empty parse tree: (())
-    empty_seg: the token that marks an empty segment
-
-    Returns
-    -------
-    list of parse trees (as strings)
     """
     params = {'mem': args.mem,
             'parser': args.parser,
             'models': args.models,
             'grammar': args.grammar,
-            'threads': args.threads,
+            'threads': args.threads if threads is None else threads,
             'maxlength': args.max_length,
             }
-    cmd_line = 'java -mx%(mem)dg -cp "%(parser)s:%(models)s" edu.stanford.nlp.parser.lexparser.LexicalizedParser -nthreads %(threads)d -sentences newline -maxLength %(maxlength)d -outputFormat oneline %(grammar)s -' % (params)
+    return 'java -mx%(mem)dg -cp "%(parser)s:%(models)s" edu.stanford.nlp.parser.lexparser.LexicalizedParser -nthreads %(threads)d -sentences newline -maxLength %(maxlength)d -outputFormat oneline %(grammar)s -' % (params)
+
+
+def empty_trees(content, trees, empty_seg):
+    """
+    Replaces trees of empty segments (marked with `empty_seg`) by empty trees.
+
+    >>> empty_trees(['a b', '<EMPTY>'], ['(ROOT (NP (DT a) (NN b)))', '(ROOT (NP (NN <EMPTY>)))'], '<EMPTY>')
+    ['(ROOT (NP (DT a) (NN b)))', '(())']
+    """
+    return [ptb if seg != empty_seg else '(())' for seg, ptb in itertools.izip(content, trees)]
+
+
+def parse(content, args):
+    """
+    Parse a number of segments (with a new instance of the parser, see `parser_command`). 
+    
+    Arguments
+    ---------
+    content: segments (strings)
+    args: a namespace, see `parser_command` (as well as empty_seg: the token that marks an empty segment)
+
+    Returns
+    -------
+    list of parse trees (as strings)
+    """
+    cmd_line = parser_command(args)
     cmd_args = shlex.split(cmd_line)
     logging.debug('running: %s', cmd_line)
     proc = subprocess.Popen(cmd_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     stdout, stderr = proc.communicate('\n'.join(content))
     # before returning we replace trees of empty segments (marked as so) by empty trees
     output = [line.strip() for line in stdout.split('\n')]
-    return [ptb if seg != args.empty_seg else '(())' for seg, ptb in itertools.izip(content, output)]
+    return empty_trees(content, output, args.empty_seg)
+
+
+class PersistentParser(object):
+    """
+    A long-lived instance of the Stanford parser (see `parser_command`) fed over pipes, 
+    so that JVM start-up and grammar loading are paid once rather than once per document.
+
+    Each batch of segments is framed by a sentinel segment (a single made-up token): 
+    the parser outputs one tree per segment, thus the batch is over when the sentinel's tree comes out.
+    Segments are written by a separate thread, so that the parser never blocks on a full pipe.
+
+    The parser runs a single thread: with more threads Stanford only prints finished trees once the next sentence
+    comes in, thus the sentinel's tree would never come out (instances run in parallel instead, see `persistent_main`).
+    """
+
+    def __init__(self, args, sentinel='PARSEDOCSENDOFBATCH'):
+        cmd_line = parser_command(args, threads=1)
+        logging.debug('starting: %s', cmd_line)
+        # the parser's messages (progress and errors) go straight to our stderr, as nobody reads a pipe while parsing
+        self.proc_ = subprocess.Popen(shlex.split(cmd_line), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.sentinel_ = sentinel
+        self.batches_ = 0
+
+    def _write(self, lines):
+        try:
+            for line in lines:
+                print >> self.proc_.stdin, line
+            self.proc_.stdin.flush()
+        except IOError:  # the parser died, which `parse` reports
+            pass
+
+    def parse(self, content, empty_seg):
+        """
+        Parse a batch of segments.
+
+        Arguments
+        ---------
+        content: segments (strings), newlines within a segment are replaced by spaces
+        empty_seg: the token that marks an empty segment
+
+        Returns
+        -------
+        list of parse trees (as strings)
+        """
+        self.batches_ += 1
+        sentinel = '{0}{1}X'.format(self.sentinel_, self.batches_)
+        lines = [' '.join(seg.split()) for seg in content]
+        writer = threading.Thread(target=self._write, args=(lines + [sentinel],))
+        writer.daemon = True
+        writer.start()
+        trees = []
+        while True:
+            line = self.proc_.stdout.readline()
+            if not line:
+                raise Exception('The parser exited (returncode=%s) in the middle of a batch, see its messages on stderr' % self.proc_.wait())
+            line = line.strip()
+            if sentinel in line:
+                break
+            trees.append(line)
+        writer.join()
+        if len(trees) != len(content):
+            raise Exception('Expected %d trees, got %d (segments and trees are out of sync)' % (len(content), len(trees)))
+        return empty_trees(content, trees, empty_seg)
+
+    def close(self):
+        self.proc_.stdin.close()
+        self.proc_.wait()
 
 
 def wrap_parse(doc, args):
@@ -91,9 +182,68 @@ def wrap_parse(doc, args):
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
 
 
+def parse_with(parsers, doc, empty_seg):
+    """
+    Parses a document with a parser taken from a queue of idle parsers (and returns the parser to the queue).
+
+    Arguments
+    ---------
+    parsers: a Queue of PersistentParser objects
+    doc: a tuple (segments, attributes), segments are strings
+    empty_seg: the token that marks an empty segment
+
+    Returns
+    -------
+    parse trees, the document's attributes and time to parse
+    """
+    try:
+        t0 = time.time()
+        content, attrs = doc
+        logging.info('Parsing document whose attributes are %s', attrs)
+        parser = parsers.get()
+        try:
+            trees = parser.parse(content, empty_seg)
+        finally:
+            parsers.put(parser)
+        return trees, attrs, time.time() - t0
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def persistent_main(args):
+    """
+    Streams documents through --jobs long-lived instances of the parser (see `PersistentParser`).
+    Documents are written out in input order as soon as they are parsed.
+    """
+    logging.info('Starting %d instances of the parser', args.jobs)
+    parsers = Queue.Queue()
+    for _ in xrange(args.jobs):
+        parsers.put(PersistentParser(args))
+
+    # the parsing happens in the parsers' processes, thus threads suffice to keep them busy
+    pool = ThreadPool(args.jobs)
+    times = []
+    try:
+        for trees, attrs, dt in pool.imap(partial(parse_with, parsers, empty_seg=args.empty_seg), 
+                iterdoctext(args.input)):
+            writedoctext(args.output, trees, **attrs)
+            times.append(dt)
+    finally:
+        pool.close()
+        pool.join()
+        while not parsers.empty():
+            parsers.get().close()
+
+    # dumps a summary
+    print >> sys.stderr, tabulate(enumerate(times), headers=['doc', 'time'], tablefmt='pipe')
+
+
 def main(args):
     logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
 
+    if args.persistent:
+        return persistent_main(args)
+
     # reads docs from input
     docs = list(iterdoctext(args.input))
 
@@ -133,10 +283,12 @@ def argparser(parser=None, func=main):
             help='maximum sentence length (necessary to prevent Stanford from crashing)')
     parser.add_argument('--jobs', '-j', type=int, default=4,
             help='number of jobs (documents in parallel)')
+    parser.add_argument('--persistent', action='store_true',
+            help='keep --jobs instances of the parser running and stream documents through them (rather than starting a parser per document)')
     parser.add_argument('--mem', type=int, default=10,
             help='memory (in G) for each instance of the stanford parser')
     parser.add_argument('--threads', type=int, default=4,
-            help='nuber of threads for each instance of the stanford parser')
+            help='nuber of threads for each instance of the stanford parser (with --persistent each instance runs a single thread)')
     parser.add_argument('--parser', type=str, 
             default='/home/waziz/tools/stanford/stanford-parser-full-2014-10-31/stanford-parser.jar',
             help='Path to Stanford parser (jar)')
@@ -8,9 +8,11 @@ import numpy as np
 import itertools
 import argparse
 import logging
+import traceback
 import modeleval
 import wmtgold
 from functools import partial
+from multiprocessing import Pool
 from tabulate import tabulate
 from scipy import stats
 from collections import namedtuple
@@ -20,6 +22,12 @@ from discourse import command
 
 RankerData = namedtuple('RankerData', 'alias systems rankings first intervals comparisons confidence')
 
+# a bootstrap test (see `bootstrap` and `parallel_bootstrap`) where kind is one of
+#   'intervals': data are per-document statistics (see `weighted_bootstrap_resampling`)
+#   'pairwise': data are per-document pairwise statistics (see `weighted_paired_bootstrap_resampling_pairwise`)
+#   'paired': data is a tensor R[m,d,s] assessed by metric (see `paired_bootstrap_resampling`)
+BootstrapTest = namedtuple('BootstrapTest', 'kind data metric')
+
 
 def read_rankings(istream, tiebreak=False):
     """
@@ -69,17 +77,50 @@ def read_rankings(istream, tiebreak=False):
     return R, sorted(system_set)
 
 
+def first_statistics(rankings):
+    """
+    Per-document statistics behind `assess_first`.
+
+    Arguments
+    ---------
+    ranking: numpy array such that ranking[d,s] is systems' s ranking wrt document d (or a batch ranking[b,d,s])
+
+    Returns
+    -------
+    first: numpy array such that first[d,s] is 1 if s is ranked first in document d and 0 otherwise
+    """
+    return (rankings == 1).astype(float)
+
+
+def comparison_statistics(rankings):
+    """
+    Per-document statistics behind `assess_comparisons`.
+
+    Arguments
+    ---------
+    ranking: numpy array such that ranking[d,s] is systems' s ranking wrt document d (or a batch ranking[b,d,s])
+
+    Returns
+    -------
+    comparisons: numpy array such that comparisons[d,s1,s2] is 1 if s1 ranks strictly higher than s2 in document d and 0 otherwise
+    """
+    return (rankings[..., :, np.newaxis] < rankings[..., np.newaxis, :]).astype(float)
+
+
 def assess_first(rankings):
     """
     Arguments
     ---------
     ranking: numpy array such that ranking[d,s] is systems' s ranking wrt document d
+        (or a batch of such arrays, i.e. ranking[b,d,s], see `bootstrap_resampling`)
     Returns
     -------
-    first: numpy array such that first[s] is the ratio at wich s is ranked first
+    first: numpy array such that first[s] is the ratio at wich s is ranked first (or first[b,s] for a batch)
+
+    >>> assess_first(np.array([[1, 2], [1, 1]]))
+    array([1. , 0.5])
     """
-    N, M = rankings.shape
-    return np.array([sum(r == 1 for r in rankings[:,s]) for s in xrange(M)], float)/N
+    return first_statistics(rankings).mean(-2)
 
 
 def assess_comparisons(rankings):
@@ -87,24 +128,19 @@ def assess_comparisons(rankings):
     Arguments
     ---------
     ranking: numpy array such that ranking[d,s] is systems' s ranking wrt document d
+        (or a batch of such arrays, i.e. ranking[b,d,s], see `bootstrap_resampling`)
     Returns
     -------
     comparisons: numpy array such that comparisons[s1,s2] is the rate at which s1 ranks strictly higher than s2
+        (or comparisons[b,s1,s2] for a batch)
+
+    >>> assess_comparisons(np.array([[1, 2, 3], [2, 1, 2]]))
+    array([[0. , 0.5, 0.5],
+           [0.5, 0. , 1. ],
+           [0. , 0. , 0. ]])
     """
-    N, M = rankings.shape
-    # comparisons[s1,s2]: how many times s1 ranks better than s2
-    comparisons = np.zeros((M,M))
-    # count
-    for d in xrange(N):
-        for s1, s2 in itertools.combinations(range(M), 2):
-            # we ignore ties
-            if rankings[d,s1] < rankings[d,s2]:
-                comparisons[s1,s2] += 1
-            elif rankings[d,s2] < rankings[d,s1]:
-                comparisons[s2,s1] += 1
-
-    # return normalised counts
-    return comparisons/N
+    # comparisons[s1,s2]: how often s1 ranks better than s2 (ties are ignored)
+    return comparison_statistics(rankings).mean(-3)
  
 
 def get_confidence_intervals(assessments, p_value=0.05):
@@ -115,56 +151,315 @@ def get_confidence_intervals(assessments, p_value=0.05):
     return assessments[(l, u),:].transpose()
 
 
-def bootstrap_resampling(R, rounds, metric):
+def resample(N, rounds, rng=np.random, batch_size=100):
+    """
+    Draws bootstrap samples in batches.
+
+    Arguments
+    ---------
+    N: number of documents
+    rounds: total number of samples
+    rng: a source of random numbers (np.random or a np.random.RandomState for reproducible results)
+    batch_size: number of samples per batch
+
+    Returns
+    -------
+    generator of matrices of shape (batch_size, N), each row is a sample (with replacement) of document ids
+    (rows come off the random stream exactly as they would with one `np.random.choice(N, N)` per round)
+
+    >>> [batch.shape for batch in resample(5, 7, np.random.RandomState(0), batch_size=3)]
+    [(3, 5), (3, 5), (1, 5)]
+    """
+    for start in xrange(0, rounds, batch_size):
+        yield rng.randint(0, N, size=(min(batch_size, rounds - start), N))
+
+
+def resample_counts(N, rounds, rng=np.random, batch_size=100):
+    """
+    Draws bootstrap samples in batches (as `resample` does) but represents each sample by how many times it contains each document.
+
+    Returns
+    -------
+    generator of matrices of shape (batch_size, N), counts[b,d] is the number of copies of document d in the b-th sample
+
+    >>> [counts.sum(1) for counts in resample_counts(5, 4, np.random.RandomState(0), batch_size=3)]
+    [array([5, 5, 5]), array([5])]
+    """
+    for batch in resample(N, rounds, rng, batch_size):
+        B = batch.shape[0]
+        # ids are offset by sample so that a single bincount counts all samples in the batch
+        yield np.bincount((batch + N * np.arange(B)[:,np.newaxis]).ravel(), minlength=B * N).reshape(B, N)
+
+
+def bootstrap_means(stats, rounds, rng=np.random, batch_size=100):
+    """
+    Bootstrap estimates of the mean of per-document statistics, such as those behind `assess_first` (see `first_statistics`)
+    and `assess_comparisons` (see `comparison_statistics`).
+    A sample is a vector of document counts, thus its mean is a weighted sum of the statistics 
+    and a batch of samples costs a single matrix product (regardless of how many documents are resampled).
+
+    Arguments
+    ---------
+    stats: numpy array such that stats[d,...] are the statistics of document d
+    rounds: number of samples
+    rng: a source of random numbers (see `resample`)
+    batch_size: number of samples per batch
+
+    Returns
+    -------
+    generator of arrays of shape (batch_size,) + stats.shape[1:]
+
+    >>> stats = first_statistics(np.array([[1, 2], [1, 1], [2, 1]]))
+    >>> means = np.concatenate(list(bootstrap_means(stats, 10, np.random.RandomState(0), batch_size=4)))
+    >>> np.all(means == assess_first(np.array([[1, 2], [1, 1], [2, 1]])[next(resample(3, 10, np.random.RandomState(0), 10))]))
+    True
+    """
+    N = stats.shape[0]
+    flat = stats.reshape(N, -1)
+    for counts in resample_counts(N, rounds, rng, batch_size):
+        yield (counts.dot(flat) / float(N)).reshape((counts.shape[0],) + stats.shape[1:])
+
+
+def count_wins(assessments):
+    """
+    Counts victories across a batch of assessments.
+
+    Arguments
+    ---------
+    assessments: either a (batch, M) array of assessments or a (batch, M, M) array of pairwise assessments
+
+    Returns
+    -------
+    wins[i,j] is the number of assessments in which i is strictly better than j
+    (or, for pairwise assessments, in which i compares strictly better to j than j compares to i)
+
+    >>> count_wins(np.array([[0.5, 0.2], [0.1, 0.2]]))
+    array([[0, 1],
+           [1, 0]])
+    """
+    if assessments.ndim == 2:
+        return (assessments[:,:,np.newaxis] > assessments[:,np.newaxis,:]).sum(0)
+    return (assessments > assessments.swapaxes(1, 2)).sum(0)
+
+
+def paired_batch_size(R, budget=10**7):
+    """number of resampled tensors (see `paired_bootstrap_resampling`) which fit in a budget of rankings"""
+    return max(1, budget // R.size)
+
+
+def bootstrap_resampling(R, rounds, metric, rng=np.random, batch_size=100):
     """
     Computes confidence intervals by bootstrap resampling
+
+    Arguments
+    ---------
+    R such that R[d,s] is the ranking of system s for document d
+    rounds: number of samples
+    metric: assesses a batch of samples at once, i.e. maps an array (batch, N, S) to an array (batch, S), see `assess_first`
+    rng: a source of random numbers (see `resample`)
+    batch_size: number of samples assessed at once
+
+    Returns
+    -------
+    sorted assessments (rounds, S)
     """
     N, M = R.shape
-    assessments = []
-    for i in xrange(rounds):
-        batch = np.random.choice(N, size=N, replace=True)
-        assessments.append(metric(R[batch,:]))
+    assessments = np.concatenate([metric(R[batch]) for batch in resample(N, rounds, rng, batch_size)])
     return np.sort(assessments, 0)
 
 
-def paired_bootstrap_resampling(R, rounds, metric):
+def paired_bootstrap_resampling(R, rounds, metric, rng=np.random, batch_size=100):
     """
     Arguments
     ---------
     R such that T[m,d,s] is the ranking model m assigns to system s for document d 
+    rounds: number of samples
+    metric: assesses a batch of samples at once, i.e. maps an array (batch, M, D, S) to an array (batch, M) (see `modeleval`)
+    rng: a source of random numbers (see `resample`)
+    batch_size: number of samples assessed at once
+
+    Returns
+    -------
+    wins[m1,m2] is the rate at which m1 is strictly better than m2
     """
     M, D, S = R.shape
     wins = np.zeros((M, M))
-    for i in xrange(rounds):
-        batch = np.random.choice(D, size=D, replace=True)
-        assessments = metric(R[:,batch,:])
-        # count victories
-        for m1, m2 in itertools.combinations(range(M), 2):
-            if assessments[m1] > assessments[m2]:
-                wins[m1,m2] += 1
-            elif assessments[m2] > assessments[m1]:
-                wins[m2,m1] += 1
+    for batch in resample(D, rounds, rng, batch_size):
+        # samples are stacked on a leading axis: (batch, M, D, S)
+        assessments = metric(R[:,batch,:].swapaxes(0, 1))
+        wins += count_wins(assessments)
     return wins/rounds
 
 
-def paired_bootstrap_resampling_pairwise(R, rounds, pairwise_metric):
+def paired_bootstrap_resampling_pairwise(R, rounds, pairwise_metric, rng=np.random, batch_size=100):
     """
     Paired bootstrap resampling using a pairwise metric
+
+    Arguments
+    ---------
+    R such that R[d,s] is the ranking of system s for document d
+    rounds: number of samples
+    pairwise_metric: assesses a batch of samples at once, i.e. maps an array (batch, N, S) to an array (batch, S, S), 
+        see `assess_comparisons`
+    rng: a source of random numbers (see `resample`)
+    batch_size: number of samples assessed at once
+
+    Returns
+    -------
+    wins[s1,s2] is the rate at which s1 compares strictly better to s2 than s2 compares to s1
     """
     N, M = R.shape
     wins = np.zeros((M, M))
-    for i in xrange(rounds):
-        batch = np.random.choice(N, size=N, replace=True)
-        assessments = pairwise_metric(R[batch,:])
-        # count victories
-        for s1, s2 in itertools.combinations(range(M), 2):
-            if assessments[s1,s2] > assessments[s2,s1]:
-                wins[s1,s2] += 1
-            elif assessments[s2,s1] > assessments[s1,s2]:
-                wins[s2,s1] += 1
+    for batch in resample(N, rounds, rng, batch_size):
+        assessments = pairwise_metric(R[batch])
+        wins += count_wins(assessments)
+    return wins/rounds
+
+
+def weighted_bootstrap_resampling(stats, rounds, rng=np.random, batch_size=100):
+    """
+    Computes confidence intervals by bootstrap resampling (as `bootstrap_resampling`) 
+    for metrics which average per-document statistics (see `bootstrap_means`)
+
+    Returns
+    -------
+    sorted assessments (rounds, S)
+    """
+    return np.sort(np.concatenate(list(bootstrap_means(stats, rounds, rng, batch_size))), 0)
+
+
+def weighted_paired_bootstrap_resampling_pairwise(stats, rounds, rng=np.random, batch_size=100):
+    """
+    Paired bootstrap resampling (as `paired_bootstrap_resampling_pairwise`) 
+    for pairwise metrics which average per-document statistics (see `bootstrap_means`)
+
+    Returns
+    -------
+    wins[s1,s2] is the rate at which s1 compares strictly better to s2 than s2 compares to s1
+    """
+    wins = np.zeros(stats.shape[1:])
+    for assessments in bootstrap_means(stats, rounds, rng, batch_size):
+        wins += count_wins(assessments)
     return wins/rounds
 
 
+def bootstrap_block(test, rounds, seed, batch_size=100):
+    """
+    Runs a number of rounds of a bootstrap test (see `BootstrapTest`) using a random stream of its own.
+
+    Returns
+    -------
+    'intervals': unsorted assessments (rounds, S)
+    'pairwise' and 'paired': counts of victories (not normalised)
+    """
+    rng = np.random.RandomState(seed)
+    if test.kind == 'intervals':
+        return np.concatenate(list(bootstrap_means(test.data, rounds, rng, batch_size)))
+    elif test.kind == 'pairwise':
+        return sum(count_wins(assessments) for assessments in bootstrap_means(test.data, rounds, rng, batch_size))
+    elif test.kind == 'paired':
+        D = test.data.shape[1]
+        return sum(count_wins(test.metric(test.data[:,batch,:].swapaxes(0, 1))) 
+                for batch in resample(D, rounds, rng, min(batch_size, paired_batch_size(test.data))))
+    raise ValueError('Unknown kind of bootstrap test: %s' % test.kind)
+
+
+# tests are shared with worker processes (inherited when the pool forks, thus never pickled)
+_SHARED_ = {}
+
+
+def _init_worker(tests):
+    _SHARED_.update(tests=tests)
+
+
+def wrapped_bootstrap_block((t, rounds, seed)):
+    try:
+        return bootstrap_block(_SHARED_['tests'][t], rounds, seed)
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def parallel_bootstrap(tests, rounds, rng, jobs, block_size=100):
+    """
+    Runs bootstrap tests in parallel. 
+    The rounds of each test are split in blocks of a fixed size and each block draws samples from a random stream of its own,
+    seeded by `rng`. Blocks are merged in order, thus results only depend on the state of `rng` (not on the number of workers).
+
+    Arguments
+    ---------
+    tests: a sequence of BootstrapTest
+    rounds: number of samples per test
+    rng: a np.random.RandomState from which blocks are seeded
+    jobs: number of worker processes (1 runs all blocks in the calling process)
+    block_size: number of rounds per block
+
+    Returns
+    -------
+    one result per test: sorted assessments (rounds, S) for 'intervals' and win rates for 'pairwise' and 'paired'
+
+    >>> test = BootstrapTest('intervals', first_statistics(np.array([[1, 2], [1, 1], [2, 1]])), None)
+    >>> a = parallel_bootstrap([test], 250, np.random.RandomState(0), 1, block_size=100)[0]
+    >>> b = parallel_bootstrap([test], 250, np.random.RandomState(0), 2, block_size=100)[0]
+    >>> a.shape, np.array_equal(a, b)
+    ((250, 2), True)
+    """
+    tasks = []
+    for t in xrange(len(tests)):
+        n_blocks = (rounds + block_size - 1) // block_size
+        seeds = rng.randint(np.iinfo(np.int32).max, size=n_blocks)
+        tasks.extend((t, min(block_size, rounds - b * block_size), seed) for b, seed in enumerate(seeds))
+    if jobs > 1:
+        pool = Pool(jobs, _init_worker, (tests,))
+        try:
+            blocks = pool.map(wrapped_bootstrap_block, tasks)
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+    else:
+        blocks = [bootstrap_block(tests[t], n, seed) for t, n, seed in tasks]
+
+    # merge blocks (in order) 
+    results = []
+    for t, test in enumerate(tests):
+        mine = [block for (i, _, _), block in itertools.izip(tasks, blocks) if i == t]
+        if test.kind == 'intervals':
+            results.append(np.sort(np.concatenate(mine), 0))
+        else:
+            results.append(sum(mine) / float(rounds))
+    return results
+
+
+def bootstrap(tests, rounds, rng=np.random, jobs=0):
+    """
+    Runs bootstrap tests (see `BootstrapTest`).
+    If jobs > 0, all tests share the same pool of workers (see `parallel_bootstrap`),
+    otherwise they run one after another drawing samples directly from `rng`.
+
+    Returns
+    -------
+    one result per test (see `parallel_bootstrap`)
+    """
+    if jobs > 0:
+        return parallel_bootstrap(tests, rounds, rng, jobs)
+    results = []
+    for test in tests:
+        if test.kind == 'intervals':
+            results.append(weighted_bootstrap_resampling(test.data, rounds, rng=rng))
+        elif test.kind == 'pairwise':
+            results.append(weighted_paired_bootstrap_resampling_pairwise(test.data, rounds, rng=rng))
+        elif test.kind == 'paired':
+            # samples are assessed in batches of resampled tensors (see `paired_batch_size`)
+            results.append(paired_bootstrap_resampling(test.data, rounds, metric=test.metric, rng=rng, 
+                batch_size=paired_batch_size(test.data)))
+        else:
+            raise ValueError('Unknown kind of bootstrap test: %s' % test.kind)
+    return results
+
+
 def get_refsysid(systems, suffix='ref'):
     refs = [i for i, sysname in enumerate(systems) if sysname.endswith(suffix)]
     if len(refs) > 1:
@@ -174,18 +469,25 @@ def get_refsysid(systems, suffix='ref'):
     return refs[0]
 
 
-def test_ranker(ranker, rankings, systems, rounds=1000, p_value=0.95):
+def ranker_tests(rankings):
     """
-    Compares diferent systems as ranked by a given model.
+    Bootstrap tests which compare systems as ranked by a given model (see `test_ranker`):
+    per-document statistics are computed once, bootstrap samples only reweight them.
     """
+    return [BootstrapTest('intervals', first_statistics(rankings), None),
+            BootstrapTest('pairwise', comparison_statistics(rankings), None)]
+
+
+def ranker_data(ranker, rankings, systems, tests, results, p_value=0.95):
+    """Summarises the outcome of `ranker_tests` (see `bootstrap`)"""
+    (f_test, c_test), (f_assessments, confidence) = tests, results
+
     # 1) FIRST
-    first = assess_first(rankings)
-    f_assessments = bootstrap_resampling(rankings, rounds, metric=assess_first)
+    first = f_test.data.mean(0)
     intervals = get_confidence_intervals(f_assessments, p_value)
 
     # 2) COMPARISONS
-    comparisons = assess_comparisons(rankings)
-    confidence = paired_bootstrap_resampling_pairwise(rankings, rounds, pairwise_metric=assess_comparisons)
+    comparisons = c_test.data.mean(0)
     
     return RankerData(alias=ranker, 
             rankings=rankings, 
@@ -196,17 +498,37 @@ def test_ranker(ranker, rankings, systems, rounds=1000, p_value=0.95):
             confidence=confidence)
 
 
-def test_all_rankers(rankers, rounds, p_value):
-    # test each ranker
-    rankers_data = []
+def test_ranker(ranker, rankings, systems, rounds=1000, p_value=0.95, rng=np.random, jobs=0):
+    """
+    Compares diferent systems as ranked by a given model.
+    If jobs > 0, bootstrap resampling runs in parallel with a random stream per block of rounds (see `parallel_bootstrap`).
+    """
+    tests = ranker_tests(rankings)
+    return ranker_data(ranker, rankings, systems, tests, bootstrap(tests, rounds, rng, jobs), p_value)
+
+
+def test_all_rankers(rankers, rounds, p_value, rng=np.random, jobs=0):
+    """
+    Tests each ranker (see `test_ranker`).
+    The tests of all rankers go through a single call to `bootstrap` (thus a single pool of workers if jobs > 0).
+    """
+    inputs = []
+    tests = []
     for ranker, path in rankers:
         logging.info('Comparing systems using %s: %s', ranker, path)
         rankings, systems = read_rankings(open(path))
-        rankers_data.append(test_ranker(ranker, rankings, systems, rounds, p_value))
-    return rankers_data
+        inputs.append((ranker, rankings, systems))
+        tests.extend(ranker_tests(rankings))
+    results = bootstrap(tests, rounds, rng, jobs)
+    return [ranker_data(ranker, rankings, systems, tests[2*i:2*i+2], results[2*i:2*i+2], p_value) 
+            for i, (ranker, rankings, systems) in enumerate(inputs)]
 
 
-def modelcmp(rankers, args, alias, header, metric, scale=100):
+def modelcmp(rankers, args, alias, header, metric, confidence, scale=100):
+    """
+    Writes the assessment of each model under a metric and the confidence (in %) with which a model beats another 
+    (the outcome of a 'paired' `BootstrapTest` of the metric).
+    """
     systems = rankers[0].systems
     refsysid = rankers[0].systems.index(args.refsys)
     rankers_names = [ranker.alias for ranker in rankers]
@@ -224,8 +546,6 @@ def modelcmp(rankers, args, alias, header, metric, scale=100):
                     headers=['model', header],
                     tablefmt=fmt,
                     floatfmt=".2f")
-    logging.info('Confidence: %s', alias)
-    confidence = paired_bootstrap_resampling(R, args.rounds, metric=metric) * 100
     for fmt in args.tablefmt:
         with open('{0}.modelcmp-{1}-confidence.{2}.{3}'.format(args.output, alias, cmp_id, fmt), 'w') as fo:
             print >> fo, tabulate(np.column_stack((rankers_names, confidence)),
@@ -247,7 +567,11 @@ def main(args):
             format='%(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
 
 
-    rankers = test_all_rankers(args.ranker, args.rounds, args.pvalue)
+    # all resampling goes through the same random stream (seeded for reproducibility)
+    # in parallel mode this stream seeds blocks of rounds (see `parallel_bootstrap`)
+    rng = np.random.RandomState(args.seed) if args.seed is not None else np.random
+
+    rankers = test_all_rankers(args.ranker, args.rounds, args.pvalue, rng, args.jobs)
 
     for r, ranker in enumerate(rankers):
         # clean up system names
@@ -323,13 +647,17 @@ def main(args):
             #A = modelcmp(rankers, args, infix, infix, metric=metricfunc)
             
 
-        A1 = modelcmp(rankers, args, 'refgt', 'refgt', metric=partial(modeleval.ranks_higher, sysid=refsysid, strictly=True))
-        A2 = modelcmp(rankers, args, 'refge', 'refge', metric=partial(modeleval.ranks_higher, sysid=refsysid, strictly=False))
-        A3 = modelcmp(rankers, args, 'firstx', 'firstx', metric=partial(modeleval.top1, sysid=refsysid, exclusive=True))
-        A4 = modelcmp(rankers, args, 'first', 'first', metric=partial(modeleval.top1, sysid=refsysid, exclusive=False))
-        A5 = modelcmp(rankers, args, 'EW', 'EW', metric=partial(modeleval.expected_win, sysid=refsysid))
-        H = ['refgt', 'refge', 'firstx', 'first', 'EW']
-        ALL = [rankers_names, A1, A2, A3, A4, A5]
+        metrics = [('refgt', partial(modeleval.ranks_higher, sysid=refsysid, strictly=True)),
+                ('refge', partial(modeleval.ranks_higher, sysid=refsysid, strictly=False)),
+                ('firstx', partial(modeleval.top1, sysid=refsysid, exclusive=True)),
+                ('first', partial(modeleval.top1, sysid=refsysid, exclusive=False)),
+                ('EW', partial(modeleval.expected_win, sysid=refsysid))]
+        # the confidence tests of all metrics go through a single call to `bootstrap` (thus a single pool of workers)
+        logging.info('Confidence: %s', ' '.join(alias for alias, _ in metrics))
+        confidence = bootstrap([BootstrapTest('paired', R, metric) for _, metric in metrics], args.rounds, rng, args.jobs)
+        H = [alias for alias, _ in metrics]
+        ALL = [rankers_names] + [modelcmp(rankers, args, alias, alias, metric, C * 100) 
+                for (alias, metric), C in itertools.izip(metrics, confidence)]
         #if args.pair in wmtgold.WMT14_RANKINGS:
         #    gold=np.array([wmtgold.WMT14_RANKINGS[args.pair][sysname] for sysname in system_names], float)
         #    A6 = modelcmp(rankers, args, 'gold', 'gold', scale=1.0, metric=partial(modeleval.rho, sysid=refsysid, gold_rankings=gold))
@@ -400,6 +728,14 @@ def argparser(parser=None, func=main):
     parser.add_argument('--rounds', 
             type=int, default=1000,
             help='number of rounds in bootstrap resampling')
+    parser.add_argument('--seed', 
+            type=int,
+            help='seed for the random number generator used in bootstrap resampling (for reproducible results)')
+    parser.add_argument('--jobs', '-j',
+            type=int, default=0,
+            help='run bootstrap resampling in parallel with this many processes, '
+            'results are reproducible (given --seed) regardless of the number of processes '
+            '(by default, rounds run sequentially on a single random stream)')
     parser.add_argument('--pvalue', '-p',
             type=float, default=0.05,
             help='p-value')
@@ -23,50 +23,127 @@ A much better way around is not to assume the data is complete and use EM (basic
 @author: wilkeraziz
 """
 
-import itertools
 import math
 import sys
 import logging
-from collections import defaultdict
-from scipy.optimize import minimize_scalar
+from collections import defaultdict, namedtuple
+from scipy.optimize import minimize as scipy_minimize
 import argparse
 import numpy as np
-from discourse.util import bar, pairwise, ibm_pairwise, read_documents, encode_documents, find_least_common
+from discourse.util import bar, chunks, flatten_pairs, load_vocab_counts
+from discourse.syntax_based.sparse import SparseTable
+from discourse.syntax_based.packed import PackedCorpus, read_corpus, read_packed
 from discourse import command
 
-def count(T, V, insertion=False, null=0):
+def count(T, V, insertion=False, null=0, chunk_size=1000):
     """
     Count unigram and bigram patterns in training data
 
+    Documents are counted in chunks: the pairs (u, v) in the cartesian product of adjacent sentences
+    are flattened (see `flatten_pairs`) and accumulated into a sparse table of bigram counts.
+    The training data can be a generator, only one chunk is held in memory at a time.
+
     Arguments
     ---------
-    T: training data encoded as numpy arrays of ids
+    T: training data encoded as numpy arrays of ids (or a PackedCorpus)
     V: size of the vocabulary (which might include a null symbol)
     insertion: whether or not insertion is considered (in which case the null symbol takes id 0 in the vocabulary)
+    chunk_size: number of documents counted at once
 
     Returns
     -------
     unigram counts: a numpy array of size V
-    bigram counts: a V by V numpy array
+    bigram counts: a V by V SparseTable
+
+    >>> doc = [np.array([1]), np.array([2, 2])]
+    >>> U, B = count([doc, doc], 3, insertion=True)
+    >>> U
+    array([2., 2., 4.])
+    >>> B.rows, B.cols, B.values
+    (array([0, 1]), array([2, 2]), array([4., 4.]))
     """
     # counts
     U = np.zeros(V)
-    B = np.zeros((V, V))
-
-    getpairs = ibm_pairwise if insertion else pairwise
+    keys = np.zeros(0, np.int64)
+    values = np.zeros(0)
 
     # counting
-    for D in bar(T, msg='Counting patterns'):
+    packed = isinstance(T, PackedCorpus)
+    for documents in (T.chunks(chunk_size) if packed else chunks(bar(T, msg='Counting patterns'), chunk_size)):
+        if packed:  # sentences and patterns are read off the packed arrays
+            tokens, _, offsets = documents.arrays()
+            lengths = np.diff(offsets)
+            patterns = [tokens]
+        else:
+            lengths = np.array([len(D) for D in documents], int)
+            patterns = [Sa for D in documents for Sa in D]
         if insertion:  # if we have null tokens we count one occurrence for each sentence in the document (that can head a pair of sentences)
-            U[null] += len(D) - 1
-        for Sa in D:
-            for u in Sa:
-                U[u] += 1
-        for Sa, Sb in getpairs(D):
-            for u, v in itertools.product(Sa, Sb):
-                B[u,v] += 1
+            U[null] += (lengths - 1).sum()
+        if patterns:
+            U += np.bincount(np.concatenate(patterns).astype(int), minlength=V)
+        # if insertion=True, the null symbol heads the first sentence of each pair
+        pairs = flatten_pairs(documents, insertion, e0=null)
+        # merge this chunk's bigrams with the ones counted so far
+        keys, inverse = np.unique(np.concatenate([keys, pairs.e.astype(np.int64) * V + pairs.f]), return_inverse=True)
+        values = np.bincount(inverse, weights=np.concatenate([values, np.ones(pairs.e.size)]), minlength=keys.size)
+
+    return U, SparseTable(keys, values, (V, V))
+
+
+SufficientStatistics = namedtuple('SufficientStatistics', 'bigrams unigrams segment n_segments constant V')
+
 
-    return U, B
+def sufficient_statistics(T, U, B, insertion=False):
+    """
+    Gathers (once) the quantities the likelihood depends on, so that it can be evaluated for any c without revisiting the data.
+
+    Arguments
+    ---------
+    T: training data encoded by `encode_documents`
+    U: unigram counts as produced by `count`
+    B: bigram counts as produced by `count`
+    insertion: whether or not insertion is considered
+
+    Returns
+    -------
+    SufficientStatistics where
+        bigrams[l] = count(u, v) and unigrams[l] = count(u) for the l-th link (u, v) between a trigger u in a sentence 
+            and a pattern v in the next sentence (see `flatten_pairs`)
+        segment[l] is the segment (pattern v in a sentence pair) the l-th link belongs to
+        n_segments is the total number of segments
+        constant = \sum_segments log(1/|Sa|) where Sa is the first sentence in the pair
+        V is the size of the vocabulary
+    """
+    pairs = flatten_pairs(T, insertion)
+    lengths = np.bincount(pairs.segment, minlength=pairs.n_segments)
+    return SufficientStatistics(bigrams=np.asarray(B.lookup(pairs.e, pairs.f), float),
+            unigrams=np.asarray(U[pairs.e], float),
+            segment=pairs.segment,
+            n_segments=pairs.n_segments,
+            constant=-np.log(lengths).sum(),
+            V=len(U))
+
+
+def loglikelihood_and_derivative(stats, c):
+    """
+    Computes the log likelihood of the data and its derivative with respect to c in closed form
+
+        L(c) = \sum_segments log(1/|Sa|) + log(Z) where Z = \sum_{u in Sa} (count(u,v) + c)/(count(u) + c|V|)
+        dL/dc = \sum_segments Z'/Z where Z' = \sum_{u in Sa} (count(u) - |V| count(u,v))/(count(u) + c|V|)^2
+
+    Arguments
+    ---------
+    stats: as produced by `sufficient_statistics`
+    c: smoothing constant (in absolute discounting smoothing)
+
+    Returns
+    -------
+    log likelihood and its derivative
+    """
+    denominator = stats.unigrams + c * stats.V
+    Z = np.bincount(stats.segment, weights=(stats.bigrams + c) / denominator, minlength=stats.n_segments)
+    dZ = np.bincount(stats.segment, weights=(stats.unigrams - stats.V * stats.bigrams) / denominator ** 2, minlength=stats.n_segments)
+    return stats.constant + np.log(Z).sum(), (dZ / Z).sum()
 
 
 def loglikelihood(T, U, B, c=0, insertion=False):
@@ -82,31 +159,22 @@ def loglikelihood(T, U, B, c=0, insertion=False):
     insertion: whether or not insertion is considered
 
     """
-    ll = 0.0
-    
-    getpairs = ibm_pairwise if insertion else pairwise
-
-    for D in bar(T, maxval=len(T), msg='log likelihood'):
-        # for each sentence pair
-        for Sa, Sb in getpairs(D):  # if insertion=True, then getpairs=ibm_pairwise, consequently, Sa[0] is the null word
-            # for each pattern in the second sentence of the pair
-            for v in Sb:
-                # sum up the contributions of the pattern v conditioned on each pattern u in the first sentence of the pair
-                ll += np.log(1.0/len(Sa)) + np.log(np.sum([float(B[u,v] + c)/(U[u] + c * len(U)) for u in Sa]))
-
-    return ll
+    return loglikelihood_and_derivative(sufficient_statistics(T, U, B, insertion), c)[0]
 
 
 def minimize(T, U, B, insertion):
     """optimise the likelihood of T"""
+
+    # the data is visited only once, each evaluation of f only deals with the sufficient statistics
+    stats = sufficient_statistics(T, U, B, insertion)
     
-    def f(c, T, U, B, insertion):
-        logging.info('Computing minus log likelihood with c=%f', c)
-        ll = loglikelihood(T, U, B, c, insertion)
+    def f(c):
+        logging.info('Computing minus log likelihood with c=%f', c[0])
+        ll, dll = loglikelihood_and_derivative(stats, c[0])
         logging.info('average likelihood: %f', -ll/len(T))
-        return -ll/len(T)
+        return -ll/len(T), np.array([-dll/len(T)])
 
-    return minimize_scalar(f, bounds=(0.0, 1.0), args=(T, U, B, insertion), method='bounded')
+    return scipy_minimize(f, [0.5], jac=True, bounds=[(0.0, 1.0)], method='L-BFGS-B')
 
 
 def main(args):
@@ -115,22 +183,25 @@ def main(args):
             level=(logging.DEBUG if args.verbose else logging.INFO), 
             format='%(levelname)s %(message)s')
 
-    # read in documents
-    logging.info('Reading documents in ...')
-    documents = read_documents(sys.stdin, args.boundary)
-    logging.info('%d documents, on average %.2f sentences per document', len(documents), np.mean([len(D)for D in documents]))
-    
-    least_common, min_count = find_least_common(documents) if args.unk else (frozenset(), 0)
-    if args.unk:
-        logging.info('Least common patterns: frequency=%d patterns=%d', min_count, len(least_common))
-   
-    # decide whether or not there will be a null symbol
-    # encode documents using numpy array of ids
-    T, vocab = encode_documents(documents, ignore=least_common)
-   
+    # read in documents and encode them using numpy array of ids
+    if args.packed:
+        T, tokens = read_packed(args.packed, args.boundary, args.unk, args.min_count)
+    else:
+        T, tokens = read_corpus(sys.stdin, args.boundary, args.unk, args.min_count,
+                load_vocab_counts(args.vocab) if args.vocab else None)
+    lengths = np.diff(T.documents) if args.packed else [len(D) for D in T]
+    logging.info('%d documents, on average %.2f sentences per document', len(T), np.mean(lengths))
+    train_model(args, T, tokens)
+
+
+def train_model(args, T, tokens):
+    """
+    Counts unigrams and bigrams in an encoded corpus and stores them (args.output.unigrams and args.output.bigrams).
+    This is shared by the command line interface and the pipeline (which trains models in-process).
+    """
     # gather unigram and bigram counts
     logging.info('Counting ...')    
-    U, B = count(T, len(vocab), insertion=args.insertion)
+    U, B = count(T, len(tokens), insertion=args.insertion)
     logging.info('%d unigrams, %d bigrams', U.size, B.size)
 
     # compute log likelihood
@@ -139,8 +210,6 @@ def main(args):
     logging.info('Negative log likelihood %f with c=%f and insertion=%s', -ll, args.smoothing, args.insertion)
     
     # dumps U and B in a nice format
-    tokens = [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)]
-    V = len(tokens)
     logging.info('Writing unigrams to: %s', '{0}.unigrams'.format(args.output))
     with open('{0}.unigrams'.format(args.output), 'w') as fu:
         print >> fu, '#pattern\t#count'
@@ -149,10 +218,10 @@ def main(args):
     logging.info('Writing bigrams to: %s', '{0}.bigrams'.format(args.output))
     with open('{0}.bigrams'.format(args.output), 'w') as fb:
         print >> fb, '#trigger\t#pattern\t#count'
-        for u in xrange(V):
-            # we iterate over triggers so that the most likely ones come first
-            for v in sorted(itertools.ifilter(lambda v: B[u,v], xrange(V)), key=lambda v: B[u,v], reverse=True):
-                print >> fb, '{0}\t{1}\t{2}'.format(tokens[u], tokens[v], B[u,v])
+        # we iterate over triggers and for each trigger the most frequent patterns come first
+        for k in np.lexsort((-B.values, B.rows)):
+            if B.values[k]:
+                print >> fb, '{0}\t{1}\t{2}'.format(tokens[B.rows[k]], tokens[B.cols[k]], B.values[k])
 
     # legacy options: optimise likelihood
     if args.mle:
@@ -172,6 +241,9 @@ def argparser(parser=None, func=main):
     parser.add_argument('output', 
             type=str,
             help="prefix for output files")
+    parser.add_argument('--packed',
+            type=str,
+            help='read the training corpus from a packed corpus with this prefix (see pack) instead of stdin')
     parser.add_argument('--insertion', '-i',
             action='store_true',
             help='allows for insertion (obviating the need for a smoothing constant)')
@@ -184,6 +256,12 @@ def argparser(parser=None, func=main):
     parser.add_argument('--unk', '-u',
             action='store_true',
             help='replaces singletons by an unk token')
+    parser.add_argument('--min-count',
+            type=int, default=0,
+            help='replaces patterns occurring fewer times than this by an unk token')
+    parser.add_argument('--vocab',
+            type=str,
+            help='use a vocabulary with counts (see discourse.util.save_vocab) instead of counting patterns in the input')
     parser.add_argument('--mle',
             action='store_true',
             help="chooses c to maximise the data's likelihood (useless, note that this will retrieve the MLE solution, i.e. c=0)")
@@ -5,15 +5,18 @@ This module can be used to score a document using A. Louis's model
 """
 
 import sys
+import os
 import argparse
 import logging
 import numpy as np
 import traceback
 from itertools import izip
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 from multiprocessing import Pool
 from functools import partial
-from discourse.util import register_token, read_documents, encode_documents, encode_test_documents, ibm_pairwise, pairwise, smart_open
+from discourse.util import register_token, iter_documents, iter_test_documents, encode_test_document, chunks, imap_documents, flatten_pairs, smart_open, atomic_open
+from discourse.syntax_based.sparse import SparseTable
+from discourse.syntax_based.packed import PackedCorpus, open_streams
 from discourse import command
 
 
@@ -28,7 +31,8 @@ def load_model(u_path, b_path, null='<null>', unk='<unk>'):
     
     Returns
     -------
-    T: numpy array such that T[f,e] = t(f|e)
+    U: numpy array of unigram counts
+    B: SparseTable of bigram counts such that B[u,v] = count(u, v)
     vocab: defaultdict mapping a pattern (str) into an id (int)
     """
     vocab = defaultdict()
@@ -59,119 +63,245 @@ def load_model(u_path, b_path, null='<null>', unk='<unk>'):
     
     V = len(vocab)
     U = np.zeros(V, int)
-    B = np.zeros((V, V), int)
     for w, c in u_entries:
         U[w] = c
-    for w1, w2, c in b_entries:
-        B[w1,w2] = c
+    w1s, w2s, counts = zip(*b_entries) if b_entries else ([], [], [])
+    B = SparseTable.from_entries(w1s, w2s, np.array(counts, int), (V, V))
     return U, B, vocab
 
 
-def loglikelihood(corpus, U, B, c, insertion=False):
+LogProbTable = namedtuple('LogProbTable', 'B c lognorm')
+
+
+def logprob_table(U, B, c):
     """
-    Computes -log(likelihood(T))
+    Precomputes (once per model and smoothing constant) what is needed to score documents, that is,
+    log(count(u) + c|V|), the log normaliser of each trigger u.
+    Bigram counts are kept sparse: for pairs never observed the smoothed probability c/(count(u) + c|V|) is obtained analytically.
+
+    Arguments
+    ---------
+    U: unigram counts
+    B: SparseTable of bigram counts
+    c: smoothing constant
+
+    Returns
+    -------
+    LogProbTable
+    """
+    with np.errstate(divide='ignore'):
+        return LogProbTable(B=B, c=c, lognorm=np.log(U + c * len(U)))
+
+
+def loglikelihood(corpus, table, insertion=False):
+    """
+    Computes log(likelihood(T)) of each document
+
+        p(Sb|Sa) = \prod_{v in Sb} 1/|Sa| \sum_{u in Sa} (count(u,v) + c)/(count(u) + c|V|)
+
+    All sentence pairs in the corpus are flattened (see `flatten_pairs`) and the inner sums are computed
+    in log space (logsumexp over the links of each segment) with vectorised gathers.
 
     This version is slightly different from the one in ibm1.py
     because it has to deal with unknown patterns.
+
+    Arguments
+    ---------
+    corpus: documents encoded by `encode_test_document`
+    table: as produced by `logprob_table`
+    insertion: whether or not the null word is inserted in the first sentence of each pair
+
+    Returns
+    -------
+    an array with the log likelihood of each document
+
+    >>> U, B = np.array([4, 2, 2]), SparseTable.from_entries([0, 0, 1], [1, 2, 2], [2, 2, 1], (3, 3))
+    >>> doc = [np.array([1]), np.array([2, 2])]
+    >>> loglikelihood([doc, doc[:1]], logprob_table(U, B, 0.5), insertion=True)
+    array([-1.63488979,  0.        ])
+    """
+    pairs = flatten_pairs(corpus, insertion)
+    # log p(v|u) for every link (u, v), unseen pairs (not stored in B) simply get log(c) - log(count(u) + c|V|)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logprobs = np.log(table.B.lookup(pairs.e, pairs.f) + table.c) - table.lognorm[pairs.e]
+    # logsumexp over the links of each segment (the links of a segment are contiguous)
+    lengths = np.bincount(pairs.segment, minlength=pairs.n_segments)
+    maxima = np.full(pairs.n_segments, -np.inf)
+    nonempty = lengths > 0
+    if logprobs.size:
+        maxima[nonempty] = np.maximum.reduceat(logprobs, (np.cumsum(lengths) - lengths)[nonempty])
+    maxima[~np.isfinite(maxima)] = 0
+    Z = np.bincount(pairs.segment, weights=np.exp(logprobs - maxima[pairs.segment]), minlength=pairs.n_segments)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S = maxima + np.log(Z) - np.log(lengths)
+    return np.bincount(pairs.document, weights=S, minlength=pairs.n_documents)
+
+
+def decode_stream(istream, ostream, table, vocab, insertion=False, boundaries=False, batch=100):
+    """
+    Scores documents as they are read and dumps their scores right away.
+    Documents are encoded and scored in batches, thus memory usage is bounded by the batch size
+    (rather than growing with the size of the input).
+
+    Arguments
+    ---------
+    istream: test documents in doctext format
+    ostream: where scores are written to
+    table: as produced by `logprob_table`
+    vocab: defaultdict mapping a pattern (str) into an id (int)
+    insertion: whether the model was estimated with null insertion
+    boundaries: whether document boundary tokens should be added
+    batch: number of documents scored at once
+
+    Returns
+    -------
+    sum of the log likelihoods and number of documents
     """
-    L = np.zeros(len(corpus))
-     
-    getpairs = ibm_pairwise if insertion else pairwise
+    return score_batches(chunks(iter_test_documents(istream, vocab, boundaries), batch), ostream, table, insertion)
 
-    for i, D in enumerate(corpus):
-        # for each sentence pair
-        for Sa, Sb in getpairs(D):  # if insertion=True, then getpairs=ibm_pairwise, consequently, Sa[0] is the null word
-            # for each pattern in the second sentence of the pair
-            for v in Sb:
-                # sum up the contributions of the pattern v conditioned on each pattern u in the first sentence of the pair
-                L[i] = np.log(1.0/len(Sa)) + np.log(np.sum([(B[u,v] + c)/(U[u] + c * len(U)) for u in Sa]))
-    return L
+
+def score_batches(batches, ostream, table, insertion=False):
+    """
+    Scores batches of encoded documents (e.g. slices of a PackedCorpus) dumping their scores right away.
+
+    Returns
+    -------
+    sum of the log likelihoods and number of documents
+    """
+    print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
+    total, n = 0.0, 0
+    for documents in batches:
+        L = loglikelihood(documents, table, insertion)
+        for D, ll in izip(documents, L):
+            num_sentences = len(D)
+            num_patterns = sum(len(row) for row in D)
+            print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(n, ll, num_sentences, 
+                    ll/num_sentences, num_patterns, ll/num_patterns)
+            n += 1
+        total += L.sum()
+    return total, n
+
+
+# the model is shared with worker processes (inherited when the pool forks, thus never pickled)
+_SHARED_ = {}
+
+
+def _init_worker(table, vocab, insertion):
+    _SHARED_.update(table=table, vocab=vocab, insertion=insertion)
+
+
+def _shared_model(unigrams, bigrams, c, mtime):
+    """loads a model once per worker of a shared pool (whose workers were not initialised with it, see `decode_many`)"""
+    key = (unigrams, bigrams, c, mtime)
+    if key not in _SHARED_:
+        U, B, vocab = load_model(unigrams, bigrams)
+        _SHARED_[key] = logprob_table(U, B, c), vocab, B.values[B.rows == 0].sum() > 0
+    return _SHARED_[key]
+
+
+def score_chunk(documents, table, vocab, insertion):
+    """encodes and scores a chunk of documents returning their log likelihoods, number of sentences and number of patterns"""
+    corpus = [encode_test_document(D, vocab) for D in documents]
+    L = loglikelihood(corpus, table, insertion)
+    return L, [len(D) for D in corpus], [sum(len(row) for row in D) for D in corpus]
 
 
-def wrapped_loglikelihood(corpus, U, B, c, insertion):
+def wrapped_score_documents(documents):
     try:
-        return loglikelihood(corpus, U, B, c, insertion)
+        return score_chunk(documents, _SHARED_['table'], _SHARED_['vocab'], _SHARED_['insertion'])
     except:
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
 
 
-def decode(unigrams, bigrams, c, istream, ostream, estream=sys.stderr):
+def wrapped_score_with(model, documents):
+    try:
+        return score_chunk(documents, *_shared_model(*model))
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def decode(unigrams, bigrams, c, istream, ostream, estream=sys.stderr, packed=None):
 
     # reads in the model
     logging.info('Loading model: %s and %s', unigrams, bigrams)
     U, B, vocab = load_model(unigrams, bigrams)
-    logging.info('%d unigrams and %d bigrams', U.shape[0], B.shape[0])
+    logging.info('%d unigrams and %d bigrams', U.shape[0], B.size)
 
     # detect whether document boundary tokens were used in the model
     boundaries = '<doc>' in vocab
     # detect whether insertion was swtiched
-    insertion = B[0,:].sum() > 0
-    # reads in the test documents
-    logging.info('Reading test documents in (boundaries=%s) ...', boundaries)
-    documents = read_documents(istream, boundaries)  
-    logging.info('%d test documents read', len(documents))
-   
-    # encode test documents using the model's vocabulary
-    test = encode_test_documents(documents, vocab)
-
-    # computes the log likelihood of each document
-    L = loglikelihood(test, U, B, c, insertion)
-
-    # dumps scores
-    print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
-    for i, ll in enumerate(L):
-        num_sentences = len(test[i])
-        num_patterns = sum(len(row) for row in test[i])
-        print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(i, ll, num_sentences, 
-                ll/num_sentences, num_patterns, ll/num_patterns)
+    insertion = B.values[B.rows == 0].sum() > 0
+    # the normalisers are computed once for all documents
+    table = logprob_table(U, B, c)
+    # streams test documents in (encoded using the model's vocabulary) and computes the log likelihood of each document
+    logging.info('Scoring test documents (boundaries=%s) ...', boundaries)
+    if packed:  # test documents are read off a packed corpus (re-encoded using the model's vocabulary)
+        corpus = PackedCorpus.load(packed)
+        if boundaries:
+            corpus = corpus.with_boundaries()
+        total, n = score_batches(corpus.encode(vocab).chunks(100), ostream, table, insertion)
+    else:
+        total, n = decode_stream(istream, ostream, table, vocab, insertion, boundaries)
+    logging.info('%d test documents scored', n)
+
     print >> estream, '#sum\t#mean'
-    print >> estream, '{0}\t{1}'.format(L.sum(), np.mean(L))
+    print >> estream, '{0}\t{1}'.format(total, total / n if n else np.nan)
   
 
-def decode_many(unigrams, bigrams, c, ipaths, opaths, jobs, estream=sys.stderr):
+def decode_many(unigrams, bigrams, c, ipaths, opaths, jobs, estream=sys.stderr, chunk_size=100, pool=None):
 
     # reads in the model
     logging.info('Loading model: %s and %s', unigrams, bigrams)
     U, B, vocab = load_model(unigrams, bigrams)
-    logging.info('%d unigrams and %d bigrams', U.shape[0], B.shape[0])
+    logging.info('%d unigrams and %d bigrams', U.shape[0], B.size)
 
     # detect whether document boundary tokens were used in the model
     boundaries = '<doc>' in vocab
     # detect whether insertion was swtiched
-    insertion = B[0,:].sum() > 0
-
-    # reads in the test documents
-    logging.info('Reading test documents in (boundaries=%s) ...', boundaries)
-
-    tests = [None] * len(ipaths)
-    for i, ipath in enumerate(ipaths):
-        documents = read_documents(smart_open(ipath), boundaries)  
-        logging.info('%s: %d test documents read', ipath, len(documents))
-        # encode test documents using the model's vocabulary
-        tests[i] = encode_test_documents(documents, vocab)
-
-    # computes the log likelihood of each document in each test file
-    pool = Pool(jobs)
-    all_L = pool.map(partial(wrapped_loglikelihood, U=U, B=B, c=c, insertion=insertion), tests)
-
-    print >> estream, '#file\t#sum\t#mean'
-    for ipath, opath, test, L in izip(ipaths, opaths, tests, all_L):
-        with smart_open(opath, 'w') as ostream:
+    insertion = B.values[B.rows == 0].sum() > 0
+    # the normalisers are computed once for all documents
+    table = logprob_table(U, B, c)
+
+    # test documents are streamed in and scored in chunks by the workers (as they become available)
+    # each file is written out as soon as all of its chunks are scored
+    logging.info('Scoring test documents (boundaries=%s) ...', boundaries)
+    if pool is None:
+        pool, shared = Pool(jobs, _init_worker, (table, vocab, insertion)), False
+        func = wrapped_score_documents
+    else:
+        # workers of a shared pool load the model themselves (once)
+        shared = True
+        func = partial(wrapped_score_with, (unigrams, bigrams, c, max(os.path.getmtime(unigrams), os.path.getmtime(bigrams))))
+    summary = [None] * len(ipaths)
+    for k, results in imap_documents(pool, func, ipaths, 
+            partial(iter_documents, doc_boundaries=boundaries), chunk_size, max_pending=4 * jobs):
+        n = 0
+        with atomic_open(opaths[k]) as ostream:
             # dumps scores
             print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
-            for i, ll in enumerate(L):
-                num_sentences = len(test[i])
-                num_patterns = sum(len(row) for row in test[i])
-                print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(i, ll, num_sentences, 
-                        ll/num_sentences, num_patterns, ll/num_patterns)
-            print >> estream, '{0}\t{1}\t{2}'.format(opath, L.sum(), np.mean(L))
+            for L, sentences, patterns in results:
+                for ll, num_sentences, num_patterns in izip(L, sentences, patterns):
+                    print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(n, ll, num_sentences, 
+                            ll/num_sentences, num_patterns, ll/num_patterns)
+                    n += 1
+        L = np.concatenate([L for L, _, _ in results])
+        logging.info('%s: %d test documents scored', ipaths[k], n)
+        summary[k] = '{0}\t{1}\t{2}'.format(opaths[k], L.sum(), L.mean() if n else np.nan)
+    if not shared:
+        pool.close()
+        pool.join()
+
+    print >> estream, '#file\t#sum\t#mean'
+    for line in summary:
+        print >> estream, line
 
 
 def main(args):
     logging.basicConfig(
             level=(logging.DEBUG if args.verbose else logging.INFO), 
             format='%(levelname)s %(message)s')
-    decode(args.unigrams, args.bigrams, args.smoothing, args.input, args.output)
+    istream, ostream = open_streams(args)
+    decode(args.unigrams, args.bigrams, args.smoothing, istream, ostream, packed=args.packed)
     
 
 @command('alouis_decoder', 'syntax-based')
@@ -190,14 +320,17 @@ def argparser(parser=None, func=main):
             type=str,
             help='bigram counts')
     parser.add_argument('input', nargs='?', 
-            type=argparse.FileType('r'), default=sys.stdin,
-            help='test corpus in doctext format')
+            type=str, default='-',
+            help='test corpus in doctext format, with --packed the only positional argument is the output')
     parser.add_argument('output', nargs='?', 
-            type=argparse.FileType('w'), default=sys.stdout,
+            type=str, default='-',
             help='document log probabilities')
     parser.add_argument('--smoothing', '-c',
             type=float, default=0.001,
             help='smoothing constant')
+    parser.add_argument('--packed',
+            type=str,
+            help='read the test corpus from a packed corpus with this prefix (see pack) instead of the input stream')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
@@ -1,15 +1,28 @@
 """
 Extract d-sequences from PTB-style parse trees (see Louis and Nekova, 2012).
 
+Extraction can go through a persistent cache (see `DSeqCache`) which is content-addressed:
+the d-sequences of a tree are stored under (tree hash, depth, no_punc, lexicalised, child_phrase),
+where the hash also covers the source of this module (so that entries extracted by older code are never reused),
+thus on sweeps over hyperparameters (e.g. depths 1-4) of the same corpora a tree is parsed only once per configuration.
+Several depths can also be extracted with a single traversal of each tree (see `dseqs_at`).
 
 @author: wilkeraziz
 """
 
+import os
+import re
+import time
+import itertools
 import string
 import argparse
 import sys
+import hashlib
+import sqlite3
+from collections import OrderedDict
 from nltk.tree import Tree
 from discourse.doctext import writedoctext, iterdoctext
+from discourse.util import tabulate
 from discourse import command
 
 
@@ -62,7 +75,41 @@ def find_subtrees(tree, depth):
     return subtrees
 
 
-def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost', separator='*', backoff=['*']):
+def find_subtrees_at(tree, depths):
+    """
+    Returns all subtrees at each of the given depths (with a single traversal of the tree)
+
+    Arguments
+    ---------
+    tree: either an nltk.tree.Tree or a PTB-formatted string
+    depths: the target depths
+
+    Returns
+    -------
+    list of subtrees (see `find_subtrees`) for each target depth
+
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NP (JJ major) (NN news) (NNS items)) (PP (IN in) (NP (NP (VBG leading) (JJ Turkish) (NNS newspapers)) (PP (IN on) (NP (NNP Monday))))))) (. .)))"
+    >>> [[t.label() for t in subtrees] for subtrees in find_subtrees_at(ptb_str, [2, 4])]
+    [['NP', 'VP', '.'], ['NP', 'PP']]
+    """
+    if isinstance(tree, str):
+        tree = Tree.fromstring(tree)
+    subtrees = {depth: [] for depth in depths}
+    max_depth = max(depths) if depths else 0
+
+    def visit(node, depth):
+        children = [t for t in node if isinstance(t, Tree)]
+        if depth + 1 in subtrees:
+            subtrees[depth + 1].extend(children)
+        if depth + 1 < max_depth:
+            for t in children:
+                visit(t, depth + 1)
+
+    visit(tree, 0)
+    return [subtrees[depth] for depth in depths]
+
+
+def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost', separator='*', backoff=['*'], fast=True):
     """
     Returns d-sequences of a certain depth.
     
@@ -82,6 +129,7 @@ def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost
     child_phrase: which child phrase is chosen to annotate the parent (choices: leftmost, rightmost, none)
     separator: string that separates the parent and the child pattern
     backoff: return backoff when no sequences can be produced
+    fast: PTB-formatted strings are scanned (see `scan_ptb`) rather than parsed into nltk trees
 
     Returns
     -------
@@ -103,10 +151,118 @@ def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost
     >>> dseqs(ptb_str, 2, child_phrase='none')
     ['NP', 'VP']
     """
-    # convert input to nlt.tree.Tree if str
-    if isinstance(tree, str):
-        tree = Tree.fromstring(tree)
-    
+    # finds (a summary of) the subtrees at given depth
+    nodes = find_nodes_at(tree, [depth], fast)[0]
+    # gathers patterns
+    return make_patterns(nodes, no_punc, lexicalised, child_phrase, separator, backoff)
+
+
+def dseqs_at(tree, depths, no_punc=True, lexicalised=False, child_phrase='leftmost', separator='*', backoff=['*'], fast=True):
+    """
+    Returns d-sequences of several depths with a single traversal of the tree (see `dseqs` for the arguments).
+
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NP (JJ major) (NN news) (NNS items)) (PP (IN in) (NP (NP (VBG leading) (JJ Turkish) (NNS newspapers)) (PP (IN on) (NP (NNP Monday))))))) (. .)))"
+    >>> dseqs_at(ptb_str, [2, 3])
+    [['NP*DT', 'VP*VBP'], ['DT', 'VBG', 'VBP', 'NP*NP']]
+    """
+    return [make_patterns(nodes, no_punc, lexicalised, child_phrase, separator, backoff) 
+            for nodes in find_nodes_at(tree, depths, fast)]
+
+
+_PTB_TOKENS_ = re.compile(r'\(\s*[^\s()]*|\)|[^\s()]+')
+
+
+def scan_ptb(ptb_str, depths):
+    """
+    Scans a PTB-formatted string and returns a summary of the nodes at each of the given depths
+    without building a tree (tokenisation follows nltk.tree.Tree.fromstring).
+
+    Arguments
+    ---------
+    ptb_str: a PTB-formatted string
+    depths: the target depths
+
+    Returns
+    -------
+    list of nodes (in the order they appear in the string) for each target depth, a node is a list [label, leftmost, rightmost]
+    where leftmost and rightmost are the node's first and last children represented by a pair (label, True) if the child is a node
+    or (word, False) if the child is a leaf (or None if the node has no children)
+
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NN news))) (. .)))"
+    >>> scan_ptb(ptb_str, [2])
+    [[['NP', ('DT', True), ('VBG', True)], ['VP', ('VBP', True), ('NP', True)], ['.', ('.', False), ('.', False)]]]
+    >>> scan_ptb(ptb_str, [3, 1])
+    [[['DT', ('The', False), ('The', False)], ['VBG', ('following', False), ('following', False)], ['VBP', ('are', False), ('are', False)], ['NP', ('NN', True), ('NN', True)]], [['S', ('NP', True), ('.', True)]]]
+    >>> scan_ptb('(A (B x)', [1])
+    Traceback (most recent call last):
+    ...
+    ValueError: Unbalanced brackets in: (A (B x)
+    """
+    nodes = {depth: [] for depth in depths}
+    # stack of open nodes, those which are not at a target depth are represented by None
+    stack = []
+    complete = False
+    for token in _PTB_TOKENS_.findall(ptb_str):
+        if token[0] == '(':
+            if complete:
+                raise ValueError('Expected end of string in: %s' % ptb_str)
+            label = token[1:].lstrip()
+            if stack:  # a node child
+                parent = stack[-1]
+                if parent is not None:
+                    if parent[1] is None:
+                        parent[1] = (label, True)
+                    parent[2] = (label, True)
+            selected = nodes.get(len(stack))
+            if selected is not None:
+                node = [label, None, None]
+                selected.append(node)
+                stack.append(node)
+            else:
+                stack.append(None)
+        elif token == ')':
+            if not stack:
+                raise ValueError('Unbalanced brackets in: %s' % ptb_str)
+            stack.pop()
+            complete = not stack
+        else:  # a leaf child
+            if not stack:
+                raise ValueError('Leaf outside brackets in: %s' % ptb_str)
+            parent = stack[-1]
+            if parent is not None:
+                if parent[1] is None:
+                    parent[1] = (token, False)
+                parent[2] = (token, False)
+    if stack:
+        raise ValueError('Unbalanced brackets in: %s' % ptb_str)
+    return [nodes[depth] for depth in depths]
+
+
+def _summarise(subtree):
+    """represents an nltk subtree as a node (see `scan_ptb`)"""
+    child = lambda t: (t.label(), True) if isinstance(t, Tree) else (t, False)
+    return [subtree.label(), child(subtree[0]), child(subtree[-1])]
+
+
+def find_nodes_at(tree, depths, fast=True):
+    """
+    Returns a summary of the nodes (see `scan_ptb`) at each of the given depths.
+
+    Arguments
+    ---------
+    tree: either an nltk.tree.Tree or a PTB-formatted string
+    depths: the target depths
+    fast: PTB-formatted strings are scanned (see `scan_ptb`) rather than parsed into nltk trees
+    """
+    if isinstance(tree, str) and fast:
+        return scan_ptb(tree, depths)
+    return [[_summarise(t) for t in subtrees] for subtrees in find_subtrees_at(tree, depths)]
+
+
+def make_patterns(nodes, no_punc=True, lexicalised=False, child_phrase='leftmost', separator='*', backoff=['*']):
+    """
+    Returns the syntactic patterns of a sequence of nodes as produced by `find_nodes_at` (see `dseqs` for the arguments).
+    """
     # deal with punctuation
     if no_punc:
         is_valid = lambda label: any(c not in string.punctuation for c in label)
@@ -115,21 +271,18 @@ def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost
 
     # index of the child phrase to be selected
     if child_phrase == 'leftmost':
-        get_child = lambda parent: parent[0]
+        get_child = lambda parent: parent[1]
     elif child_phrase == 'rightmost':
-        get_child = lambda parent: parent[-1]
+        get_child = lambda parent: parent[2]
     elif child_phrase in ['none', '']:
         get_child = lambda parent: None
     else:
         raise ValueError('Unknown option for child_phrase=%s', child_phrase)
 
-    # finds subtrees at given depth
-    subtrees = find_subtrees(tree, depth)
-    # gathers patterns
     patterns = []
-    for parent in subtrees:
+    for parent in nodes:
         # skip punctuation nodes if no_punc heuristic is enabled
-        parent_label = parent.label()
+        parent_label = parent[0]
         if no_punc and not is_valid(parent_label):
             continue
 
@@ -141,10 +294,10 @@ def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost
             continue
         
         child_label = None
-        if isinstance(child, Tree):  # child is a node
-            child_label = child.label()
+        if child[1]:  # child is a node
+            child_label = child[0]
         elif lexicalised:  # child is a leaf and we are lexicalising items
-            child_label = child
+            child_label = child[0]
 
         if child_label is None:  # child was not accepted
             patterns.append(parent_label)
@@ -156,21 +309,215 @@ def dseqs(tree, depth=2, no_punc=True, lexicalised=False, child_phrase='leftmost
     return patterns if patterns else backoff 
 
 
+def _source_digest():
+    """sha1 of the source of this module"""
+    with open('{0}.py'.format(os.path.splitext(__file__)[0]), 'rb') as fi:
+        return hashlib.sha1(fi.read()).hexdigest()
+
+
+_SOURCE_DIGEST_ = _source_digest()
+
+
+class DSeqCache(object):
+    """
+    A persistent cache of d-sequences with an in-memory LRU front.
+
+    Entries are stored in an sqlite database (safe to share amongst concurrent processes)
+    and the most recently used ones are also kept in memory.
+
+    >>> cache = DSeqCache()  # in-memory only
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NN news))) (. .)))"
+    >>> key = DSeqCache.key(ptb_str, 2)
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, ['NP*DT', 'VP*VBP'])
+    >>> cache.get(key)
+    ['NP*DT', 'VP*VBP']
+    """
+
+    def __init__(self, path=None, capacity=100000, batch=1000):
+        """
+        Arguments
+        ---------
+        path: path to the sqlite database (if None, entries are only kept in memory)
+        capacity: maximum number of entries kept in memory
+        batch: number of new entries buffered before they are written to the database
+        """
+        self.path = path
+        self.capacity = capacity
+        self.batch = batch
+        self._lru = OrderedDict()
+        self._pending = []
+        self._db = None
+        self._pid = None
+
+    @staticmethod
+    def key(tree, depth, no_punc=True, lexicalised=False, child_phrase='leftmost'):
+        """returns the key of a PTB-formatted string under a certain configuration (and the current version of this module)"""
+        return (hashlib.sha1(_SOURCE_DIGEST_ + tree.strip()).hexdigest(), depth, int(no_punc), int(lexicalised), child_phrase or 'none')
+
+    def _connect(self):
+        # connections cannot be shared across processes, thus a forked process opens its own
+        if self._db is None or self._pid != os.getpid():
+            self._db = sqlite3.connect(self.path, timeout=600)
+            # entries can always be recomputed, thus we trade durability for speed (and WAL lets readers and writers coexist)
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=OFF')
+            self._db.execute('CREATE TABLE IF NOT EXISTS dseqs (tree TEXT, depth INTEGER, no_punc INTEGER, '
+                    'lexicalised INTEGER, child_phrase TEXT, patterns TEXT, '
+                    'PRIMARY KEY (tree, depth, no_punc, lexicalised, child_phrase))')
+            self._db.commit()
+            self._pid = os.getpid()
+            self._pending = []
+        return self._db
+
+    def _remember(self, key, patterns):
+        self._lru[key] = patterns
+        if len(self._lru) > self.capacity:
+            self._lru.popitem(last=False)
+
+    def get(self, key):
+        """returns the d-sequences stored under a key (or None)"""
+        patterns = self._lru.pop(key, None)
+        if patterns is None and self.path is not None:
+            row = self._connect().execute('SELECT patterns FROM dseqs WHERE tree=? AND depth=? AND no_punc=? '
+                    'AND lexicalised=? AND child_phrase=?', key).fetchone()
+            if row is not None:
+                patterns = row[0].split()
+        if patterns is not None:
+            self._remember(key, patterns)
+        return patterns
+
+    def put(self, key, patterns):
+        """stores the d-sequences of a key"""
+        self._remember(key, patterns)
+        if self.path is not None:
+            self._connect()
+            self._pending.append(key + (' '.join(patterns),))
+            if len(self._pending) >= self.batch:
+                self.flush()
+
+    def flush(self):
+        """writes buffered entries to the database"""
+        if self._pending and self._pid == os.getpid():
+            self._db.executemany('INSERT OR IGNORE INTO dseqs VALUES (?, ?, ?, ?, ?, ?)', self._pending)
+            self._db.commit()
+        self._pending = []
+
+    def close(self):
+        self.flush()
+        if self._db is not None and self._pid == os.getpid():
+            self._db.close()
+        self._db = None
+
+
+def cached_dseqs(tree, depths, cache, no_punc=True, lexicalised=False, child_phrase='leftmost', backoff=['*']):
+    """
+    Returns d-sequences of several depths (see `dseqs_at`) going through a cache.
+    Depths missing from the cache are extracted with a single traversal of the tree.
+
+    Arguments
+    ---------
+    tree: a PTB-formatted string
+    depths: the target depths
+    cache: a DSeqCache
+    no_punc, lexicalised, child_phrase: see `dseqs`
+    backoff: return backoff when no sequences can be produced (the cache stores the empty sequence)
+
+    Returns
+    -------
+    list of syntactic patterns for each depth
+
+    >>> cache = DSeqCache()
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NN news))) (. .)))"
+    >>> cached_dseqs(ptb_str, [2, 3], cache)
+    [['NP*DT', 'VP*VBP'], ['DT', 'VBG', 'VBP', 'NP*NN']]
+    >>> cached_dseqs(ptb_str, [5], cache)
+    [['*']]
+    >>> cache.get(DSeqCache.key(ptb_str, 5))
+    []
+    """
+    keys = [DSeqCache.key(tree, depth, no_punc, lexicalised, child_phrase) for depth in depths]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, patterns in enumerate(results) if patterns is None]
+    if missing:
+        extracted = dseqs_at(tree, [depths[i] for i in missing],
+                no_punc=no_punc,
+                lexicalised=lexicalised,
+                child_phrase=child_phrase,
+                backoff=[])
+        for i, patterns in zip(missing, extracted):
+            cache.put(keys[i], patterns)
+            results[i] = patterns
+    return [patterns if patterns else backoff for patterns in results]
+
+
+def benchmark(trees, depths, **kwargs):
+    """
+    Compares the nltk path (trees are parsed with nltk.tree.Tree.fromstring) to the fast path (see `scan_ptb`).
+
+    Arguments
+    ---------
+    trees: PTB-formatted strings
+    depths: the target depths
+    kwargs: see `dseqs`
+
+    Returns
+    -------
+    time (in seconds) taken by the nltk path, time taken by the fast path, and the number of trees for which the patterns differ
+
+    >>> ptb_str = "(ROOT (S (NP (DT The) (VBG following)) (VP (VBP are) (NP (NN news))) (. .)))"
+    >>> benchmark([ptb_str] * 10, [1, 2, 3], lexicalised=True)[2]
+    0
+    """
+    start = time.time()
+    slow = [dseqs_at(tree, depths, fast=False, **kwargs) for tree in trees]
+    nltk_time = time.time() - start
+    start = time.time()
+    fast = [dseqs_at(tree, depths, fast=True, **kwargs) for tree in trees]
+    fast_time = time.time() - start
+    return nltk_time, fast_time, sum(a != b for a, b in itertools.izip(slow, fast))
+
+
 def main(args):
+    depths = args.depths if args.depths else [args.depth]
+    if args.benchmark:
+        trees = [tree for trees, attrs in iterdoctext(args.input) for tree in trees]
+        rows = []
+        for child_phrase, no_punc, lexicalised in itertools.product(['leftmost', 'rightmost', 'none'], [True, False], [False, True]):
+            nltk_time, fast_time, mismatches = benchmark(trees, depths, no_punc=no_punc, lexicalised=lexicalised, child_phrase=child_phrase)
+            speedup = nltk_time / fast_time if fast_time > 0 else float('nan')  # e.g. no trees
+            rows.append([child_phrase, no_punc, lexicalised, nltk_time, fast_time, speedup, mismatches])
+        print >> sys.stderr, '{0} trees, depths: {1}'.format(len(trees), ' '.join(str(depth) for depth in depths))
+        print >> sys.stderr, tabulate(rows, headers=['child', 'no_punc', 'lexicalised', 'nltk (s)', 'fast (s)', 'speedup', 'mismatches'])
+        return
+    if args.depths:
+        # one output per depth
+        if not args.prefix:
+            raise ValueError('--depths requires --prefix')
+        outputs = [open('{0}.d{1}'.format(args.prefix, depth), 'w') for depth in depths]
+    else:
+        outputs = [args.output]
+    options = {'no_punc': not args.punc, 'lexicalised': args.lexicalised, 'child_phrase': args.child, 'backoff': ['*']}
+    if args.cache:
+        cache = DSeqCache(args.cache)
+        extract = lambda tree: cached_dseqs(tree, depths, cache, **options)
+    else:
+        extract = lambda tree: dseqs_at(tree, depths, **options)
     # reads in documents
     for trees, attrs in iterdoctext(args.input):
-        # generator of d-sequences
-        sequences = (dseqs(tree, 
-                        depth=args.depth, 
-                        no_punc=not args.punc, 
-                        lexicalised=args.lexicalised, 
-                        child_phrase=args.child, 
-                        backoff=['*']) 
-                    for tree in trees)
+        # d-sequences of each tree at each depth (a tree is traversed only once)
+        sequences = [extract(tree) for tree in trees]
         # writes d-sequences
-        writedoctext(args.output, 
-                (' '.join(patterns) for patterns in sequences),
-                **attrs)
+        for k, ostream in enumerate(outputs):
+            writedoctext(ostream, 
+                    (' '.join(patterns[k]) for patterns in sequences),
+                    **attrs)
+    if args.cache:
+        cache.close()
+    if args.depths:
+        for ostream in outputs:
+            ostream.close()
 
 
 @command('dseq', 'analysis')
@@ -187,6 +534,14 @@ def argparser(parser=None, func=main):
             type=argparse.FileType('w'), default=sys.stdout,
             help='d-sequences')
     parser.add_argument('--depth', '-d', type=int, default=2)
+    parser.add_argument('--depths', type=int, nargs='+',
+            help='extracts d-sequences of several depths with a single traversal of each tree (requires --prefix)')
+    parser.add_argument('--prefix', type=str,
+            help='with --depths, d-sequences of depth d are written to PREFIX.dd')
+    parser.add_argument('--benchmark', action='store_true',
+            help='compares the nltk path to the fast PTB scanner on the input (all combinations of --child, --punc and --lexicalised), no d-sequences are written')
+    parser.add_argument('--cache', type=str,
+            help='path to a persistent cache of d-sequences (sqlite database, created if necessary)')
     parser.add_argument('--punc', '-p', action='store_true',
             help='allow punctuation')
     parser.add_argument('--lexicalised', '-l', action='store_true',
@@ -39,78 +39,251 @@ In practice we do not have aligned data, thus to estimate t(F|E) we marginalise
 
 import sys
 import logging
-import itertools
 import argparse
+import traceback
 import numpy as np
-from discourse.util import bar, ibm_pairwise, read_documents, encode_documents, find_least_common
+from multiprocessing import Pool
+from discourse.util import bar, FlatPairs, flatten_pairs, shared_array, save_vocab, load_vocab_counts, atomic_path
+from discourse.syntax_based.sparse import SparseTable
+from discourse.syntax_based.packed import PackedCorpus, read_corpus, read_packed, open_streams
 from discourse import command
 
-def loglikelihood(corpus, T, progress=False):
-    """computes -log(likelihood(T))"""
-    L = np.zeros(len(corpus))
-    for i, D in bar(enumerate(corpus), maxval=len(corpus), none=not progress, msg='log likelihood'):
-        # for each sentence pair
-        for E, F in ibm_pairwise(D):
-            # for each pattern in the second sentence of the pair
-            for f in F:
-                # sum up the contributions of the pattern v conditioned on each pattern u in the first sentence of the pair
-                L[i] += np.log(T[f,E].sum())
-    return L
+def likelihood(pairs, links, T):
+    """
+    Computes the normalising factors of the fractional counts (first half of the E-step, see `fractional_counts`).
+    These are the very quantities the likelihood is made of, thus the log likelihood of T comes as a by-product:
+        \sum_D \sum_(F,E) \sum_i log( \sum_j t(fi|ej) )
+
+    Arguments
+    ---------
+    pairs: sentence pairs as flattened by `discourse.util.flatten_pairs`
+    links: links[l] is the cell of T associated with the l-th link
+    T: T[f,e] = t(f|e) as a SparseTable
+
+    Returns
+    -------
+    Z[k] = \sum_j t(fk|ej) for the k-th pattern f (a segment)
+    L[d] = log(likelihood(T)) for the d-th document
+    """
+    Z = np.bincount(pairs.segment, weights=T.values[links], minlength=pairs.n_segments)
+    L = np.bincount(pairs.document, weights=np.log(Z), minlength=pairs.n_documents)
+    return Z, L
 
 
-def ibm1(corpus, V, max_iterations, min_gain, progress=False):
+def fractional_counts(pairs, links, T, Z):
+    """
+    Gathers fractional counts for every link in the corpus at once (second half of the E-step, see `likelihood`).
+
+    Arguments
+    ---------
+    pairs: sentence pairs as flattened by `discourse.util.flatten_pairs`
+    links: links[l] is the cell of T associated with the l-th link
+    T: T[f,e] = t(f|e) as a SparseTable
+    Z: normalising factors as computed by `likelihood`
+
+    Returns
+    -------
+    C[k] = c(f,e) for the k-th cell (f, e) of T
+    N[e] = c(e)
+    """
+    t = T.values[links]
+    # (normalised) fractional counts
+    # (a pattern whose triggers all have zero probability contributes no counts)
+    Z = Z[pairs.segment]
+    c = np.zeros(t.size)
+    np.divide(t, Z, out=c, where=Z > 0)
+    C = np.bincount(links, weights=c, minlength=T.size)
+    N = np.bincount(pairs.e, weights=c, minlength=T.shape[1])
+    return C, N
+
+
+def mstep(C, N, T):
+    """
+    Normalises fractional counts in one pass: t(f|e) = c(f,e)/c(e).
+
+    Arguments
+    ---------
+    C: C[k] = c(f,e) for the k-th cell (f, e) of T
+    N: N[e] = c(e)
+    T: the current SparseTable (only its layout is used)
+
+    Returns
+    -------
+    the new values of T, cells of triggers with zero counts get probability 0
+    """
+    n = N[T.cols]
+    values = np.zeros(T.size)
+    np.divide(C, n, out=values, where=n > 0)
+    return values
+
+
+# state shared with worker processes (inherited when the pool forks, thus never pickled)
+_SHARED_ = {}
+
+
+def shard_pairs(pairs, n_shards):
+    """
+    Splits the links into at most n_shards contiguous shards of roughly the same size without breaking segments.
+
+    Returns
+    -------
+    list of shards (first link, last link + 1, first segment, last segment + 1)
+    """
+    L = pairs.e.size
+    # approximate cuts are moved back to the first link in their segments
+    approx = (np.arange(1, n_shards) * L) // n_shards
+    cuts = np.searchsorted(pairs.segment, pairs.segment[approx]) if L else np.zeros(0, int)
+    cuts = np.unique(np.concatenate(([0], cuts, [L])))
+    # segments follow links (the last shard takes any trailing segment)
+    segments = [0] + [pairs.segment[l] for l in cuts[1:-1]] + [pairs.n_segments]
+    return [(cuts[j], cuts[j + 1], segments[j], segments[j + 1]) for j in range(len(cuts) - 1)]
+
+
+def _init_worker(pairs, links, T, Z, C, N, L):
+    """stores the state shared by all E-step workers"""
+    _SHARED_.update(pairs=pairs, links=links, T=T, Z=Z, C=C, N=N, L=L)
+
+
+def _estep_shard((j, a, b, sa, sb, counts)):
+    """
+    Runs half of the E-step for the j-th shard of links (a, b) and segments (sa, sb):
+    either the likelihood (counts=False) or the fractional counts (counts=True) given the normalisers of the former.
+    Results are stored in shared memory (Z[sa:sb] and L[j], or C[j] and N[j]) rather than returned.
+    """
+    try:
+        pairs = _SHARED_['pairs']
+        shard = FlatPairs(e=pairs.e[a:b], 
+                f=pairs.f[a:b], 
+                segment=pairs.segment[a:b] - sa, 
+                document=pairs.document[sa:sb], 
+                n_segments=sb - sa, 
+                n_documents=pairs.n_documents)
+        if counts:
+            _SHARED_['C'][j], _SHARED_['N'][j] = fractional_counts(shard, _SHARED_['links'][a:b], _SHARED_['T'], _SHARED_['Z'][sa:sb])
+        else:
+            _SHARED_['Z'][sa:sb], _SHARED_['L'][j] = likelihood(shard, _SHARED_['links'][a:b], _SHARED_['T'])
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def ibm1(corpus, V, max_iterations, min_gain, progress=False, jobs=1):
     """
     Estimates t(f|e) where (e, f) are syntactic patterns in adjacent sentences in a document.
     
     Arguments
     ---------
     corpus: training data encoded using numpy arrays of vocab ids (integers) 
-        where the id 0 represents the null symbol
+        where the id 0 represents the null symbol (or a PackedCorpus)
     V: vocabulary size
     max_iterations: maximum number of iterations (current convergence criterion)
+    jobs: number of processes gathering fractional counts (each over a shard of the sentence pairs)
 
     Return
     ------
-    T[f,e] = t(f|e) as a numpy array
+    T[f,e] = t(f|e) as a SparseTable
     """
 
-    T = np.ones((V, V), float) / V   # T[f,e] = t(f|e)
+    # sentence pairs are flattened once and reused in every E-step
+    if isinstance(corpus, PackedCorpus):
+        pairs = corpus.flatten_pairs()
+    else:
+        pairs = flatten_pairs(bar(corpus, maxval=len(corpus), none=not progress, msg='Sentence pairs'))
+    # only pairs (f, e) co-occurring in adjacent sentences can ever get probability mass, 
+    # thus T stores only those cells
+    T, links = SparseTable.from_pairs(pairs.f, pairs.e, (V, V), return_inverse=True)
+    logging.info('%d patterns linked to their triggers by %d links (%d parameters)', pairs.n_segments, links.size, T.size)
+
+    if jobs > 1:
+        # map-reduce E-step: each worker gathers partial counts over a shard of links
+        # T and the partial counts live in shared memory, thus only shard boundaries are pickled
+        shards = shard_pairs(pairs, jobs)
+        T.values = shared_array(T.size)
+        Z = shared_array(pairs.n_segments)
+        C_shards = shared_array((len(shards), T.size))
+        N_shards = shared_array((len(shards), V))
+        L_shards = shared_array((len(shards), pairs.n_documents))
+        pool = Pool(len(shards), _init_worker, (pairs, links, T, Z, C_shards, N_shards, L_shards))
+        logging.info('Distributing the E-step to %d workers', len(shards))
+
+        def compute_likelihood():
+            pool.map(_estep_shard, [(j,) + shard + (False,) for j, shard in enumerate(shards)])
+            return L_shards.sum(0)
+
+        def compute_counts():
+            pool.map(_estep_shard, [(j,) + shard + (True,) for j, shard in enumerate(shards)])
+            return C_shards.sum(0), N_shards.sum(0)
+    else:
+        pool = None
+        state = {}
+
+        def compute_likelihood():
+            state['Z'], L = likelihood(pairs, links, T)
+            return L
+
+        compute_counts = lambda: fractional_counts(pairs, links, T, state['Z'])
+
+    T.values[:] = 1.0 / V  # T[f,e] = t(f|e)
     LL = []
-    
-    LL.append(-loglikelihood(corpus, T, progress).sum())
-    logging.info('Initial log likelihood %f', LL[-1])
 
-    for i in range(max_iterations):
-        logging.info('Iteration %d', i)
-        C = np.zeros((V, V), float)  # C[f,e] = c(f,e)
-        N = np.zeros(V, float)       # N[e] = c(e)
-        # E-step
-        for D in bar(corpus, none=not progress, msg='E-step'):
-            # for each sentence pair
-            for E, F in ibm_pairwise(D):
-                Z = np.zeros(V, float)  # Z[fi] = \sum_j t(fi|ej)
-                # normalising factor 
-                for f in F:
-                    Z[f] = T[f,E].sum()  # this notation can be tricky to read: we are summing for row f the cells in columns indexed by elements of E
-                # gather (normalised) fractional counts
-                for e, f in itertools.product(E, F):
-                    c = T[f,e]/Z[f]
-                    C[f,e] += c
-                    N[e] += c
-        # M-step
-        for f, e in bar(itertools.product(range(V), range(V)), maxval=V*V, none=not progress, msg='M-step'):
-            T[f,e] = C[f,e] / N[e] 
-    
-        LL.append(-loglikelihood(corpus, T, progress).sum())
-        gain = - LL[-1] + LL[-2]
-        logging.info(' log_likelihood=%f log_gain=%f', LL[-1], gain)
-        if gain <= min_gain:
+    # the i-th E-step computes the likelihood of the estimates produced by the (i-1)-th M-step,
+    # fractional counts are only gathered once we know we are not done (converged or out of iterations)
+    for i in range(max_iterations + 1):
+        # E-step (first half): L[d] = log likelihood
+        L = compute_likelihood()
+        LL.append(-L.sum())
+        if i == 0:
+            logging.info('Initial log likelihood %f', LL[-1])
+        else:
+            gain = - LL[-1] + LL[-2]
+            logging.info(' log_likelihood=%f log_gain=%f', LL[-1], gain)
+            if gain <= min_gain:
+                break
+        if i == max_iterations:
             break
+        logging.info('Iteration %d', i)
+        # E-step (second half): C[k] = c(f,e) and N[e] = c(e)
+        C, N = compute_counts()
+        # M-step (in place, workers share T.values)
+        T.values[:] = mstep(C, N, T)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     LL = np.array(LL)
     logging.info('Final negative log likelihood %f ', LL[-1])
     return T, LL
 
+
+def save_model(prefix, T, tokens):
+    """
+    Stores T in binary format: a vocabulary (prefix.vocab) and the arrays of a SparseTable (prefix.*.npy),
+    which `discourse.syntax_based.ibm1_decoder` can memory-map.
+    """
+    with atomic_path('{0}.vocab'.format(prefix)) as tmp:
+        save_vocab(tmp, tokens)
+    T.save(prefix)
+
+
+def write_model(ostream, T, tokens):
+    """
+    Dumps T in a nice format
+
+    Arguments
+    ---------
+    ostream: where we write to
+    T: T[f,e] = t(f|e) as a SparseTable
+    tokens: tokens[i] is the pattern whose id is i
+    """
+    # we print a header so that the meaning of each column is clear
+    print >> ostream, '#trigger\t#pattern\t#p(pattern|trigger)'  # note that e=trigger and f=pattern 
+    # we iterate over f in no particular order (simply that of the vocabulary ids)
+    # and then over triggers so that the most likely ones come first
+    for k in np.lexsort((-T.values, T.rows)):
+        f, e, t = T.rows[k], T.cols[k], T.values[k]
+        if t:
+            print >> ostream, '{0}\t{1}\t{2}'.format(tokens[e], tokens[f], t)
+
      
 def main(args):
     
@@ -118,25 +291,24 @@ def main(args):
             level=(logging.DEBUG if args.verbose else logging.INFO), 
             format='%(asctime)s %(levelname)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
 
-    # read documents 
-    logging.info('Reading documents in...')
-    documents = read_documents(args.input, args.boundary)
-    logging.info('%d documents read', len(documents))
+    istream, ostream = open_streams(args)
+    if args.packed:
+        corpus, tokens = read_packed(args.packed, args.boundary, args.unk, args.min_count)
+    else:
+        corpus, tokens = read_corpus(istream, args.boundary, args.unk, args.min_count,
+                load_vocab_counts(args.vocab) if args.vocab else None)
+    logging.info('%d tokens read (including <null> and <unk>)', len(tokens))
+    train_model(args, corpus, tokens, ostream)
 
-    least_common, min_count = find_least_common(documents) if args.unk else (frozenset(), 0)
-    if args.unk:
-        logging.info('Least common patterns: frequency=%d patterns=%d', min_count, len(least_common))
-
-    # maps tokens to integer ids (0 is reserved for a special <null> symbol)
-    # and encodes the training data using numpy arrays of vocab ids
-    logging.info('Making vocab')
-    corpus, vocab = encode_documents(documents, ignore=least_common)
-    logging.info('%d tokens read (including <null> and <unk>)', len(vocab))
 
+def train_model(args, corpus, tokens, ostream):
+    """
+    Estimates IBM model 1 on an encoded corpus and stores it (as well as the log-likelihood values) as requested in args.
+    This is shared by the command line interface and the pipeline (which trains models in-process).
+    """
     # estimates parameters T[f,e] = t(f|e)
     # where (e, f) are syntactic patterns occurring in adjacent sentences in a document
-    T, LL = ibm1(corpus, len(vocab), args.max_iterations, args.min_gain, args.progress)
-    T = np.nan_to_num(T)
+    T, LL = ibm1(corpus, len(tokens), args.max_iterations, args.min_gain, args.progress, args.jobs)
     
     # store the log-likelihood values
     if args.ll:
@@ -144,20 +316,25 @@ def main(args):
             [fo.write('{0}\n'.format(ll)) for ll in LL]
 
     # dumps T in a nice format
-    tokens = [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)]
-    V = len(tokens)
-    # we print a header so that the meaning of each column is clear
-    print >> args.output, '#trigger\t#pattern\t#p(pattern|trigger)'  # note that e=trigger and f=pattern 
-    # we iterate over f in no particular order (simply that of the vocabulary ids)
-    for f in xrange(V):
-        # we iterate over triggers so that the most likely ones come first
-        for e in sorted(itertools.ifilter(lambda e: T[f,e], xrange(V)), key=lambda e: T[f,e], reverse=True):
-            print >> args.output, '{0}\t{1}\t{2}'.format(tokens[e], tokens[f], T[f,e])
+    write_model(ostream, T, tokens)
+    if args.binary:
+        logging.info('Saving binary model: %s', args.binary)
+        save_model(args.binary, T, tokens)
 
 
 @command('ibm1', 'syntax-based')
 def argparser(parser=None, func=main):
-    """parse command line arguments"""
+    """
+    parse command line arguments
+
+    With --packed a single positional argument is the output:
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'out.txt')
+    >>> args = argparser(func=None).parse_args(['--packed', 'P', path])
+    >>> istream, ostream = open_streams(args)
+    >>> istream is None, ostream.name == path
+    (True, True)
+    """
 
     if parser is None:
         parser = argparse.ArgumentParser(prog='ibm1')
@@ -166,14 +343,20 @@ def argparser(parser=None, func=main):
     parser.formatter_class = argparse.ArgumentDefaultsHelpFormatter
 
     parser.add_argument('input', nargs='?', 
-            type=argparse.FileType('r'), default=sys.stdin,
-            help='input corpus in doctext format')
+            type=str, default='-',
+            help='input corpus in doctext format, with --packed the only positional argument is the output')
     parser.add_argument('output', nargs='?', 
-            type=argparse.FileType('w'), default=sys.stdout,
+            type=str, default='-',
             help='output IBM1 estimates')
+    parser.add_argument('--packed',
+            type=str,
+            help='read the training corpus from a packed corpus with this prefix (see pack) instead of the input stream')
     parser.add_argument('--ll',
             type=str,
             help='store the progression of the likelihood')
+    parser.add_argument('--binary',
+            type=str,
+            help='also store the model in binary format using this prefix (see ibm1_decoder --binary)')
     parser.add_argument('--max-iterations', '-m',
             type=int, default=50,
             help='maximum number of iterations')
@@ -186,6 +369,15 @@ def argparser(parser=None, func=main):
     parser.add_argument('--unk', '-u',
             action='store_true',
             help='replaces singletons by an unk token')
+    parser.add_argument('--min-count',
+            type=int, default=0,
+            help='replaces patterns occurring fewer times than this by an unk token')
+    parser.add_argument('--vocab',
+            type=str,
+            help='use a vocabulary with counts (see discourse.util.save_vocab) instead of counting patterns in the input')
+    parser.add_argument('--jobs', '-j',
+            type=int, default=1,
+            help='number of processes gathering fractional counts in the E-step')
     parser.add_argument('--progress', '-p',
             action='store_true',
             help='display progress information')
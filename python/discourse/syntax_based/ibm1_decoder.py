@@ -5,6 +5,7 @@ This module can be used to score a document using IBM model 1.
 """
 
 import sys
+import os
 import argparse
 import logging
 import numpy as np
@@ -13,7 +14,9 @@ from itertools import izip
 from collections import defaultdict
 from multiprocessing import Pool
 from functools import partial
-from discourse.util import register_token, read_documents, encode_documents, encode_test_documents, ibm_pairwise, smart_open
+from discourse.util import register_token, iter_documents, iter_test_documents, encode_test_document, chunks, imap_documents, flatten_pairs, load_vocab, smart_open, atomic_open
+from discourse.syntax_based.sparse import SparseTable
+from discourse.syntax_based.packed import PackedCorpus, open_streams
 from discourse import command
 
 
@@ -28,7 +31,7 @@ def load_model(path, null='<null>', unk='<unk>'):
     
     Returns
     -------
-    T: numpy array such that T[f,e] = t(f|e)
+    T: SparseTable such that T[f,e] = t(f|e)
     vocab: defaultdict mapping a pattern (str) into an id (int)
     """
     with open(path) as fi:
@@ -44,9 +47,28 @@ def load_model(path, null='<null>', unk='<unk>'):
             e, f, t = line.split('\t') # t = t(f|e) where e=trigger and f=pattern
             entries.append((register_token(f, vocab), register_token(e, vocab), float(t)))
         V = len(vocab)
-        T = np.zeros((V, V), float)
-        for f, e, t in entries:
-            T[f,e] = t
+        fs, es, ts = zip(*entries) if entries else ([], [], [])
+        T = SparseTable.from_entries(fs, es, np.array(ts, float), (V, V))
+    return T, vocab
+
+
+def load_binary_model(prefix):
+    """
+    Loads a model stored in binary format (as produced by ibm1.py --binary).
+    The arrays are memory-mapped, thus loading takes nearly constant time
+    and worker processes forked afterwards share the same pages.
+
+    Arguments
+    ---------
+    prefix: prefix of the model files (prefix.vocab and prefix.*.npy)
+    
+    Returns
+    -------
+    T: SparseTable such that T[f,e] = t(f|e)
+    vocab: defaultdict mapping a pattern (str) into an id (int)
+    """
+    vocab = load_vocab('{0}.vocab'.format(prefix))
+    T = SparseTable.load(prefix)
     return T, vocab
 
 
@@ -55,99 +77,171 @@ def loglikelihood(corpus, T):
     Computes -log(likelihood(T))
 
     This version is slightly different from the one in ibm1.py
-    because it has to deal with unknown patterns.
+    because it has to deal with unknown patterns (as well as pairs of patterns never seen at training).
+    """
+    pairs = flatten_pairs(corpus)
+    # sum up the contributions of each pattern f conditioned on each pattern e in the first sentence of the pair
+    Z = np.bincount(pairs.segment, weights=T.lookup(pairs.f, pairs.e), minlength=pairs.n_segments)
+    return np.bincount(pairs.document, weights=np.log(Z), minlength=pairs.n_documents)
+
+
+def decode_stream(istream, ostream, T, vocab, boundaries=False, batch=100):
+    """
+    Scores documents as they are read and dumps their scores right away.
+    Documents are encoded and scored in batches, thus memory usage is bounded by the batch size
+    (rather than growing with the size of the input).
+
+    Arguments
+    ---------
+    istream: test documents in doctext format
+    ostream: where scores are written to
+    T: SparseTable such that T[f,e] = t(f|e)
+    vocab: defaultdict mapping a pattern (str) into an id (int)
+    boundaries: whether document boundary tokens should be added
+    batch: number of documents scored at once
+
+    Returns
+    -------
+    sum of the log likelihoods and number of documents
+    """
+    return score_batches(chunks(iter_test_documents(istream, vocab, boundaries), batch), ostream, T)
+
+
+def score_batches(batches, ostream, T):
+    """
+    Scores batches of encoded documents (e.g. slices of a PackedCorpus) dumping their scores right away.
+
+    Returns
+    -------
+    sum of the log likelihoods and number of documents
     """
-    L = np.zeros(len(corpus))
-    for i, D in enumerate(corpus):
-        # for each sentence pair
-        for E, F in ibm_pairwise(D):
-            # for each pattern in the second sentence of the pair
-            for f in F:
-                # sum up the contributions of the pattern v conditioned on each pattern u in the first sentence of the pair
-                L[i] += np.log(T[f,E].sum())
-    return L
-
-
-def wrapped_loglikelihood(corpus, T):
+    print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
+    total, n = 0.0, 0
+    for documents in batches:
+        L = loglikelihood(documents, T)
+        for D, ll in izip(documents, L):
+            num_sentences = len(D)
+            num_patterns = sum(len(row) for row in D)
+            print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(n, ll, num_sentences, 
+                    ll/num_sentences, num_patterns, ll/num_patterns)
+            n += 1
+        total += L.sum()
+    return total, n
+
+
+# the model is shared with worker processes (inherited when the pool forks, thus never pickled)
+_SHARED_ = {}
+
+
+def _init_worker(T, vocab):
+    _SHARED_['T'] = T
+    _SHARED_['vocab'] = vocab
+
+
+def _shared_model(model, binary, mtime):
+    """loads a model once per worker of a shared pool (whose workers were not initialised with it, see `decode_many`)"""
+    key = (model, binary, mtime)
+    if key not in _SHARED_:
+        _SHARED_[key] = load_binary_model(model) if binary else load_model(model)
+    return _SHARED_[key]
+
+
+def score_chunk(documents, T, vocab):
+    """encodes and scores a chunk of documents returning their log likelihoods, number of sentences and number of patterns"""
+    corpus = [encode_test_document(D, vocab) for D in documents]
+    L = loglikelihood(corpus, T)
+    return L, [len(D) for D in corpus], [sum(len(row) for row in D) for D in corpus]
+
+
+def wrapped_score_documents(documents):
+    try:
+        return score_chunk(documents, _SHARED_['T'], _SHARED_['vocab'])
+    except:
+        raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
+
+
+def wrapped_score_with(model, documents):
     try:
-        return loglikelihood(corpus, T)
+        T, vocab = _shared_model(*model)
+        return score_chunk(documents, T, vocab)
     except:
         raise Exception(''.join(traceback.format_exception(*sys.exc_info())))
 
 
-def decode(model, istream, ostream, estream=sys.stderr):
+def decode(model, istream, ostream, estream=sys.stderr, binary=False, packed=None):
 
     # reads in the model
     logging.info('Loading model: %s', model)
-    T, vocab = load_model(model)
+    T, vocab = load_binary_model(model) if binary else load_model(model)
     logging.info('%d patterns and %d entries', len(vocab), T.size)
 
     # detect whether document boundary tokens were used in the model
     boundaries = '<doc>' in vocab
-    # reads in the test documents
-    logging.info('Reading test documents in (boundaries=%s) ...', boundaries)
-    documents = read_documents(istream, boundaries)  
-    logging.info('%d test documents read', len(documents))
-   
-    # encode test documents using the model's vocabulary
-    test = encode_test_documents(documents, vocab)
-
-    # computes the log likelihood of each document
-    L = loglikelihood(test, T)
-
-    # dumps scores
-    print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
-    for i, ll in enumerate(L):
-        num_sentences = len(test[i])
-        num_patterns = sum(len(row) for row in test[i])
-        print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(i, ll, num_sentences, 
-                ll/num_sentences, num_patterns, ll/num_patterns)
+    # streams test documents in (encoded using the model's vocabulary) and computes the log likelihood of each document
+    logging.info('Scoring test documents (boundaries=%s) ...', boundaries)
+    if packed:  # test documents are read off a packed corpus (re-encoded using the model's vocabulary)
+        corpus = PackedCorpus.load(packed)
+        if boundaries:
+            corpus = corpus.with_boundaries()
+        total, n = score_batches(corpus.encode(vocab).chunks(100), ostream, T)
+    else:
+        total, n = decode_stream(istream, ostream, T, vocab, boundaries)
+    logging.info('%d test documents scored', n)
+
     print >> estream, '#sum\t#mean'
-    print >> estream, '{0}\t{1}'.format(L.sum(), np.mean(L))
+    print >> estream, '{0}\t{1}'.format(total, total / n if n else np.nan)
   
 
-def decode_many(model, ipaths, opaths, jobs, estream=sys.stderr):
+def decode_many(model, ipaths, opaths, jobs, estream=sys.stderr, chunk_size=100, binary=False, pool=None):
 
     # reads in the model
     logging.info('Loading model: %s', model)
-    T, vocab = load_model(model)
+    T, vocab = load_binary_model(model) if binary else load_model(model)
     logging.info('%d patterns and %d entries', len(vocab), T.size)
 
     # detect whether document boundary tokens were used in the model
     boundaries = '<doc>' in vocab
 
-    # reads in the test documents
-    logging.info('Reading test documents in (boundaries=%s) ...', boundaries)
-
-    tests = [None] * len(ipaths)
-    for i, ipath in enumerate(ipaths):
-        documents = read_documents(smart_open(ipath), boundaries)  
-        logging.info('%s: %d test documents read', ipath, len(documents))
-        # encode test documents using the model's vocabulary
-        tests[i] = encode_test_documents(documents, vocab)
-
-    # computes the log likelihood of each document in each test file
-    pool = Pool(jobs)
-    all_L = pool.map(partial(wrapped_loglikelihood, T=T), tests)
-
-    print >> estream, '#file\t#sum\t#mean'
-    for ipath, opath, test, L in izip(ipaths, opaths, tests, all_L):
-        with smart_open(opath, 'w') as ostream:
+    # test documents are streamed in and scored in chunks by the workers (as they become available)
+    # each file is written out as soon as all of its chunks are scored
+    logging.info('Scoring test documents (boundaries=%s) ...', boundaries)
+    if pool is None:
+        pool, shared = Pool(jobs, _init_worker, (T, vocab)), False
+        func = wrapped_score_documents
+    else:
+        # workers of a shared pool load the model themselves (once)
+        shared = True
+        func = partial(wrapped_score_with, (model, binary, os.path.getmtime('{0}.vocab'.format(model) if binary else model)))
+    summary = [None] * len(ipaths)
+    for k, results in imap_documents(pool, func, ipaths, 
+            partial(iter_documents, doc_boundaries=boundaries), chunk_size, max_pending=4 * jobs):
+        n = 0
+        with atomic_open(opaths[k]) as ostream:
             # dumps scores
             print >> ostream, '#doc\t#logprob\t#sentences\t#s_normalised\t#patterns\t#p_normalised'
-            for i, ll in enumerate(L):
-                num_sentences = len(test[i])
-                num_patterns = sum(len(row) for row in test[i])
-                print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(i, ll, num_sentences, 
-                        ll/num_sentences, num_patterns, ll/num_patterns)
-            print >> estream, '{0}\t{1}\t{2}'.format(opath, L.sum(), np.mean(L))
+            for L, sentences, patterns in results:
+                for ll, num_sentences, num_patterns in izip(L, sentences, patterns):
+                    print >> ostream, '{0}\t{1}\t{2}\t{3}\t{4}\t{5}'.format(n, ll, num_sentences, 
+                            ll/num_sentences, num_patterns, ll/num_patterns)
+                    n += 1
+        L = np.concatenate([L for L, _, _ in results])
+        logging.info('%s: %d test documents scored', ipaths[k], n)
+        summary[k] = '{0}\t{1}\t{2}'.format(opaths[k], L.sum(), L.mean() if n else np.nan)
+    if not shared:
+        pool.close()
+        pool.join()
+
+    print >> estream, '#file\t#sum\t#mean'
+    for line in summary:
+        print >> estream, line
 
 
 def main(args):
     logging.basicConfig(
             level=(logging.DEBUG if args.verbose else logging.INFO), 
             format='%(levelname)s %(message)s')
-    decode(args.model, args.input, args.output)
+    istream, ostream = open_streams(args)
+    decode(args.model, istream, ostream, binary=args.binary, packed=args.packed)
     
 
 @command('ibm1_decoder', 'syntax-based')
@@ -162,13 +256,19 @@ def argparser(parser=None, func=main):
     
     parser.add_argument('model',
             type=str,
-            help='path to model estimated by ibm1.py')
+            help='path to model estimated by ibm1.py (or prefix of a binary model, see --binary)')
     parser.add_argument('input', nargs='?', 
-            type=argparse.FileType('r'), default=sys.stdin,
-            help='test corpus in doctext format')
+            type=str, default='-',
+            help='test corpus in doctext format, with --packed the only positional argument is the output')
     parser.add_argument('output', nargs='?', 
-            type=argparse.FileType('w'), default=sys.stdout,
+            type=str, default='-',
             help='document log probabilities')
+    parser.add_argument('--binary',
+            action='store_true',
+            help='the model is stored in binary format (see ibm1.py --binary)')
+    parser.add_argument('--packed',
+            type=str,
+            help='read the test corpus from a packed corpus with this prefix (see pack) instead of the input stream')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
@@ -0,0 +1,379 @@
+"""
+A packed (binary) format for corpora of syntactic patterns.
+
+Reading a corpus in doctext format means splitting text and building one small numpy array per sentence (wrapped in object arrays).
+A packed corpus stores the same documents in three flat arrays
+    tokens: the id (int32) of every pattern in the corpus (in order)
+    sentences: offsets of sentences into tokens (n_sentences + 1 entries)
+    documents: offsets of documents into sentences (n_documents + 1 entries)
+plus a vocabulary with counts (see `discourse.util.save_vocab`).
+The arrays are stored in numpy's format (prefix.tokens.npy, prefix.sentences.npy and prefix.documents.npy)
+and memory-mapped when loaded, thus repeated training and decoding skips parsing text altogether.
+
+Convert a corpus in doctext format:
+    python -m discourse.syntax_based.packed corpus.doctext corpus
+
+You can test me:
+    python -m doctest packed.py
+
+@author: wilkeraziz
+"""
+
+import sys
+import argparse
+import logging
+import numpy as np
+from array import array
+from itertools import izip
+from collections import defaultdict
+from discourse.util import iter_documents, encode_and_count, encode_test_document, prune_vocab, register_token, save_vocab, load_vocab, FlatPairs
+from discourse import command
+
+
+class PackedCorpus(object):
+    """
+    Documents packed into a flat array of token ids and two arrays of offsets.
+
+    A packed corpus behaves like a sequence of documents encoded by `encode_documents`:
+    `corpus[i]` is a list of arrays of ids (views of `tokens`, one per sentence)
+    and `corpus[a:b]` is a packed corpus sharing the same arrays.
+
+    >>> corpus = pack_documents([[['a', 'b'], ['c']], [['a']]])
+    >>> corpus.tokens, corpus.sentences, corpus.documents
+    (array([2, 3, 4, 2], dtype=int32), array([0, 2, 3, 4]), array([0, 2, 3]))
+    >>> corpus.vocab
+    ['<null>', '<unk>', 'a', 'b', 'c']
+    >>> len(corpus), corpus[0]
+    (2, [array([2, 3], dtype=int32), array([4], dtype=int32)])
+    >>> list(corpus[1:])
+    [[array([2], dtype=int32)]]
+    """
+
+    def __init__(self, tokens, sentences, documents, vocab):
+        self.tokens = tokens
+        self.sentences = sentences
+        self.documents = documents
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.documents) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            a, b, step = i.indices(len(self))
+            assert step == 1, 'Packed corpora can only be sliced contiguously'
+            b = max(a, b)
+            return PackedCorpus(self.tokens,
+                    self.sentences[self.documents[a]:self.documents[b] + 1],
+                    self.documents[a:b + 1] - self.documents[a],
+                    self.vocab)
+        if i < 0:
+            i += len(self)
+        offsets = self.sentences[self.documents[i]:self.documents[i + 1] + 1]
+        return [self.tokens[a:b] for a, b in izip(offsets[:-1], offsets[1:])]
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def chunks(self, size):
+        """iterates over contiguous slices of at most `size` documents"""
+        for a in xrange(0, len(self), size):
+            yield self[a:a + size]
+
+    def arrays(self):
+        """returns (tokens, sentences, documents) restricted to the documents in this corpus (offsets start from 0)"""
+        t0 = self.sentences[0]
+        return self.tokens[t0:self.sentences[-1]], self.sentences - t0, self.documents
+
+    def with_boundaries(self, bos='<doc>', eos='</doc>'):
+        """
+        Wraps every document with boundary sentences (see `iter_documents`).
+        Boundary tokens are added to the vocabulary if necessary and ids are then renumbered in order of first occurrence,
+        thus they match those of documents read with boundaries in the first place (see `pack_documents`).
+
+        >>> corpus = pack_documents([[['a', 'b'], ['c']], [['a']]]).with_boundaries()
+        >>> list(corpus)[1]
+        [array([2], dtype=int32), array([3], dtype=int32), array([6], dtype=int32)]
+        >>> corpus.vocab
+        ['<null>', '<unk>', '<doc>', 'a', 'b', 'c', '</doc>']
+        >>> corpus.sentences, corpus.documents
+        (array([0, 1, 3, 4, 5, 6, 7, 8]), array([0, 4, 7]))
+        """
+        vocab = list(self.vocab)
+        index = dict((t, i) for i, t in enumerate(vocab))
+        ids = []
+        for t in (bos, eos):
+            if t not in index:
+                index[t] = len(vocab)
+                vocab.append(t)
+            ids.append(index[t])
+        tokens, sentences, documents = self.arrays()
+        # a boundary token is inserted before the first and after the last token of each document
+        # (np.insert is stable, thus eos of a document precedes bos of the next one)
+        positions = np.column_stack([sentences[documents[:-1]], sentences[documents[1:]]]).ravel()
+        tokens = np.insert(tokens, positions, np.tile(np.array(ids, tokens.dtype), len(self)))
+        # ids are renumbered in order of first occurrence (null and unk keep ids 0 and 1, tokens which do not occur go last)
+        occurring, first = np.unique(tokens, return_index=True)
+        order = occurring[np.argsort(first, kind='mergesort')]
+        order = order[order > 1]
+        order = np.concatenate([[0, 1], order, np.setdiff1d(np.arange(2, len(vocab)), order)]).astype(int)
+        mapping = np.empty(len(vocab), tokens.dtype)
+        mapping[order] = np.arange(len(vocab))
+        tokens = mapping[tokens]
+        vocab = [vocab[i] for i in order]
+        # and so is a sentence of length 1
+        positions = np.column_stack([documents[:-1], documents[1:]]).ravel()
+        lengths = np.insert(np.diff(sentences), positions, 1)
+        sentences = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        return PackedCorpus(tokens, sentences, documents + 2 * np.arange(len(documents)), vocab)
+
+    def counts(self):
+        """number of occurrences of each token in the vocabulary"""
+        tokens, _, _ = self.arrays()
+        return np.bincount(tokens, minlength=len(self.vocab))
+
+    def prune(self, min_count=0, least_common=False):
+        """
+        Replaces rare patterns by unk (see `prune_vocab`).
+
+        >>> corpus = pack_documents([[['a', 'b'], ['c', 'a']]]).prune(least_common=True)
+        >>> corpus.tokens, corpus.vocab
+        (array([2, 1, 1, 2], dtype=int32), ['<null>', '<unk>', 'a'])
+        >>> pack_documents([[['a', 'b'], ['c', 'a']]]).prune(min_count=2).vocab
+        ['<null>', '<unk>', 'a']
+        """
+        tokens, sentences, documents = self.arrays()
+        mapping, vocab, _ = prune_vocab(self.vocab, self.counts(), min_count, least_common)
+        return PackedCorpus(mapping[tokens].astype(np.int32), sentences, documents, vocab)
+
+    def encode(self, vocab, unk='<unk>'):
+        """
+        Re-encodes the corpus with a fixed (training) vocab (see `encode_test_documents`).
+
+        >>> corpus = pack_documents([[['a', 'b'], ['c', 'a']]])
+        >>> corpus.encode({'<null>':0, '<unk>':1, 'c':2, 'a':3}).tokens
+        array([3, 1, 2, 3], dtype=int32)
+        """
+        unk_id = vocab[unk]
+        mapping = np.array([vocab.get(t, unk_id) for t in self.vocab], np.int32)
+        tokens, sentences, documents = self.arrays()
+        return PackedCorpus(mapping[tokens] if tokens.size else tokens, sentences, documents,
+                [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)])
+
+    def flatten_pairs(self, insertion=True, e0=0):
+        """
+        Same as `discourse.util.flatten_pairs`, but links are computed directly from the offset arrays (without visiting documents).
+
+        >>> corpus = PackedCorpus(np.array([1, 2, 3, 4]), np.array([0, 1, 3, 4]), np.array([0, 3]), None)
+        >>> corpus.flatten_pairs()
+        FlatPairs(e=array([0, 1, 0, 1, 0, 2, 3]), f=array([2, 2, 3, 3, 4, 4, 4]), segment=array([0, 0, 1, 1, 2, 2, 2]), document=array([0, 0, 0]), n_segments=3, n_documents=1)
+        >>> corpus.flatten_pairs(insertion=False).e
+        array([1, 1, 2, 3])
+        """
+        tokens, sentences, documents = self.arrays()
+        lengths = np.diff(sentences)
+        # every sentence but the last one in a document heads a pair (E, F) where F is the next sentence
+        last = np.zeros(lengths.size, bool)
+        nonempty = documents[1:] > documents[:-1]
+        last[documents[1:][nonempty] - 1] = True
+        E = np.flatnonzero(~last)
+        F = E + 1
+        # each pattern in F makes a segment and each segment makes as many links as there are patterns in E (plus null)
+        m = lengths[F]
+        n = lengths[E] + int(insertion)
+        n_segments = int(m.sum())
+        pair = np.repeat(np.arange(E.size), m)
+        f = tokens[sentences[F][pair] + np.arange(n_segments) - np.repeat(np.cumsum(m) - m, m)]
+        size = n[pair]
+        segment = np.repeat(np.arange(n_segments), size)
+        k = np.arange(segment.size) - np.repeat(np.cumsum(size) - size, size)
+        e = tokens[np.maximum(sentences[E][pair][segment] + k - int(insertion), 0)].astype(int)
+        if insertion:
+            e[k == 0] = e0
+        doc = np.repeat(np.arange(len(self)), np.diff(documents))
+        return FlatPairs(e=e,
+                f=f[segment].astype(int),
+                segment=segment,
+                document=doc[E][pair],
+                n_segments=n_segments,
+                n_documents=len(self))
+
+    def save(self, prefix):
+        """Stores the corpus: prefix.vocab (with counts) and prefix.tokens.npy, prefix.sentences.npy and prefix.documents.npy"""
+        tokens, sentences, documents = self.arrays()
+        np.save('{0}.tokens.npy'.format(prefix), tokens)
+        np.save('{0}.sentences.npy'.format(prefix), sentences)
+        np.save('{0}.documents.npy'.format(prefix), documents)
+        save_vocab('{0}.vocab'.format(prefix), self.vocab, self.counts())
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """
+        Loads a corpus stored with `save`.
+        By default arrays are memory-mapped (read-only), thus loading takes constant time
+        and processes forked after loading share the same pages.
+        """
+        vocab = load_vocab('{0}.vocab'.format(prefix))
+        return cls(np.load('{0}.tokens.npy'.format(prefix), mmap_mode=mmap_mode),
+                np.load('{0}.sentences.npy'.format(prefix), mmap_mode=mmap_mode),
+                np.load('{0}.documents.npy'.format(prefix), mmap_mode=mmap_mode),
+                [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)])
+
+
+def pack_documents(documents, null='<null>', unk='<unk>'):
+    """
+    Packs documents (as produced by `iter_documents`) in a single pass.
+    As in `encode_documents`, null and unk get ids 0 and 1 and patterns are numbered in order of first occurrence.
+
+    Arguments
+    ---------
+    documents: iterable of documents (lists of sentences, i.e. lists of patterns)
+    null: null symbol (id 0)
+    unk: unknown symbol (id 1)
+
+    Returns
+    -------
+    PackedCorpus
+    """
+    vocab = defaultdict()
+    register_token(null, vocab)
+    register_token(unk, vocab)
+    tokens = array('i')
+    sentences = array('l', [0])
+    documents_ = array('l', [0])
+    for D in documents:
+        for S in D:
+            tokens.extend(register_token(t, vocab) for t in S)
+            sentences.append(len(tokens))
+        documents_.append(len(sentences) - 1)
+    return PackedCorpus(np.frombuffer(tokens, np.int32).copy() if tokens else np.zeros(0, np.int32),
+            np.array(sentences, np.int64),
+            np.array(documents_, np.int64),
+            [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)])
+
+
+def read_corpus(istream, boundary=False, unk=False, min_count=0, vocab=None):
+    """
+    Reads in and encodes training documents in doctext format.
+
+    Arguments
+    ---------
+    istream: documents in doctext format
+    boundary: whether document boundary tokens should be added
+    unk: whether the least common patterns are replaced by unk
+    min_count: patterns occurring fewer times than this are replaced by unk
+    vocab: a vocabulary with counts (tokens, counts) as loaded by `load_vocab_counts`,
+        if None, it is built as the documents are read (see `encode_and_count`)
+
+    Returns
+    -------
+    corpus: list of documents encoded using numpy arrays of ids
+    tokens: the vocabulary (the id of a token is its position)
+    """
+    logging.info('Reading documents in...')
+    documents = iter_documents(istream, boundary)
+    if vocab is None:
+        # patterns are counted as the documents are encoded
+        corpus, tokens, counts = encode_and_count(documents)
+        mapping, pruned, _ = prune_vocab(tokens, counts, min_count, unk)
+        corpus = [[mapping[S] for S in D] for D in corpus]
+    else:
+        # no need to count patterns, they are encoded directly with the (pruned) ids
+        tokens, counts = vocab
+        mapping, pruned, _ = prune_vocab(tokens, counts, min_count, unk)
+        corpus = [encode_test_document(D, dict(izip(tokens, mapping))) for D in documents]
+    logging.info('%d documents read', len(corpus))
+    logging.info('%d patterns replaced by unk', len(tokens) - len(pruned))
+    return corpus, pruned
+
+
+def read_packed(prefix, boundary=False, unk=False, min_count=0):
+    """
+    Loads training documents from a packed corpus.
+
+    Returns
+    -------
+    corpus: PackedCorpus
+    tokens: the vocabulary (the id of a token is its position)
+    """
+    logging.info('Loading packed corpus: %s', prefix)
+    corpus = PackedCorpus.load(prefix)
+    logging.info('%d documents read', len(corpus))
+    if boundary:
+        corpus = corpus.with_boundaries()
+    if unk or min_count:
+        pruned = corpus.prune(min_count, unk)
+        logging.info('%d patterns replaced by unk', len(corpus.vocab) - len(pruned.vocab))
+        corpus = pruned
+    return corpus, corpus.vocab
+
+
+def open_streams(args):
+    """
+    Opens the streams of a command reading documents either from `args.input` (doctext) or from `args.packed`.
+    With --packed nothing is read from the input stream, thus a single positional argument names the output.
+    Paths are opened as by argparse.FileType ('-' stands for stdin/stdout).
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'out.txt')
+    >>> istream, ostream = open_streams(argparse.Namespace(packed='P', input=path, output='-'))
+    >>> istream is None, ostream.name == path
+    (True, True)
+    >>> open_streams(argparse.Namespace(packed='P', input=path, output=path))
+    Traceback (most recent call last):
+    ...
+    ValueError: With --packed the only positional argument is the output
+
+    Returns
+    -------
+    istream: input stream (None with --packed)
+    ostream: output stream
+    """
+    if args.packed:
+        paths = [path for path in (args.input, args.output) if path != '-']
+        if len(paths) > 1:
+            raise ValueError('With --packed the only positional argument is the output')
+        return None, argparse.FileType('w')(paths[0] if paths else '-')
+    return argparse.FileType('r')(args.input), argparse.FileType('w')(args.output)
+
+
+def main(args):
+    logging.basicConfig(
+            level=(logging.DEBUG if args.verbose else logging.INFO),
+            format='%(levelname)s %(message)s')
+    logging.info('Packing documents ...')
+    corpus = pack_documents(iter_documents(args.input))
+    logging.info('%d documents, %d sentences, %d patterns (%d unique)',
+            len(corpus), len(corpus.sentences) - 1, corpus.tokens.size, len(corpus.vocab))
+    logging.info('Saving: %s', args.output)
+    corpus.save(args.output)
+
+
+@command('pack', 'syntax-based')
+def argparser(parser=None, func=main):
+    """parse command line arguments"""
+
+    if parser is None:
+        parser = argparse.ArgumentParser(prog='pack')
+    parser.description = 'Converts a corpus in doctext format to a packed (memory-mappable) corpus'
+    parser.formatter_class = argparse.ArgumentDefaultsHelpFormatter
+
+    parser.add_argument('input', nargs='?',
+            type=argparse.FileType('r'), default=sys.stdin,
+            help='input corpus in doctext format')
+    parser.add_argument('output',
+            type=str,
+            help='prefix for output files (prefix.vocab and prefix.*.npy)')
+    parser.add_argument('--verbose', '-v',
+            action='store_true',
+            help='increase the verbosity level')
+
+    if func is not None:
+        parser.set_defaults(func=func)
+
+    return parser
+
+
+if __name__ == '__main__':
+    main(argparser().parse_args())
@@ -0,0 +1,135 @@
+"""
+Sparse tables for syntax-based models.
+
+Syntax-based models are parameterised by tables indexed by pairs of patterns (e.g. T[f,e] = t(f|e) in IBM model 1).
+Only a tiny fraction of the V x V cells is ever observed (pairs of patterns co-occurring in adjacent sentences),
+thus we store only those cells in coordinate format (COO) sorted by (row, column).
+
+You can test me:
+    python -m doctest sparse.py
+
+@author: wilkeraziz
+"""
+
+import numpy as np
+from discourse.util import atomic_open
+
+
+class SparseTable(object):
+    """
+    A 2-dimensional table which stores only a fixed set of (row, column) cells.
+    Cells which are not stored hold a default value (typically 0).
+
+    >>> T = SparseTable.from_pairs(np.array([2, 0, 2, 0]), np.array([1, 3, 1, 0]), (3, 4))
+    >>> T.rows, T.cols
+    (array([0, 0, 2]), array([0, 3, 1]))
+    >>> T.values[:] = [0.1, 0.2, 0.3]
+    >>> T.lookup(np.array([2, 0, 1]), np.array([1, 0, 1]))
+    array([0.3, 0.1, 0. ])
+    >>> T.index(np.array([0, 1]), np.array([3, 3]))
+    array([ 1, -1])
+    >>> T.size
+    3
+    """
+
+    def __init__(self, keys, values, shape):
+        """
+        Arguments
+        ---------
+        keys: sorted keys of the cells stored (see `encode`)
+        values: value of each cell
+        shape: (number of rows, number of columns)
+        """
+        self.keys = keys
+        self.values = values
+        self.shape = tuple(int(n) for n in shape)
+        self._rows = None
+        self._cols = None
+
+    @classmethod
+    def from_pairs(cls, rows, cols, shape, dtype=float, return_inverse=False):
+        """
+        Constructs a table whose cells are the unique (row, column) pairs given (values are initialised to 0).
+
+        Arguments
+        ---------
+        rows: row of each pair (pairs might repeat)
+        cols: column of each pair
+        shape: (number of rows, number of columns)
+        dtype: type of the values
+        return_inverse: also returns inverse[i] such that the i-th pair is stored in the cell inverse[i]
+
+        Returns
+        -------
+        SparseTable (and inverse if requested)
+        """
+        keys, inverse = np.unique(np.asarray(rows, np.int64) * shape[1] + cols, return_inverse=True)
+        table = cls(keys, np.zeros(keys.size, dtype), shape)
+        return (table, inverse) if return_inverse else table
+
+    @classmethod
+    def from_entries(cls, rows, cols, values, shape):
+        """Constructs a table from (row, column, value) entries (rows and columns must be unique pairs)"""
+        keys = np.asarray(rows, np.int64) * shape[1] + np.asarray(cols, int)
+        order = np.argsort(keys, kind='mergesort')
+        return cls(keys[order], np.asarray(values)[order], shape)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        """
+        Loads a table stored with `save`.
+        By default arrays are memory-mapped (read-only), thus loading takes constant time
+        and processes forked after loading share the same pages.
+        """
+        keys = np.load('{0}.keys.npy'.format(prefix), mmap_mode=mmap_mode)
+        values = np.load('{0}.values.npy'.format(prefix), mmap_mode=mmap_mode)
+        shape = np.load('{0}.shape.npy'.format(prefix))
+        return cls(keys, values, shape)
+
+    def save(self, prefix):
+        """
+        Stores the table in binary format: prefix.keys.npy, prefix.values.npy and prefix.shape.npy
+        (each file is replaced only once it is complete, see `discourse.util.atomic_open`).
+        """
+        for suffix, array in [('keys', self.keys), ('values', self.values), ('shape', np.array(self.shape, np.int64))]:
+            with atomic_open('{0}.{1}.npy'.format(prefix, suffix), 'wb') as fo:
+                np.save(fo, array)
+
+    @property
+    def rows(self):
+        """row of each cell"""
+        if self._rows is None:
+            self._rows = self.keys // self.shape[1]
+        return self._rows
+
+    @property
+    def cols(self):
+        """column of each cell"""
+        if self._cols is None:
+            self._cols = self.keys % self.shape[1]
+        return self._cols
+
+    @property
+    def size(self):
+        """number of cells stored"""
+        return self.values.size
+
+    def encode(self, rows, cols):
+        """encodes (row, column) pairs as sortable integer keys"""
+        return np.asarray(rows, np.int64) * self.shape[1] + cols
+
+    def index(self, rows, cols):
+        """returns the cell of each (row, column) pair, or -1 for pairs which are not stored"""
+        keys = self.encode(rows, cols)
+        if not self.keys.size:
+            return np.full(keys.shape, -1, int)
+        positions = np.minimum(np.searchsorted(self.keys, keys), self.keys.size - 1)
+        return np.where(self.keys[positions] == keys, positions, -1)
+
+    def lookup(self, rows, cols, default=0):
+        """returns the value of each (row, column) pair, or a default value for pairs which are not stored"""
+        positions = self.index(rows, cols)
+        values = np.full(positions.shape, default, self.values.dtype)
+        found = positions >= 0
+        values[found] = self.values[positions[found]]
+        return values
@@ -9,12 +9,20 @@ Also check my docstrings ;)
 @author: wilkeraziz
 """
 import sys
+import os
+import time
+import traceback
 import itertools
 import numpy as np
 import gzip
 import glob
 import random
-from collections import defaultdict, Counter
+import ctypes
+import threading
+from functools import partial
+from contextlib import contextmanager
+from collections import defaultdict, Counter, namedtuple, deque
+from multiprocessing.sharedctypes import RawArray
 
 try:
     from progressbar import ProgressBar, AnimatedMarker, Percentage, Timer, ETA, Bar
@@ -84,6 +92,71 @@ def ibm_pairwise(document, e0=0):
     return ((np.concatenate((np.array([e0], int), _E)), F) for _E, F in pairwise(document))
 
 
+FlatPairs = namedtuple('FlatPairs', 'e f segment document n_segments n_documents')
+
+
+def flatten_pairs(corpus, insertion=True, e0=0):
+    """
+    Flattens all pairs of adjacent sentences in a corpus into index arrays.
+
+    Each pattern f in the second sentence of a pair (E, F) defines a segment
+    and each segment links f to every pattern e in the first sentence of the pair.
+    Links are stored contiguously segment after segment (much like the rows of a CSR matrix),
+    this way quantities such as \sum_j t(f|ej) can be computed with a single gather/scatter (e.g. `np.bincount`).
+
+    Arguments
+    ---------
+    corpus: documents encoded by `encode_documents` (or `encode_test_documents`)
+    insertion: whether or not the null symbol e0 is inserted in the first sentence of each pair (see `ibm_pairwise`)
+    e0: the id of the null symbol
+
+    Returns
+    -------
+    FlatPairs where
+        e[l] is the trigger of the l-th link
+        f[l] is the pattern of the l-th link
+        segment[l] is the segment the l-th link belongs to
+        document[k] is the document the k-th segment belongs to
+        n_segments is the total number of segments
+        n_documents is the total number of documents
+
+    >>> doc = [np.array([1]), np.array([2, 3]), np.array([4])]
+    >>> pairs = flatten_pairs([doc])
+    >>> pairs.e
+    array([0, 1, 0, 1, 0, 2, 3])
+    >>> pairs.f
+    array([2, 2, 3, 3, 4, 4, 4])
+    >>> pairs.segment
+    array([0, 0, 1, 1, 2, 2, 2])
+    >>> pairs.document
+    array([0, 0, 0])
+    >>> flatten_pairs([doc], insertion=False).e
+    array([1, 1, 2, 3])
+    """
+    if hasattr(corpus, 'flatten_pairs'):  # a PackedCorpus knows how to flatten itself (see `discourse.syntax_based.packed`)
+        return corpus.flatten_pairs(insertion, e0)
+    getpairs = partial(ibm_pairwise, e0=e0) if insertion else pairwise
+    E_links, F_links, S_links, S_docs = [], [], [], []
+    n_segments = 0
+    n_documents = 0
+    for i, D in enumerate(corpus):
+        n_documents += 1
+        for E, F in getpairs(D):
+            m, n = len(F), len(E)
+            E_links.append(np.tile(E, m))
+            F_links.append(np.repeat(F, n))
+            S_links.append(np.repeat(np.arange(n_segments, n_segments + m), n))
+            S_docs.append(np.repeat(i, m))
+            n_segments += m
+    concat = lambda arrays: np.concatenate(arrays).astype(int) if arrays else np.zeros(0, int)
+    return FlatPairs(e=concat(E_links),
+            f=concat(F_links),
+            segment=concat(S_links),
+            document=concat(S_docs),
+            n_segments=n_segments,
+            n_documents=n_documents)
+
+
 def partial_ordering(elements, reverse=False, shuf=False):
     sorted_ids = sorted(range(len(elements)), key=lambda i: elements[i], reverse=reverse)
     if not shuf:
@@ -142,11 +215,38 @@ def _partial_ordering(elements, shuf=True, reverse=False):
 
 def read_documents(istream, doc_boundaries=False):
     """reads documents from an input stream"""
+    return list(iter_documents(istream, doc_boundaries))
+
+
+def iter_documents(istream, doc_boundaries=False):
+    """
+    Iterates over documents in an input stream (one at a time, see `read_documents`).
+
+    >>> stream = ['# id=1', 'a b', 'c', '', '# id=2', 'd']
+    >>> list(iter_documents(stream))
+    [[['a', 'b'], ['c']], [['d']]]
+    >>> next(iter_documents(stream, True))
+    [['<doc>'], ['a', 'b'], ['c'], ['</doc>']]
+    """
     def wrap_doc(sentences):
         """wraps a doc with document tags if requested"""
         return itertools.chain(['<doc>'], sentences, ['</doc>']) if doc_boundaries else sentences
 
-    return [[line.split() for line in wrap_doc(lines)] for lines, attrs in iterdoctext(istream)]
+    return ([line.split() for line in wrap_doc(lines)] for lines, attrs in iterdoctext(istream))
+
+
+def chunks(iterable, size):
+    """
+    Groups an iterable into lists of at most `size` elements (only one chunk is held in memory at a time).
+
+    >>> list(chunks(range(5), 2))
+    [[0, 1], [2, 3], [4]]
+    """
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
 
 
 def register_token(t, vocab):
@@ -158,6 +258,132 @@ def register_token(t, vocab):
     return i
 
 
+def save_vocab(path, tokens, counts=None):
+    """stores a vocabulary: one token per line (the token id is the line number) optionally followed by a tab and its count"""
+    with open(path, 'w') as fo:
+        if counts is None:
+            for t in tokens:
+                print >> fo, t
+        else:
+            for t, n in itertools.izip(tokens, counts):
+                print >> fo, '{0}\t{1}'.format(t, n)
+
+
+def load_vocab(path):
+    """loads a vocabulary stored with `save_vocab` into a defaultdict mapping tokens to ids"""
+    with open(path) as fi:
+        return defaultdict(None, ((line.rstrip('\n').split('\t', 1)[0], i) for i, line in enumerate(fi)))
+
+
+def load_vocab_counts(path):
+    """loads a vocabulary stored with `save_vocab` (with counts) returning the list of tokens and an array of counts"""
+    tokens, counts = [], []
+    with open(path) as fi:
+        for line in fi:
+            t, n = line.rstrip('\n').split('\t')
+            tokens.append(t)
+            counts.append(int(n))
+    return tokens, np.array(counts, int)
+
+
+def build_vocab(T, null='<null>', unk='<unk>'):
+    """
+    Counts patterns and assigns them ids in a single pass over a stream of documents (see `encode_and_count`).
+    Documents are not kept, thus memory usage depends only on the size of the vocabulary.
+
+    Returns
+    -------
+    tokens: the vocabulary (the id of a token is its position), null and unk get ids 0 and 1
+    counts: number of occurrences of each token
+
+    >>> build_vocab([[['a', 'b'], ['c', 'a']]])
+    (['<null>', '<unk>', 'a', 'b', 'c'], array([0, 0, 2, 1, 1]))
+    """
+    vocab = defaultdict()
+    register_token(null, vocab)
+    register_token(unk, vocab)
+    counts = [0, 0]
+    for D in T:
+        for S in D:
+            for t in S:
+                i = register_token(t, vocab)
+                if i == len(counts):
+                    counts.append(1)
+                else:
+                    counts[i] += 1
+    return [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)], np.array(counts, int)
+
+
+def encode_and_count(T, null='<null>', unk='<unk>'):
+    """
+    Encodes documents and counts patterns in a single pass (see `prune_vocab` to filter rare patterns afterwards).
+    Ids are assigned in order of first occurrence (as in `encode_documents`).
+
+    Returns
+    -------
+    corpus: list of documents (each a list of numpy arrays of ids)
+    tokens: the vocabulary (the id of a token is its position), null and unk get ids 0 and 1
+    counts: number of occurrences of each token
+
+    >>> corpus, tokens, counts = encode_and_count([[['a', 'b'], ['c', 'a']]])
+    >>> corpus
+    [[array([2, 3]), array([4, 2])]]
+    >>> counts
+    array([0, 0, 2, 1, 1])
+    """
+    vocab = defaultdict()
+    register_token(null, vocab)
+    register_token(unk, vocab)
+    counts = [0, 0]
+
+    def encode_and_count_pattern(t):
+        i = register_token(t, vocab)
+        if i == len(counts):
+            counts.append(1)
+        else:
+            counts[i] += 1
+        return i
+
+    corpus = [[np.array([encode_and_count_pattern(t) for t in S], int) for S in D] for D in T]
+    return corpus, [t for t, i in sorted(vocab.iteritems(), key=lambda (t, i): i)], np.array(counts, int)
+
+
+def prune_vocab(tokens, counts, min_count=0, least_common=False, reserved=2, unk=1):
+    """
+    Maps rare patterns to unk and renumbers the remaining ones preserving their order
+    (thus ids match those assigned by `encode_documents(..., ignore=pruned)`).
+    The first `reserved` ids (null and unk) are never pruned.
+
+    Arguments
+    ---------
+    tokens: the vocabulary (the id of a token is its position)
+    counts: number of occurrences of each token
+    min_count: patterns occurring fewer times than this are pruned
+    least_common: also prunes the least common patterns (see `find_least_common`)
+    reserved: number of reserved ids
+    unk: id of the unk token
+
+    Returns
+    -------
+    mapping (old id to new id), pruned tokens and their counts (unk accumulates the counts of pruned patterns)
+
+    >>> prune_vocab(['<null>', '<unk>', 'a', 'b', 'c'], np.array([0, 0, 3, 1, 2]), min_count=2)
+    (array([0, 1, 2, 1, 3]), ['<null>', '<unk>', 'a', 'c'], array([0, 1, 3, 2]))
+    >>> prune_vocab(['<null>', '<unk>', 'a', 'b', 'c'], np.array([0, 0, 3, 1, 2]), least_common=True)[1]
+    ['<null>', '<unk>', 'a', 'c']
+    """
+    counts = np.asarray(counts)
+    keep = counts >= min_count
+    observed = counts > 0
+    if least_common and observed.any():
+        keep &= counts != counts[observed].min()
+    keep[:reserved] = True
+    mapping = np.cumsum(keep) - 1
+    mapping[~keep] = mapping[unk]
+    pruned = np.bincount(mapping, weights=counts, minlength=keep.sum()).astype(counts.dtype)
+    return mapping, [t for t, k in itertools.izip(tokens, keep) if k], pruned
+
+
 def find_least_common(T):
     counter = Counter(itertools.chain(*(itertools.chain(*((p for p in S) for S in D )) for D in T)))
     if not counter:
@@ -218,8 +444,191 @@ def encode_test_documents(T, vocab, unk='<unk>'):
     array([[array([1]), array([ 2,  3, -1,  2,  3]), array([-1])]], dtype=object)
     """
     assert unk in vocab, 'Your vocab does not assign an id to unknonw symbols'
-    unk_id = vocab['<unk>']
-    return np.array([[np.array([vocab.get(t, unk_id) for t in S], int) for S in D] for D in T])
+    return np.array([encode_test_document(D, vocab, unk) for D in T])
+
+
+def encode_test_document(D, vocab, unk='<unk>'):
+    """
+    Encodes a single test document (a list of sentences) with a fixed (training) vocab.
+
+    >>> vocab = {'<null>':0, '<unk>':1, 'a':2}
+    >>> encode_test_document([['a', 'b'], ['a']], vocab)
+    [array([2, 1]), array([2])]
+    """
+    unk_id = vocab[unk]
+    return [np.array([vocab.get(t, unk_id) for t in S], int) for S in D]
+
+
+def iter_test_documents(istream, vocab, doc_boundaries=False, unk='<unk>'):
+    """
+    Streams test documents encoded with a fixed (training) vocab (see `encode_test_document`),
+    memory usage does not grow with the size of the input.
+    """
+    return (encode_test_document(D, vocab, unk) for D in iter_documents(istream, doc_boundaries))
+
+
+def shared_array(shape, dtype=float):
+    """
+    Allocates a numpy array (initialised with zeros) in shared memory.
+
+    Worker processes forked after the allocation (e.g. by a multiprocessing.Pool) see the same pages,
+    thus the array is never pickled and updates made by any process are visible to all of them.
+
+    >>> A = shared_array((2, 3))
+    >>> A[1,2] = 5
+    >>> A.sum()
+    5.0
+    """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray(ctypes.c_char, max(size * dtype.itemsize, 1))
+    return np.frombuffer(raw, dtype, count=size).reshape(shape)
+
+
+def imap_documents(pool, func, ipaths, read, chunk_size=100, max_pending=8):
+    """
+    Processes the documents of several files in chunks distributed over a pool of workers.
+
+    Chunks are scheduled as workers become available (`apply_async`), thus a large file
+    does not pin a single worker while the others sit idle.
+    At most `max_pending` chunks are read in ahead of the workers, thus memory usage does not grow with the input.
+    Chunks are submitted one at a time (rather than through a generator consumed by the pool),
+    thus several threads may share the same pool (e.g. decoding several corpora concurrently).
+
+    Arguments
+    ---------
+    pool: a multiprocessing.Pool
+    func: a picklable function which maps a chunk (list of documents) to a result
+    ipaths: paths to input files
+    read: a function which maps an input stream to an iterable of documents (called in this process)
+    chunk_size: maximum number of documents in a chunk
+    max_pending: maximum number of chunks read in but not yet processed
+
+    Returns
+    -------
+    generator of pairs (i, results) where i identifies the file (position in ipaths)
+    and results is the list of results of its chunks in order (an empty file makes a single empty chunk);
+    files are yielded (in order) as soon as all of their chunks are processed.
+
+    >>> import tempfile
+    >>> from multiprocessing import Pool
+    >>> path = os.path.join(tempfile.mkdtemp(), 'lines.txt')
+    >>> open(path, 'w').write('line\\n' * 250)
+    >>> pool = Pool(2)
+    >>> list(imap_documents(pool, len, [path, path], lambda istream: istream, chunk_size=100))
+    [(0, [100, 100, 50]), (1, [100, 100, 50])]
+    >>> pool.close()
+    """
+    pending = deque()  # (file, last chunk of the file?, async result) in order of submission
+    results = []
+
+    def collect():
+        i, last, result = pending.popleft()
+        results.append(result.get())
+        if last:
+            done = list(results)
+            del results[:]
+            return i, done
+
+    def submit():
+        # chunks tagged with their file and whether they are the last chunk of that file
+        for i, ipath in enumerate(ipaths):
+            with smart_open(ipath) as istream:
+                # we look one chunk ahead so that the last chunk of a file can be flagged
+                previous = None
+                for chunk in chunks(read(istream), chunk_size):
+                    if previous is not None:
+                        yield i, False, previous
+                    previous = chunk
+                yield i, True, previous if previous is not None else []
+
+    for i, last, chunk in submit():
+        pending.append((i, last, pool.apply_async(func, (chunk,))))
+        while len(pending) >= max_pending:
+            done = collect()
+            if done is not None:
+                yield done
+    while pending:
+        done = collect()
+        if done is not None:
+            yield done
+
+
+Task = namedtuple('Task', 'name func deps')
+
+
+def run_tasks(tasks, max_tasks=1):
+    """
+    Runs a graph of tasks (DAG) where each task starts as soon as the tasks it depends on are done.
+    At most `max_tasks` tasks run at once (each in its own thread), thus tasks should either wait on I/O
+    or delegate their work to processes (e.g. a multiprocessing.Pool shared by all tasks).
+    If a task fails no further task is started and an exception is raised once running tasks are over.
+
+    Arguments
+    ---------
+    tasks: a sequence of Task(name, func, deps) where func takes no arguments and deps is a sequence of names of other tasks
+        (tasks which are ready at the same time start in the order they were given)
+    max_tasks: maximum number of tasks running concurrently
+
+    Returns
+    -------
+    list of triples (name, start, duration) in order of completion, 
+    where start and duration are in seconds (start is relative to the start of the first task)
+
+    >>> log = []
+    >>> tasks = [Task('b', lambda: log.append('b'), ['a']), Task('a', lambda: log.append('a'), []), Task('c', lambda: log.append('c'), ['a', 'b'])]
+    >>> [name for name, start, duration in run_tasks(tasks, 2)], log
+    (['a', 'b', 'c'], ['a', 'b', 'c'])
+    """
+    names = frozenset(task.name for task in tasks)
+    for task in tasks:
+        for dep in task.deps:
+            if dep not in names:
+                raise ValueError('Task {0} depends on an unknown task: {1}'.format(task.name, dep))
+    waiting = list(tasks)
+    done = set()
+    running = set()
+    failed = []
+    timings = []
+    condition = threading.Condition()
+    t0 = time.time()
+
+    def execute(task):
+        start = time.time()
+        try:
+            task.func()
+            error = None
+        except:
+            error = ''.join(traceback.format_exception(*sys.exc_info()))
+        with condition:
+            running.discard(task.name)
+            timings.append((task.name, start - t0, time.time() - start))
+            if error is None:
+                done.add(task.name)
+            else:
+                failed.append((task.name, error))
+            condition.notify()
+
+    with condition:
+        while True:
+            if not failed:
+                for task in [task for task in waiting if all(dep in done for dep in task.deps)]:
+                    if len(running) >= max_tasks:
+                        break
+                    waiting.remove(task)
+                    running.add(task.name)
+                    thread = threading.Thread(target=execute, args=(task,), name=task.name)
+                    thread.daemon = True
+                    thread.start()
+            if not running:
+                break
+            condition.wait()
+
+    if failed:
+        raise Exception('\n'.join('Task {0} failed:\n{1}'.format(name, error) for name, error in failed))
+    if waiting:  # only possible if dependencies are circular
+        raise ValueError('Tasks could not be scheduled (circular dependencies): {0}'.format(', '.join(task.name for task in waiting)))
+    return timings
 
 
 def smart_open(path, *args, **kwargs):
@@ -228,5 +637,40 @@ def smart_open(path, *args, **kwargs):
     else:
         return open(path, *args, **kwargs)
 
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path (a hidden file in the same directory) which is renamed to `path` only if the block completes,
+    thus readers never see a partially written file (the temporary file is removed otherwise).
+    The temporary path is unique to the calling process and thread (see `run_tasks`).
+    """
+    tmp = os.path.join(os.path.dirname(path), '.{0}.{1}.{2}.tmp'.format(os.path.basename(path), os.getpid(), threading.current_thread().ident))
+    try:
+        yield tmp
+        os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    """
+    Opens a file for writing (see `smart_open`) which only replaces `path` once it is complete (see `atomic_path`).
+
+    >>> import tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'file.txt')
+    >>> with atomic_open(path) as fo:
+    ...     print >> fo, 'done'
+    ...     os.path.exists(path)
+    False
+    >>> open(path).read()
+    'done\\n'
+    """
+    with atomic_path(path) as tmp:
+        with (gzip.open(tmp, mode) if path.endswith('.gz') else open(tmp, mode)) as fo:
+            yield fo
+
 if __name__ == '__main__':
     print >> sys.stderr, __doc__